@@ -0,0 +1,176 @@
+import re
+import sys
+import time
+import random
+
+from seance.cluster import Cluster
+from seance.filetypes import FastqFile
+
+# usage: python misc/aligner_parity.py record INPUT RECORDED [NUM_PAIRS]
+#        python misc/aligner_parity.py check RECORDED [THRESHOLD ...]
+#        python misc/aligner_parity.py homopolymer [INPUT]
+#
+# record aligns random pairs of sequences from INPUT (fasta or fastq) with
+# pagan, with and without homopolymer correction, and writes the aligned
+# pairs to RECORDED (this needs pagan to be installed), the time pagan
+# took for each pair is written with it
+#
+# check realigns every recorded pair with the banded aligner and compares
+# the similarity Cluster calculates from both alignments, the exit status
+# is 1 if the two ever disagree on whether a pair passes a threshold, it
+# also reports how often they agree and the time taken by each aligner
+#
+# homopolymer inserts and deletes bases in every homopolymer run of the
+# sequences in INPUT (or of a built in sequence), with homopolymer correction
+# on pagan forgives these so the banded aligner must give a similarity of 1.0
+# in both orientations, the exit status is 1 if it does not
+
+HOMOPOLYMER_SEQUENCE = "GCGCCGGTGGGGTTTGACTACGATCAGGCATCGAAATCAGGGATCGACTAGCCCCATCGACTTTGATCGAC"
+
+def read_sequences(fname) :
+    fq = FastqFile(fname)
+    fq.open()
+    seqs = list(fq)
+    fq.close()
+
+    return seqs
+
+def record(input_fname, recorded_fname, num_pairs) :
+    seqs = read_sequences(input_fname)
+    pagan = Cluster(None, 0.95, False, aligner='pagan')
+    rng = random.Random(1)
+
+    with open(recorded_fname, 'w') as f :
+        for i in range(num_pairs) :
+            seq1,seq2 = rng.sample(seqs, 2)
+
+            for homopolymer_correction in (True, False) :
+                start = time.time()
+                aligned = pagan.pagan_alignment(seq1, seq2, homopolymer_correction)
+                elapsed = time.time() - start
+
+                if len(aligned) != 2 :
+                    continue
+
+                for name,s in zip((seq1.id, seq2.id), aligned) :
+                    print >> f, ">pair%d homopolymer=%d time=%f %s\n%s" % (i, int(homopolymer_correction), elapsed, name, s)
+
+def read_recorded(fname) :
+    # aligned pairs as (homopolymer_correction, pagan time, [aligned1, aligned2])
+    records = []
+
+    with open(fname) as f :
+        header = None
+        for line in f :
+            line = line.strip()
+
+            if line.startswith('>') :
+                header = line
+            elif line :
+                records.append((header, line))
+
+    pairs = []
+    for (header,s1),(_,s2) in zip(records[0::2], records[1::2]) :
+        m = re.search(r'time=([0-9.]+)', header)
+        pairs.append(('homopolymer=1' in header, float(m.group(1)) if m else 0.0, [s1, s2]))
+
+    return pairs
+
+def check(recorded_fname, thresholds) :
+    pairs = read_recorded(recorded_fname)
+    banded = Cluster(None, min(thresholds), False, aligner='banded')
+
+    disagree = dict([ (t, 0) for t in thresholds ])
+    largest = 0.0
+    total = 0.0
+    pagan_time = 0.0
+    banded_time = 0.0
+
+    for homopolymer_correction,elapsed,aligned in pairs :
+        s1,s2 = [ s.replace('-', '') for s in aligned ]
+
+        start = time.time()
+        realigned = banded.banded[homopolymer_correction].align(s1, s2)
+        banded_time += time.time() - start
+        pagan_time += elapsed
+
+        sim1 = banded.distance2(aligned, homopolymer_correction)
+        sim2 = banded.distance2(realigned, homopolymer_correction)
+
+        largest = max(largest, abs(sim1 - sim2))
+        total += abs(sim1 - sim2)
+
+        for t in thresholds :
+            if (sim1 >= t) != (sim2 >= t) :
+                disagree[t] += 1
+
+    print "%d recorded alignments" % len(pairs)
+    print "similarity difference mean %.4f max %.4f" % (total / max(1, len(pairs)), largest)
+
+    for t in thresholds :
+        print "threshold %.2f : %d pairs pass with one aligner and fail with the other (%.2f%% agree)" % \
+                (t, disagree[t], 100.0 * (len(pairs) - disagree[t]) / max(1, len(pairs)))
+
+    print "seconds per alignment pagan %.4f banded %.4f" % \
+            (pagan_time / max(1, len(pairs)), banded_time / max(1, len(pairs)))
+
+    return sum(disagree.values()) == 0
+
+def homopolymer_variants(s) :
+    # every run of two or more bases with one and three extra bases
+    # and with all but one base removed
+    for m in re.finditer(r'(A+|C+|G+|T+)', s) :
+        run = m.group(0)
+
+        if len(run) < 2 :
+            continue
+
+        for replacement in (run + run[0], run + (run[0] * 3), run[0]) :
+            yield s[:m.start()] + replacement + s[m.end():]
+
+def check_homopolymers(seqs) :
+    banded = Cluster(None, 0.95, False, aligner='banded')
+    aligner = banded.banded[True]
+
+    total = 0
+    failed = 0
+
+    for s in seqs :
+        for variant in homopolymer_variants(s) :
+            for seq1,seq2 in ((variant, s), (s, variant)) :
+                aligned = aligner.align(seq1, seq2)
+                sim = banded.distance2(aligned, True)
+                total += 1
+
+                if sim != 1.0 :
+                    failed += 1
+                    print "%.5f\n  %s\n  %s" % (sim, aligned[0], aligned[1])
+
+    print "%d homopolymer indels, %d not similarity 1.0" % (total, failed)
+
+    return failed == 0
+
+def main() :
+    if (len(sys.argv) > 3) and (sys.argv[1] == 'record') :
+        record(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 1000)
+
+    elif (len(sys.argv) > 2) and (sys.argv[1] == 'check') :
+        thresholds = map(float, sys.argv[3:]) or [0.97, 0.98, 0.99]
+        sys.exit(0 if check(sys.argv[2], thresholds) else 1)
+
+    elif (len(sys.argv) > 1) and (sys.argv[1] == 'homopolymer') :
+        if len(sys.argv) > 2 :
+            seqs = [ seq.sequence for seq in read_sequences(sys.argv[2]) ]
+        else :
+            seqs = [ HOMOPOLYMER_SEQUENCE ]
+
+        sys.exit(0 if check_homopolymers(seqs) else 1)
+
+    else :
+        print >> sys.stderr, "usage: %s record INPUT RECORDED [NUM_PAIRS]" % sys.argv[0]
+        print >> sys.stderr, "       %s check RECORDED [THRESHOLD ...]" % sys.argv[0]
+        print >> sys.stderr, "       %s homopolymer [INPUT]" % sys.argv[0]
+        sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
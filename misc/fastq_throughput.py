@@ -0,0 +1,155 @@
+import sys
+import os
+import re
+import random
+import time
+import tempfile
+
+from seance.datatypes import Sequence
+from seance.filetypes import FastqFile
+
+# usage: python misc/fastq_throughput.py [MEGABYTES] [READ_LENGTH]
+#
+# compares the throughput of seance.filetypes.FastqFile with the line by
+# line parser it used to have on a generated fastq file
+
+class LineFastqFile(object) :
+    # FastqFile.read as it was
+    def __init__(self, fname) :
+        self.fname = fname
+
+    def __iter__(self) :
+        state = 0
+        current = [None, None, None, None]
+
+        for line in open(self.fname) :
+            line = line.strip()
+
+            if line == "" :
+                continue
+
+            if line.startswith('+') and (state == 1) :
+                current[2] = line
+                state = 2
+                continue
+
+            if state == 0 :
+                if not (line.startswith('@') or line.startswith('>')) :
+                    raise ValueError("expected a sequence id")
+
+                current = [line, "", "", ""]
+                state = 1
+
+            elif state == 1 :
+                if line.startswith('>') :
+                    yield self.seq(current)
+                    current = [line, "", "", ""]
+                    continue
+
+                current[1] += line
+
+            elif state == 2 :
+                for i in set(line) :
+                    Sequence.quality_to_int(i)
+
+                current[3] += line
+
+                if len(current[1]) == len(current[3]) :
+                    state = 0
+                    yield self.seq(current)
+
+        if current[0] is not None and current[0].startswith('>') :
+            yield self.seq(current)
+
+    def seq(self, current) :
+        seqid = current[0]
+        duplicates = 1
+
+        if "NumDuplicates" in seqid :
+            mat = re.match(">(\S+)\ NumDuplicates=(\d+)$", seqid)
+            seqid = mat.group(1)
+            duplicates = int(mat.group(2))
+
+        tmp = Sequence(current[1], None if current[3] == "" else current[3])
+        tmp.id = seqid
+        tmp.duplicates = duplicates
+
+        return tmp
+
+def generate(fname, size, length) :
+    r = random.Random(1)
+
+    # a pool of reads is repeated, generating a gigabyte one base at
+    # a time would take longer than reading it
+    pool = []
+    for i in range(1000) :
+        s = ''.join([ r.choice('ACGT') for j in range(length) ])
+        q = ''.join([ chr(33 + r.randrange(20, 41)) for j in range(length) ])
+        pool.append((s, q))
+
+    f = open(fname, 'w')
+    written = 0
+    num = 0
+
+    while written < size :
+        s,q = pool[num % len(pool)]
+        record = "@read%d\n%s\n+\n%s\n" % (num, s, q)
+        f.write(record)
+        written += len(record)
+        num += 1
+
+    f.close()
+
+    return num
+
+def measure(name, reads, size) :
+    start = time.time()
+    num = 0
+
+    for seq in reads :
+        num += 1
+
+    elapsed = time.time() - start
+    print "%-30s %9d reads %7.2fs %7.1f MB/s" % (name, num, elapsed, size / 1e6 / elapsed)
+
+    return elapsed
+
+def batched(fname) :
+    fq = FastqFile(fname)
+    fq.open()
+
+    for batch in fq.batches() :
+        for seq in batch :
+            yield seq
+
+    fq.close()
+
+def main() :
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else int(1e9)
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    fd,fname = tempfile.mkstemp(suffix='.fastq')
+    os.close(fd)
+
+    try :
+        num = generate(fname, size, length)
+        size = os.path.getsize(fname)
+
+        print "%d reads of length %d (%.1f MB)" % (num, length, size / 1e6)
+
+        fq = FastqFile(fname)
+        fq.open()
+
+        before = measure("line by line", LineFastqFile(fname), size)
+        after = measure("FastqFile", fq, size)
+        measure("FastqFile.batches", batched(fname), size)
+
+        fq.close()
+
+        print "speedup %.1fx" % (before / after)
+
+    finally :
+        os.remove(fname)
+
+if __name__ == '__main__' :
+    main()
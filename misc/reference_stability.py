@@ -0,0 +1,119 @@
+import sys
+import random
+
+from seance.cluster import Cluster
+from seance.datatypes import Sequence
+
+# usage: python misc/reference_stability.py
+#
+# clusters a previous run and a new sample from scratch and again with
+# --reference style incremental clustering, the new sample has an abundant
+# new OTU that a read from a well established previous OTU is also similar
+# to, in both cases the read must join the previous OTU, the exit status
+# is 1 if it does not
+
+THRESHOLD = 0.95
+
+# keys of the previous OTU's centroid and of the read similar to both OTUs
+X = 0
+Z = 6
+
+class Sequences(object) :
+    # just enough of SequenceDB for Cluster
+    def __init__(self, seqs) :
+        self.seqs = seqs
+
+    def get(self, key) :
+        return self.seqs[key]
+
+    def num_duplicates(self, key) :
+        return self.seqs[key].duplicates
+
+    def __iter__(self) :
+        return iter(self.seqs)
+
+def mutate(s, positions, rng) :
+    tmp = list(s)
+
+    for i in positions :
+        tmp[i] = rng.choice([ c for c in 'ACGT' if c != s[i] ])
+
+    return ''.join(tmp)
+
+def sequence(s, duplicates, name) :
+    seq = Sequence(s)
+    seq.duplicates = duplicates
+    seq.id = name
+
+    return seq
+
+def make_sequences() :
+    rng = random.Random(1)
+    x = ''.join([ rng.choice('ACGT') for i in range(100) ])
+
+    # y is 6 differences from x, z is 3 from each of them
+    y = mutate(x, [10, 25, 40, 55, 70, 85], rng)
+    z = x[:50] + y[50:]
+
+    previous = {
+            X  : sequence(x, 500, X),
+            1  : sequence(mutate(x, [5], rng), 100, 1),
+            2  : sequence(mutate(x, [95], rng), 80, 2)
+        }
+
+    new = {
+            3  : sequence(y, 300, 3),
+            4  : sequence(mutate(y, [30], rng), 60, 4),
+            5  : sequence(mutate(y, [60], rng), 50, 5),
+            Z  : sequence(z, 20, Z)
+        }
+
+    return previous, new
+
+def cluster_of(c, key) :
+    for cluster in c.clusters :
+        if key in cluster :
+            return cluster[0]
+
+    return None
+
+def main() :
+    previous, new = make_sequences()
+
+    # everything from scratch
+    everything = dict(previous)
+    everything.update(new)
+
+    full = Cluster(Sequences(everything), THRESHOLD, False, aligner='banded')
+    full.create_clusters()
+
+    # the previous run, then only the new sample against its centroids
+    first = Cluster(Sequences(previous), THRESHOLD, False, aligner='banded')
+    first.create_clusters()
+
+    reference = []
+    abundance = {}
+
+    for c in first.clusters :
+        name = first.name(c[0])
+        reference.append(sequence(first.sequence(c[0]).sequence, 1, name))
+        abundance[name] = sum([ previous[key].duplicates for key in c ])
+
+    incremental = Cluster(Sequences(new), THRESHOLD, False, aligner='banded', reference=reference, reference_abundance=abundance)
+    incremental.create_clusters()
+
+    expected = full.name(cluster_of(full, X))
+    full_z = full.name(cluster_of(full, Z))
+    incremental_z = incremental.name(cluster_of(incremental, Z))
+
+    print "full re-cluster: z joins %s (x is in %s)" % (full_z, expected)
+    print "incremental: z joins %s (previous OTUs %s)" % (incremental_z, ', '.join(abundance))
+
+    ok = (full_z == expected) and (incremental_z in abundance)
+
+    print "ok" if ok else "FAILED"
+
+    return ok
+
+if __name__ == '__main__' :
+    sys.exit(0 if main() else 1)
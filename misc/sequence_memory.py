@@ -0,0 +1,62 @@
+import sys
+import os
+import gc
+import random
+import time
+
+from seance.datatypes import Sequence
+
+# usage: python misc/sequence_memory.py [NUM_READS] [READ_LENGTH]
+#
+# compares the memory used by seance.datatypes.Sequence with the layout
+# it used to have (__dict__ plus a list of ints for the qualities)
+
+class DictSequence(object) :
+    def __init__(self, seq, qual_str=None) :
+        self.sequence = seq
+        self.qual_str = qual_str
+        self.qualities = map(Sequence.quality_to_int, qual_str) if qual_str is not None else []
+        self.duplicates = 1
+        self.id = None
+
+def rss() :
+    # resident set size in bytes (linux only)
+    with open('/proc/self/statm') as f :
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def measure(cls, reads) :
+    gc.collect()
+    before = rss()
+    start = time.time()
+
+    tmp = [ cls(s, q) for s,q in reads ]
+
+    elapsed = time.time() - start
+    gc.collect()
+    used = rss() - before
+
+    del tmp
+    gc.collect()
+
+    return used, elapsed
+
+def main() :
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    r = random.Random(1)
+    reads = []
+
+    for i in range(num) :
+        s = ''.join([ r.choice('ACGT') for j in range(length) ])
+        q = ''.join([ chr(33 + r.randrange(20, 41)) for j in range(length) ])
+        reads.append((s, q))
+
+    print "%d reads of length %d" % (num, length)
+
+    for name,cls in (("Sequence (__dict__, list of ints)", DictSequence), ("Sequence (__slots__, raw qualities)", Sequence)) :
+        used,elapsed = measure(cls, reads)
+        print "%-40s %8.1f MB %6.1f bytes/read %6.2fs" % (name, used / 1e6, used / float(num), elapsed)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,117 @@
+import sys
+import os
+import gc
+import hashlib
+import random
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from seance.db import SequenceDB
+from seance.sample import Sample
+from seance.filetypes import FastqFile
+
+# usage: python misc/store_startup.py [NUM_SAMPLES] [UNIQUE_PER_SAMPLE] [READ_LENGTH]
+#
+# compares how long cluster takes to load a project and how much memory it
+# uses when the .sample files are parsed and when the samples are read from
+# the sequence store (OUTDIR/sequences.db), it also times get() on every key
+# once the samples are loaded and checks that both give the same keys,
+# counts and sequences, each measurement is run in its own process
+
+def rss() :
+    # resident set size in bytes (linux only)
+    with open('/proc/self/statm') as f :
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def make_project(dirname, num_samples, unique, length) :
+    rng = random.Random(1)
+
+    # samples share sequences, as samples from the same project do
+    pool = [ ''.join([ rng.choice('ACGT') for i in range(length) ]) for j in range(num_samples * unique / 4) ]
+    names = []
+
+    store = SequenceDB(fname=os.path.join(dirname, 'sequences.db'))
+
+    for i in range(num_samples) :
+        fname = os.path.join(dirname, "sample%d.sample" % i)
+        seqs = [ (s, rng.randint(2, 100)) for s in rng.sample(pool, unique) ]
+        seqs.sort(key=lambda x : x[1], reverse=True)
+
+        with open(fname, 'w') as f :
+            for key,(s,count) in enumerate(seqs) :
+                print >> f, ">%d NumDuplicates=%d\n%s" % (key, count, s)
+
+        store.add_sample(os.path.basename(fname), os.path.getmtime(fname), seqs)
+        names.append(fname)
+
+    store.close()
+
+    return names
+
+def load(args) :
+    how,dirname,names = args
+
+    gc.collect()
+    before = rss()
+    start = time.time()
+
+    if how == 'reparse' :
+        db = SequenceDB()
+        samples = [ Sample(FastqFile(fname), dirname, db).seqcounts for fname in names ]
+    else :
+        db = SequenceDB(fname=os.path.join(dirname, 'sequences.db'))
+        samples = [ db.get_sample(os.path.basename(fname), os.path.getmtime(fname)) for fname in names ]
+
+    elapsed = time.time() - start
+    gc.collect()
+    used = rss() - before
+
+    start = time.time()
+    md5 = hashlib.md5()
+
+    for key in range(db.num_sequences()) :
+        md5.update(db.get(key).sequence)
+
+    get_elapsed = time.time() - start
+
+    for seqcounts in samples :
+        md5.update(repr(sorted(seqcounts.items())))
+
+    return how, elapsed, used, get_elapsed, db.num_sequences(), db.num_reads(), md5.hexdigest()
+
+def main() :
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    unique = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    length = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+
+    dirname = tempfile.mkdtemp()
+
+    try :
+        names = make_project(dirname, num_samples, unique, length)
+
+        print "%d samples of %d unique sequences of length %d" % (num_samples, unique, length)
+
+        digests = set()
+
+        for how in ('reparse', 'store') :
+            pool = multiprocessing.Pool(1)
+
+            try :
+                how,elapsed,used,get_elapsed,nseqs,nreads,digest = pool.apply(load, ((how, dirname, names),))
+            finally :
+                pool.terminate()
+
+            print "%-8s load %7.2fs %8.1f MB  get() on all %d keys %7.2fs  (%d reads)" % \
+                    (how, elapsed, used / 1e6, nseqs, get_elapsed, nreads)
+
+            digests.add(digest)
+
+        print "same keys, counts and sequences" if len(digests) == 1 else "DIFFERENT keys, counts or sequences"
+
+    finally :
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__' :
+    main()
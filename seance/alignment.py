@@ -0,0 +1,268 @@
+import math
+
+
+class AlignmentError(Exception) :
+    pass
+
+class BandedAligner(object) :
+    # scoring scheme, gaps are affine (open includes the first position)
+    # and cheaper inside homopolymer runs when homopolymer correction is on
+    match = 2
+    mismatch = -3
+    gap_open = -5
+    gap_extend = -2
+    homopolymer_gap_open = -2
+    homopolymer_gap_extend = -1
+
+    # minimum number of diagonals either side of the main band
+    min_band = 5
+
+    # OTU thresholds are >= 0.95, so bands are never narrower than that,
+    # this keeps similarities independent of the threshold they were
+    # calculated for (see SimilarityCache)
+    max_band_threshold = 0.95
+
+    # seeds used to find diagonals the sequences share, a diagonal needs
+    # this many seed hits (i.e. about seed_length + seed_hits bases in common)
+    seed_length = 8
+    seed_hits = 8
+
+    NEG = -(1 << 30)
+
+    def __init__(self, similarity_threshold=0.95, homopolymer_correction=True) :
+        if (similarity_threshold < 0.0) or (similarity_threshold > 1.0) :
+            raise AlignmentError("similarity threshold must be between 0.0 and 1.0 (read %.2f)" % similarity_threshold)
+
+        self.similarity_threshold = similarity_threshold
+        self.homopolymer_correction = homopolymer_correction
+
+    def bandwidth(self, n, m) :
+        # number of diagonals either side of the diagonals the sequences share,
+        # this only covers substitutions and short indels: distance2 counts a
+        # whole run of gaps as one difference, so a long indel can still pass
+        # the threshold and has to be found with diagonals()
+        threshold = min(self.similarity_threshold, self.max_band_threshold)
+        return int(math.ceil((1.0 - threshold) * max(n, m))) + self.min_band
+
+    def diagonals(self, a, b) :
+        """lowest and highest diagonal (j - i) with at least seed_hits exact
+        seed matches, both are 0 if the sequences share nothing"""
+        k = self.seed_length
+        seeds = {}
+
+        for j in range(len(b) - k + 1) :
+            seeds.setdefault(b[j:j+k], []).append(j)
+
+        hits = {}
+        for i in range(len(a) - k + 1) :
+            for j in seeds.get(a[i:i+k], ()) :
+                hits[j - i] = hits.get(j - i, 0) + 1
+
+        shared = [ d for d,count in hits.iteritems() if count >= self.seed_hits ]
+
+        if not shared :
+            return 0, 0
+
+        return min(shared), max(shared)
+
+    def __gap_costs(self, s) :
+        # per-position gap costs, a position is in a homopolymer if
+        # either of its neighbours is the same base
+        opens = [self.gap_open] * len(s)
+        extends = [self.gap_extend] * len(s)
+
+        if not self.homopolymer_correction :
+            return opens, extends
+
+        for i in range(len(s)) :
+            if ((i > 0) and (s[i-1] == s[i])) or ((i + 1 < len(s)) and (s[i+1] == s[i])) :
+                opens[i] = self.homopolymer_gap_open
+                extends[i] = self.homopolymer_gap_extend
+
+        return opens, extends
+
+    def align(self, seq1, seq2) :
+        """global alignment of two strings within a band around the diagonal,
+        terminal gaps are free as they are not counted by Cluster.distance2
+        returns a list of the two aligned strings"""
+        a = seq1
+        b = seq2
+        n = len(a)
+        m = len(b)
+
+        if (n == 0) or (m == 0) :
+            return [a + ('-' * m), ('-' * n) + b]
+
+        NEG = self.NEG
+        match = self.match
+        mismatch = self.mismatch
+
+        w = self.bandwidth(n, m)
+        lo,hi = self.diagonals(a, b)
+        dlo = max(min(0, m - n, lo) - w, -n)
+        dhi = min(max(0, m - n, hi) + w, m)
+        width = dhi - dlo + 1
+
+        a_open, a_ext = self.__gap_costs(a)
+        b_open, b_ext = self.__gap_costs(b)
+
+        # row i, column j is stored at index j - i - dlo
+        # H = best score, E = gap in seq1 (consume seq2), F = gap in seq2 (consume seq1)
+        # pointers: H 0 = diagonal, 1 = from E, 2 = from F
+        #           E/F 0 = opened, 1 = extended
+        Hptr = []
+        Eptr = []
+        Fptr = []
+
+        prevH = [NEG] * width
+        prevE = [NEG] * width
+        prevF = [NEG] * width
+
+        for j in range(0, min(m, dhi) + 1) :
+            prevH[j - dlo] = 0
+
+        Hptr.append([0] * width)
+        Eptr.append([0] * width)
+        Fptr.append([0] * width)
+
+        best = NEG
+        best_cell = (0, 0)
+
+        if dhi >= m :
+            best = 0
+            best_cell = (0, m)
+
+        for i in range(1, n + 1) :
+            curH = [NEG] * width
+            curE = [NEG] * width
+            curF = [NEG] * width
+            hp = [0] * width
+            ep = [0] * width
+            fp = [0] * width
+
+            ai = a[i-1]
+            ao = a_open[i-1]
+            ae = a_ext[i-1]
+
+            jlo = max(0, i + dlo)
+            jhi = min(m, i + dhi)
+
+            for j in range(jlo, jhi + 1) :
+                k = j - i - dlo
+
+                if j == 0 :
+                    curH[k] = 0
+                    continue
+
+                # gap in seq1, consuming b[j-1]
+                e = NEG
+                if k > 0 :
+                    e1 = curH[k-1] + b_open[j-1]
+                    e2 = curE[k-1] + b_ext[j-1]
+                    if e2 > e1 :
+                        e = e2
+                        ep[k] = 1
+                    else :
+                        e = e1
+
+                # gap in seq2, consuming a[i-1]
+                f = NEG
+                if k + 1 < width :
+                    f1 = prevH[k+1] + ao
+                    f2 = prevF[k+1] + ae
+                    if f2 > f1 :
+                        f = f2
+                        fp[k] = 1
+                    else :
+                        f = f1
+
+                h = prevH[k] + (match if ai == b[j-1] else mismatch)
+                ptr = 0
+
+                # gaps win ties, the traceback then takes them as late as
+                # possible, so a gap in a homopolymer run is on its right
+                # where distance2 can see the base it follows
+                if e >= h :
+                    h = e
+                    ptr = 1
+
+                if f >= h :
+                    h = f
+                    ptr = 2
+
+                curH[k] = h
+                curE[k] = e
+                curF[k] = f
+                hp[k] = ptr
+
+            Hptr.append(hp)
+            Eptr.append(ep)
+            Fptr.append(fp)
+
+            # free trailing gaps in seq1
+            if jhi == m :
+                k = m - i - dlo
+                if curH[k] > best :
+                    best = curH[k]
+                    best_cell = (i, m)
+
+            prevH = curH
+            prevE = curE
+            prevF = curF
+
+        # free trailing gaps in seq2
+        for j in range(max(0, n + dlo), min(m, n + dhi) + 1) :
+            k = j - n - dlo
+            if prevH[k] > best :
+                best = prevH[k]
+                best_cell = (n, j)
+
+        if best == NEG :
+            raise AlignmentError("no alignment found within band")
+
+        i,j = best_cell
+
+        # pieces are collected back to front
+        aln1 = [ '-' * (m - j), a[i:] ]
+        aln2 = [ b[j:], '-' * (n - i) ]
+
+        state = 0
+        while (i > 0) and (j > 0) :
+            k = j - i - dlo
+
+            if state == 0 :
+                ptr = Hptr[i][k]
+
+                if ptr == 0 :
+                    aln1.append(a[i-1])
+                    aln2.append(b[j-1])
+                    i -= 1
+                    j -= 1
+                else :
+                    state = ptr
+
+            elif state == 1 :
+                aln1.append('-')
+                aln2.append(b[j-1])
+
+                if not Eptr[i][k] :
+                    state = 0
+
+                j -= 1
+
+            else :
+                aln1.append(a[i-1])
+                aln2.append('-')
+
+                if not Fptr[i][k] :
+                    state = 0
+
+                i -= 1
+
+        # free leading gaps
+        aln1.append('-' * j)
+        aln1.append(a[:i])
+        aln2.append(b[:j])
+        aln2.append('-' * i)
+
+        return [ ''.join(aln1[::-1]), ''.join(aln2[::-1]) ]
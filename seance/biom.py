@@ -2,12 +2,15 @@ import sys
 import datetime
 import json
 
+from seance.compression import open_file, detect
+
 class BiomFile(object) :
     def __init__(self) :
         self.samples = []
         self.metadata = {}
         self.otus = []
         self.data = []
+        self.column_metadata = {} # from files that were read in
 
     def set_samples(self, sample_list) :
         self.samples = [ s.description() for s in sample_list ]
@@ -29,6 +32,9 @@ class BiomFile(object) :
             self.data.append((otuid, sampleid, value))
 
     def sample_metadata(self, sample_name) :
+        if sample_name in self.column_metadata :
+            return self.column_metadata[sample_name]
+
         if sample_name not in self.metadata :
             return "null"
         tmp = {}
@@ -43,8 +49,8 @@ class BiomFile(object) :
         tmp = self.sample_metadata(sample_name)
         return "{ " + ", ".join(map(lambda x: "%s : %s" % (repr(x[0]).replace("'","\""), repr(x[1]).replace("'","\"")), tmp.items())) + " }"
 
-    def write_to(self, filename) :
-        f = open(filename, 'w')
+    def write_to(self, filename, compression=None) :
+        f = open_file(filename, 'w', compression)
         self.write(f)
         f.close()
 
@@ -76,21 +82,43 @@ class BiomFile(object) :
 
         print >> f, json.dumps(tmp, sort_keys=True, indent=2, separators=(",",": "))
 
+    def read_from(self, filename) :
+        with open_file(filename) as f :
+            tmp = json.load(f)
+
+        self.samples = [ c['id'] for c in tmp['columns'] ]
+        self.metadata = {}
+        self.column_metadata = dict([ (c['id'], c['metadata']) for c in tmp['columns'] ])
+        self.otus = [ (r['id'], r['metadata']['label']) for r in tmp['rows'] ]
+        self.data = [ tuple(i) for i in tmp['data'] ]
+
+    def otu_abundances(self) :
+        # otu id --> total count over all samples
+        tmp = dict([ (otu[0], 0) for otu in self.otus ])
+
+        for otuid,sampleid,value in self.data :
+            tmp[self.otus[otuid][0]] += value
+
+        return tmp
+
     def change_otu_names(self, filename, names) :
-        tmp = json.load(open(filename))
+        with open_file(filename) as f :
+            tmp = json.load(f)
 
         # iterate through and alter any in 'names'
         for r in tmp['rows'] :
             if r['id'] in names :
                 r['metadata']['label'] = names[r['id']]
 
-        # rewrite the file
-        f = open(filename, 'w')
+        # rewrite the file (compressed if it was before)
+        f = open_file(filename, 'w', detect(filename))
         print >> f, json.dumps(tmp, sort_keys=True, indent=2, separators=(",",": "))
         f.close()
 
     def get_label_mapping(self, filename) :
-        data = json.load(open(filename))
+        with open_file(filename) as f :
+            data = json.load(f)
+
         tmp = {}
 
         for r in data['rows'] :
@@ -0,0 +1,101 @@
+import time
+import hashlib
+import sqlite3
+import logging
+
+
+class SimilarityCache(object) :
+    """content-addressed on-disk cache of pairwise similarities
+
+    entries are keyed by the hashes of both sequences, the homopolymer
+    correction flag and the alignment method, stored in an sqlite database
+    (which takes care of locking if several runs share the same file) and
+    evicted least recently used first once there are more than max_entries"""
+
+    def __init__(self, fname, max_entries=1000000, flush_interval=1000) :
+        self.fname = fname
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.log = logging.getLogger('seance')
+
+        self.hits = 0
+        self.misses = 0
+
+        self._new = {}
+        self._used = set()
+
+        self._conn = sqlite3.connect(fname, timeout=300)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS similarity (
+                                seq1 TEXT NOT NULL,
+                                seq2 TEXT NOT NULL,
+                                homopolymer INTEGER NOT NULL,
+                                method TEXT NOT NULL,
+                                similarity REAL NOT NULL,
+                                last_used REAL NOT NULL,
+                                PRIMARY KEY (seq1, seq2, homopolymer, method))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS similarity_last_used ON similarity (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def digest(seq) :
+        return hashlib.sha1(seq.sequence).hexdigest()
+
+    def __key(self, seq1, seq2, homopolymer_correction, method) :
+        return (SimilarityCache.digest(seq1), SimilarityCache.digest(seq2), int(homopolymer_correction), method)
+
+    def get(self, seq1, seq2, homopolymer_correction, method) :
+        key = self.__key(seq1, seq2, homopolymer_correction, method)
+
+        if key in self._new :
+            self.hits += 1
+            return self._new[key]
+
+        row = self._conn.execute("""SELECT similarity FROM similarity
+                                    WHERE seq1 = ? AND seq2 = ? AND homopolymer = ? AND method = ?""", key).fetchone()
+
+        if row is None :
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._used.add(key)
+
+        return row[0]
+
+    def put(self, seq1, seq2, homopolymer_correction, method, similarity) :
+        self._new[self.__key(seq1, seq2, homopolymer_correction, method)] = similarity
+
+        if len(self._new) >= self.flush_interval :
+            self.flush()
+
+    def flush(self) :
+        now = time.time()
+
+        with self._conn :
+            self._conn.executemany("""INSERT OR REPLACE INTO similarity
+                                      (seq1, seq2, homopolymer, method, similarity, last_used)
+                                      VALUES (?, ?, ?, ?, ?, ?)""",
+                                   [ k + (v, now) for k,v in self._new.iteritems() ])
+
+            self._conn.executemany("""UPDATE similarity SET last_used = ?
+                                      WHERE seq1 = ? AND seq2 = ? AND homopolymer = ? AND method = ?""",
+                                   [ (now,) + k for k in self._used ])
+
+            count = self._conn.execute("SELECT COUNT(*) FROM similarity").fetchone()[0]
+
+            if count > self.max_entries :
+                self._conn.execute("""DELETE FROM similarity WHERE rowid IN
+                                      (SELECT rowid FROM similarity ORDER BY last_used LIMIT ?)""",
+                                   (count - self.max_entries,))
+
+        self._new = {}
+        self._used = set()
+
+    def close(self) :
+        self.flush()
+        self._conn.close()
+
+        self.log.info("similarity cache %s: %d hits, %d misses" % (self.fname, self.hits, self.misses))
+
+    def __str__(self) :
+        return "%s: hits = %d, misses = %d" % (type(self).__name__, self.hits, self.misses)
@@ -0,0 +1,122 @@
+import os
+import time
+import json
+import hashlib
+import logging
+
+
+class CheckpointError(Exception) :
+    pass
+
+class Checkpoint(object) :
+    """periodic snapshots of a clustering run
+
+    a snapshot holds the clusters of every level (one per similarity
+    threshold) and how far through the clustering order the run got, it is
+    written to a temporary file and renamed so a crash part way through a
+    write leaves the previous snapshot intact. snapshots are taken every
+    interval seconds or every sequences sequences, whichever comes first
+    (0 turns either off). settings are the options that affect clustering,
+    a run only resumes from a snapshot taken with the same settings"""
+
+    def __init__(self, fname, interval=600, sequences=0, settings=None) :
+        if (interval < 0) or (sequences < 0) :
+            raise CheckpointError("checkpoint intervals must be >= 0 (read %d, %d)" % (interval, sequences))
+
+        self.fname = fname
+        self.interval = interval
+        self.sequences = sequences
+        self.settings = settings or {}
+        self.log = logging.getLogger('seance')
+
+        self.last_time = time.time()
+        self.last_position = 0
+
+    @staticmethod
+    def digest(order) :
+        # identifies the clustering order, a snapshot is only valid
+        # for exactly the same input
+        h = hashlib.sha1()
+
+        for key in order :
+            h.update(repr(key))
+            h.update('\0')
+
+        return h.hexdigest()
+
+    def due(self, position) :
+        if self.interval and ((time.time() - self.last_time) >= self.interval) :
+            return True
+
+        if self.sequences and ((position - self.last_position) >= self.sequences) :
+            return True
+
+        return False
+
+    def save(self, levels, order, position) :
+        tmp = {
+                'order'    : Checkpoint.digest(order),
+                'position' : position,
+                'settings' : self.settings,
+                'levels'   : [ { 'threshold' : l.similarity_threshold, 'method' : l.method(), 'clusters' : l.clusters } for l in levels ]
+              }
+
+        tmpname = self.fname + '.tmp'
+
+        f = open(tmpname, 'w')
+        json.dump(tmp, f, separators=(',',':'))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        os.rename(tmpname, self.fname)
+
+        self.last_time = time.time()
+        self.last_position = position
+
+        self.log.info("checkpoint written to %s (%d / %d sequences)" % (self.fname, position, len(order)))
+
+    def restore(self, levels, order) :
+        """restores the clusters of each level from the last snapshot and
+        returns the position in order to continue from (0 if there was no
+        usable snapshot), raises CheckpointError if the snapshot is from a
+        run with different input or settings"""
+        if not os.path.exists(self.fname) :
+            self.log.warn("no checkpoint found at %s, starting from the beginning" % self.fname)
+            return 0
+
+        try :
+            tmp = json.load(open(self.fname))
+
+        except ValueError, ve :
+            self.log.warn("could not read checkpoint %s (%s), starting from the beginning" % (self.fname, str(ve)))
+            return 0
+
+        saved = tmp.get('settings', {})
+        different = sorted([ k for k in set(saved) | set(self.settings) if saved.get(k) != self.settings.get(k) ])
+
+        if [ l['threshold'] for l in tmp['levels'] ] != [ l.similarity_threshold for l in levels ] :
+            different.append('similarity')
+
+        if [ l.get('method') for l in tmp['levels'] ] != [ l.method() for l in levels ] :
+            different.append('aligner')
+
+        if tmp['order'] != Checkpoint.digest(order) :
+            different.append('input')
+
+        if different :
+            raise CheckpointError("checkpoint %s is from a run with different %s, remove it to start from the beginning" % \
+                    (self.fname, ', '.join(sorted(set(different)))))
+
+        for level,saved in zip(levels, tmp['levels']) :
+            level.restore(saved['clusters'])
+
+        self.last_position = tmp['position']
+
+        self.log.info("resuming from checkpoint %s (%d / %d sequences)" % (self.fname, tmp['position'], len(order)))
+
+        return tmp['position']
+
+    def remove(self) :
+        if os.path.exists(self.fname) :
+            os.remove(self.fname)
@@ -2,21 +2,71 @@ import sys
 import os
 import collections
 import logging
+import multiprocessing
 
 from seance.system import System
 from seance.tools import Pagan
 from seance.progress import Progress
-from seance.system import System
+from seance.alignment import BandedAligner, AlignmentError
+from seance.kmers import KmerIndex, homopolymer_compress
+from seance.distance import identity
+
+
+# one instance per worker process, keyed by (aligner, threshold)
+_workers = {}
+
+def _similarity_worker(args) :
+    aligner, threshold, seq1, seq2, homopolymer_correction = args
+
+    if (aligner, threshold) not in _workers :
+        _workers[(aligner, threshold)] = Cluster(None, threshold, False, aligner=aligner)
+
+    return _workers[(aligner, threshold)].alignment_similarity(seq1, seq2, homopolymer_correction)
 
+def _batch_similarity_worker(args) :
+    aligner, threshold, seqs, seq2, homopolymer_correction = args
+
+    if (aligner, threshold) not in _workers :
+        _workers[(aligner, threshold)] = Cluster(None, threshold, False, aligner=aligner)
+
+    return _workers[(aligner, threshold)].batch_similarity(seqs, seq2, homopolymer_correction)
 
 class Cluster(object) :
-    def __init__(self, db, similiarity_threshold, verbose) :
+    aligners = ('banded', 'pagan', 'pagan-batch')
+
+    # number of centroids aligned against a query in a single pagan call
+    pagan_batch_size = 16
+
+    def __init__(self, db, similiarity_threshold, verbose, aligner='pagan', kmer=0, threads=1, cache=None, reference=None, reference_abundance=None, dereplicate=False) :
+        if aligner not in Cluster.aligners :
+            raise ValueError("'%s' is not a valid aligner (valid options: %s)" % (aligner, ', '.join(Cluster.aligners)))
+
         self.db = db
         self.similarity_threshold = similiarity_threshold
         self.clusters = []
         self.verbose = verbose
+        self.aligner = aligner
+        self.kmer = kmer
+        self.kmer_index = None
+        self.threads = threads
+        self.cache = cache
         self.log = logging.getLogger('seance')
 
+        self.dereplicate = dereplicate
+        self.members = {} # representative --> keys it stands for while clustering
+
+        self.reference = {} # centroid name --> sequence, for clusters from a previous run
+        self.weight = {} # centroid name --> abundance in the previous run
+        self.offset = 0
+
+        if reference :
+            self.add_reference(reference, reference_abundance)
+
+        self.banded = {
+                True  : BandedAligner(similiarity_threshold, homopolymer_correction=True),
+                False : BandedAligner(similiarity_threshold, homopolymer_correction=False)
+            }
+
     def __len__(self) :
         return len(self.clusters)
 
@@ -30,6 +80,43 @@ class Cluster(object) :
 
     def centroids(self) :
         return [ c[0] for c in self.clusters ]
+
+    def add_reference(self, seqs, abundance=None) :
+        """seed the clusters with centroids from a previous run, seqs are in
+        cluster order and their ids are the previous names (seanceN), new
+        clusters are numbered after the largest N so names stay stable,
+        abundance maps names to read counts from the previous biom file"""
+        if abundance is None :
+            abundance = {}
+
+        for seq in seqs :
+            self.reference[seq.id] = seq
+            self.weight[seq.id] = abundance.get(seq.id, 0)
+            self.clusters.append([seq.id])
+
+            try :
+                self.offset = max(self.offset, int(seq.id[len('seance'):]) + 1)
+
+            except ValueError :
+                pass
+
+    def size(self, c) :
+        # clusters from a previous run only hold their centroid, they are
+        # ranked by their previous read count, which is never less than the
+        # number of sequences they had, so new clusters do not overtake them
+        return len(c) + self.weight.get(c[0], 0)
+
+    def sequence(self, key) :
+        if key in self.reference :
+            return self.reference[key]
+
+        return self.db.get(key)
+
+    def name(self, key) :
+        if key in self.reference :
+            return key
+
+        return "seance%d" % (key + self.offset)
     
     def merge(self, names) :
         self.log.info("merging clusters based on labels")
@@ -58,90 +145,68 @@ class Cluster(object) :
 
         self.log.info("%d clusters merged into %d clusters based on blast hits" % (len(self.clusters), len(merged_clusters)))
 
-        self.clusters = sorted(merged_clusters.values(), key=len, reverse=True)
+        self.clusters = sorted(merged_clusters.values(), key=self.size, reverse=True)
 
     def distance(self, aligned, homopolymer_correction) :
-        leng = float(min(len(aligned[0]), len(aligned[1])))
-
-        last_gap = True 
-        diff = 0
-        for c1,c2 in zip(aligned[0], aligned[1]) :
-            gap = '-' in (c1,c2)
-
-            if last_gap and gap :
-                continue
-
-            if c1 != c2 :
-                diff += 1
+        return identity([aligned])[0]
 
-            last_gap = gap
-
-        if last_gap :
-            diff -= 1
+    def distance2(self, aligned, homopolymer_correction) :
+        return identity([aligned], homopolymer_correction=homopolymer_correction)[0]
 
-        return (leng - diff) / leng
+    def distances(self, alignments, homopolymer_correction) :
+        # alignments that failed (i.e. not two sequences) get 0.0
+        good = [ aligned for aligned in alignments if len(aligned) == 2 ]
+        sims = iter(identity(good, homopolymer_correction=homopolymer_correction))
 
-    def distance2(self, aligned, homopolymer_correction) :
-        leng = float(min(len(aligned[0]), len(aligned[1])))
-
-        # terminal homopolymer can cause problems
-        #
-        # pagan does 
-        # XYYYY
-        # X-YYY
-        #
-        # instead of 
-        # XYYYYZ
-        # XYYY-Z
-        if homopolymer_correction :
-            last = aligned[0][-1]
+        return [ sims.next() if len(aligned) == 2 else 0.0 for aligned in alignments ]
 
-            a0 = aligned[0].rstrip(last)
-            a1 = aligned[1].rstrip(last)
+    def method(self) :
+        # identifies how similarities were calculated for the cache
+        # (banded3 bands follow the diagonals both sequences share and put
+        # gaps on the right of homopolymer runs, similarities cached by
+        # earlier versions of the banded aligner are not reused)
+        if self.aligner == 'banded' :
+            tmp = self.banded[True]
+            if self.similarity_threshold < tmp.max_band_threshold :
+                return "banded3/%.4f" % self.similarity_threshold
 
-            if (len(a0) < len(a1)) and (a1[-1] == '-') :
-                aligned[1] = a1[:-1] + (last * (len(a1) - len(a0)))
+            return "banded3"
 
-            elif (len(a1) < len(a0)) and (a0[-1] == '-') :
-                aligned[0] = a0[:-1] + (last * (len(a0) - len(a1)))
+        return self.aligner
 
+    def similarity(self, seq1, seq2, homopolymer_correction) :
+        if self.cache is None :
+            return self.alignment_similarity(seq1, seq2, homopolymer_correction)
 
-        last_match = '-'
-        last_gap = True 
-        diff = 0
+        sim = self.cache.get(seq1, seq2, homopolymer_correction, self.method())
 
-        for c1,c2 in zip(aligned[0], aligned[1]) :
-            gap = '-' in (c1,c2)
+        if sim is None :
+            sim = self.alignment_similarity(seq1, seq2, homopolymer_correction)
+            self.cache.put(seq1, seq2, homopolymer_correction, self.method(), sim)
 
-            # only count gaps as a single difference
-            # so continue
-            if last_gap and gap :
-                continue
+        return sim
 
-            # however, if the gap is trailing a homopolymer
-            # we may want to also ignore it
-            if gap :
-                # only one can have a gap
-                # if last character was a match and 
-                # the other current character is the same
-                #   => then we are in a homopolymer
-                #   => if homopolymer_correction, continue
-                c = c1 if c1 != '-' else c2
-                if c == last_match and homopolymer_correction :
-                    continue
+    def alignment_similarity(self, seq1, seq2, homopolymer_correction) :
+        if self.aligner in ('pagan', 'pagan-batch') :
+            aligned = self.pagan_alignment(seq1, seq2, homopolymer_correction)
+        else :
+            aligned = self.banded_alignment(seq1, seq2, homopolymer_correction)
 
-            if c1 != c2 :
-                diff += 1
+        # if things are really dissimilar they do not align
+        # so just give up here for this cluster
+        if len(aligned) != 2 :
+            return 0.0
 
-            last_match = c1 if c1 == c2 else '-'
-            last_gap = gap
+        return self.distance2(aligned, homopolymer_correction)
 
-        if last_gap :
-            diff -= 1
+    def banded_alignment(self, seq1, seq2, homopolymer_correction) :
+        try :
+            return self.banded[homopolymer_correction].align(seq1.sequence, seq2.sequence)
 
-        return (leng - diff) / leng
+        except AlignmentError :
+            return []
 
-    def alignment_similarity(self, seq1, seq2, homopolymer_correction) :
+    def pagan_alignment(self, seq1, seq2, homopolymer_correction) :
         # write out
         f = open(System.tempfilename(ext='cluster'), 'w')
 
@@ -171,55 +236,337 @@ class Cluster(object) :
         os.remove(f.name)
         os.remove(fq.get_filename())
 
-        # if things are really dissimilar they do not align
-        # so just give up here for this cluster
-        if len(aligned) != 2 :
-            return 0.0
+        return aligned
 
-        return self.distance2(aligned, homopolymer_correction)
+    def batch_similarity(self, seqs, seq2, homopolymer_correction) :
+        """similarities of seq2 against each of seqs"""
+        if self.aligner == 'pagan-batch' :
+            alignments = self.pagan_batch_alignment(seqs, seq2, homopolymer_correction)
+        elif self.aligner == 'pagan' :
+            alignments = [ self.pagan_alignment(s, seq2, homopolymer_correction) for s in seqs ]
+        else :
+            alignments = [ self.banded_alignment(s, seq2, homopolymer_correction) for s in seqs ]
+
+        return self.distances(alignments, homopolymer_correction)
+
+    def pagan_batch_alignment(self, seqs, seq2, homopolymer_correction) :
+        # one pagan call aligns the query and a block of centroids, pairwise
+        # alignments are read off the combined alignment by dropping columns
+        # that are gaps in both sequences
+        f = open(System.tempfilename(ext='cluster'), 'w')
+
+        print >> f, ">query NumDuplicates=%d\n%s" % (seq2.duplicates, seq2.sequence)
+        for i,s in enumerate(seqs) :
+            print >> f, ">c%d NumDuplicates=%d\n%s" % (i, s.duplicates, s.sequence)
+
+        f.close()
+
+        if homopolymer_correction :
+            fq = Pagan().get_454_alignment(f.name)
+        else :
+            fq = Pagan().get_alignment(f.name)
+
+        rows = {}
+        fq.open()
+
+        for seq in fq :
+            rows[seq.id.lstrip('>').split()[0]] = seq.sequence
+
+        fq.close()
+
+        os.remove(f.name)
+        os.remove(fq.get_filename())
 
-    def create_clusters(self, keys=None, homopolymer_correction=True) :
+        tmp = []
+        query = rows.get('query')
+
+        for i in range(len(seqs)) :
+            centroid = rows.get("c%d" % i)
+
+            if (query is None) or (centroid is None) :
+                tmp.append([])
+                continue
+
+            columns = [ (c1,c2) for c1,c2 in zip(centroid, query) if (c1,c2) != ('-','-') ]
+            tmp.append([ ''.join([ c[0] for c in columns ]), ''.join([ c[1] for c in columns ]) ])
+
+        return tmp
+
+    def __batch_fill(self, clusters, seq, homopolymer_correction, known) :
+        # calculate similarities for a block of centroids at once
+        todo = []
+
+        for c in clusters :
+            if c[0] in known :
+                continue
+
+            cseq = self.sequence(c[0])
+
+            if self.cache is not None :
+                sim = self.cache.get(cseq, seq, homopolymer_correction, self.method())
+
+                if sim is not None :
+                    known[c[0]] = sim
+                    continue
+
+            todo.append((c[0], cseq))
+
+        if not todo :
+            return
+
+        sims = self.batch_similarity([ cseq for ckey,cseq in todo ], seq, homopolymer_correction)
+
+        for (ckey,cseq),sim in zip(todo, sims) :
+            known[ckey] = sim
+
+            if self.cache is not None :
+                self.cache.put(cseq, seq, homopolymer_correction, self.method(), sim)
+
+    def candidates(self, seq) :
+        if self.kmer_index is None :
+            return self.clusters
+
+        return self.kmer_index.candidates(seq, self.clusters)
+
+    def prepare(self, keys, homopolymer_correction) :
+        """returns keys in the order they will be clustered"""
         seqcount = collections.Counter()
 
         if keys == None :
             keys = self.db
 
-        for key in keys :
-            seqcount[key] = self.db.get(key).duplicates
+        if self.dereplicate :
+            self.members = self.homopolymer_dereplicate(keys)
 
-        p = Progress("Clustering", len(seqcount))
-        p.start()
+            for rep,members in self.members.iteritems() :
+                seqcount[rep] = sum([ self.db.num_duplicates(key) for key in members ])
 
-        for key,freq in seqcount.most_common() :
-            clustered = False
+            self.log.info("dereplication reduced %d sequences to %d" % (sum(map(len, self.members.values())), len(self.members)))
+        else :
+            for key in keys :
+                seqcount[key] = self.db.num_duplicates(key)
 
-            seq = self.db.get(key)
+        if self.kmer :
+            self.kmer_index = KmerIndex(self.kmer, self.similarity_threshold, homopolymer_correction)
 
             for c in self.clusters :
-                if self.alignment_similarity(self.db.get(c[0]), seq, homopolymer_correction) >= self.similarity_threshold :
-                    c.append(key)
-                    clustered = True
-                    break
+                self.kmer_index.add(c[0], self.sequence(c[0]))
+
+        return [ key for key,freq in seqcount.most_common() ]
+
+    def homopolymer_dereplicate(self, keys) :
+        """groups keys whose homopolymer compressed sequences are identical or
+        a prefix of one another, returns the most abundant key in each group
+        mapped to all keys in the group (most abundant first)"""
+        compressed = sorted([ (homopolymer_compress(self.db.get(key).sequence), key) for key in keys ], reverse=True)
+
+        # in reverse sorted order every sequence that is a prefix of
+        # another comes after it
+        groups = []
+        longest = None
+
+        for s,key in compressed :
+            if (longest is not None) and longest.startswith(s) :
+                groups[-1].append(key)
+            else :
+                groups.append([key])
+                longest = s
+
+        tmp = {}
+
+        for group in groups :
+            group.sort(key=self.db.num_duplicates, reverse=True)
+            tmp[group[0]] = group
+
+        return tmp
+
+    def expand(self) :
+        # replace representatives with the keys they stand for
+        tmp = []
+
+        for c in self.clusters :
+            expanded = []
+
+            for key in c :
+                expanded += self.members.get(key, [key])
+
+            tmp.append(expanded)
+
+        self.clusters = tmp
+        self.members = {}
+
+    def restore(self, clusters) :
+        # clusters from a checkpoint
+        self.clusters = clusters
+
+        if self.kmer_index is not None :
+            for c in self.clusters :
+                if c[0] not in self.kmer_index :
+                    self.kmer_index.add(c[0], self.sequence(c[0]))
+
+    def finish(self) :
+        if self.members :
+            self.expand()
 
-            if not clustered :
-                self.clusters.append([key])
+        if self.cache is not None :
+            self.cache.flush()
 
-            self.clusters.sort(key=len, reverse=True)
-            p.increment()
+        if self.kmer_index is not None :
+            self.log.info("k-mer index skipped %d centroid comparisons (%d queries)" % \
+                    (self.kmer_index.pruned, self.kmer_index.queries))
+
+    def create_clusters(self, keys=None, homopolymer_correction=True, checkpoint=None, resume=False) :
+        order = self.prepare(keys, homopolymer_correction)
+
+        start = 0
+        if resume and (checkpoint is not None) :
+            start = checkpoint.restore([self], order)
+
+        p = Progress("Clustering", len(order))
+        p.current = start
+        p.start()
+
+        if self.threads > 1 :
+            create_clusters_parallel([self], order, homopolymer_correction, self.threads, p, start, checkpoint)
+        else :
+            for index in range(start, len(order)) :
+                self.assign(order[index], homopolymer_correction)
+                p.increment()
+
+                if (checkpoint is not None) and checkpoint.due(index + 1) :
+                    checkpoint.save([self], order, index + 1)
 
         p.end()
 
+        self.finish()
+
         #self.log.info("number of clusters = %d" % len(self.clusters))
 
-    def create_clusters2(self, keys, homopolymer_correction=True, singletons=[], sample_threshold=1) :
-        self.create_clusters(keys=keys.keys(), homopolymer_correction=homopolymer_correction)
+    def assign(self, key, homopolymer_correction, known=None) :
+        """add key to the first cluster whose centroid is similar enough, or
+        start a new cluster, known maps centroid keys to similarities that
+        have already been calculated for this key (and is updated with any
+        that get calculated here)"""
+        if known is None :
+            known = {}
+
+        seq = self.db.get(key)
+        clustered = False
+        candidates = self.candidates(seq)
+
+        for index,c in enumerate(candidates) :
+            sim = known.get(c[0])
+
+            if sim is None :
+                if self.aligner == 'pagan-batch' :
+                    self.__batch_fill(candidates[index : index + self.pagan_batch_size], seq, homopolymer_correction, known)
+                    sim = known[c[0]]
+                else :
+                    sim = known[c[0]] = self.similarity(self.sequence(c[0]), seq, homopolymer_correction)
+
+            if sim >= self.similarity_threshold :
+                c.append(key)
+                clustered = True
+                break
+
+        if not clustered :
+            self.clusters.append([key])
+
+            if self.kmer_index is not None :
+                self.kmer_index.add(key, seq)
+
+        self.clusters.sort(key=self.size, reverse=True)
+
+        return clustered
+
+    def speculate(self, pool, queries, homopolymer_correction, known) :
+        """compare a batch of queries against the current centroids in parallel,
+        each query only goes as far as the first block containing a centroid
+        that passes the threshold, known maps each query key to a dictionary of
+        centroid key to similarity that is filled in"""
+        pending = []
+
+        for key in queries :
+            seq = self.db.get(key)
+            pending.append((key, seq, [ c[0] for c in self.candidates(seq) ]))
+
+        # with batched pagan each task is a whole block of centroids
+        batched = self.aligner == 'pagan-batch'
+        block = self.pagan_batch_size if batched else self.threads
+
+        while pending :
+            tasks = []
+            owners = []
+
+            for key,seq,centroids in pending :
+                todo = []
+
+                for ckey in centroids[:block] :
+                    if ckey in known[key] :
+                        continue
 
+                    cseq = self.sequence(ckey)
+
+                    if self.cache is not None :
+                        sim = self.cache.get(cseq, seq, homopolymer_correction, self.method())
+
+                        if sim is not None :
+                            known[key][ckey] = sim
+                            continue
+
+                    todo.append((ckey, cseq))
+
+                if not todo :
+                    continue
+
+                if batched :
+                    tasks.append((self.aligner, self.similarity_threshold, [ cseq for ckey,cseq in todo ], seq, homopolymer_correction))
+                    owners.append([ (key, ckey) for ckey,cseq in todo ])
+                else :
+                    for ckey,cseq in todo :
+                        tasks.append((self.aligner, self.similarity_threshold, cseq, seq, homopolymer_correction))
+                        owners.append([ (key, ckey) ])
+
+            if tasks :
+                worker = _batch_similarity_worker if batched else _similarity_worker
+                results = pool.map(worker, tasks, chunksize=max(1, len(tasks) / (4 * self.threads)))
+
+                if not batched :
+                    results = [ [r] for r in results ]
+
+                for pairs,sims in zip(owners, results) :
+                    for (key,ckey),sim in zip(pairs, sims) :
+                        known[key][ckey] = sim
+
+                        if self.cache is not None :
+                            self.cache.put(self.sequence(ckey), self.db.get(key), homopolymer_correction, self.method(), sim)
+
+            tmp = []
+            for key,seq,centroids in pending :
+                done = False
+
+                for ckey in centroids[:block] :
+                    if known[key][ckey] >= self.similarity_threshold :
+                        done = True
+                        break
+
+                if not done and (len(centroids) > block) :
+                    tmp.append((key, seq, centroids[block:]))
+
+            pending = tmp
+
+    def remove_rare(self, keys, singletons=[], sample_threshold=1) :
         new_clusters = []
 
         for c in self.clusters :
             tmp = set()
             add_cluster = False
 
+            # clusters from a previous run are always kept
+            if c[0] in self.reference :
+                new_clusters.append(c)
+                continue
+
             for k in c :
                 # short circuit in case we have any control samples
                 if k in singletons :
@@ -240,3 +587,90 @@ class Cluster(object) :
 
         self.clusters = new_clusters
 
+    def create_clusters2(self, keys, homopolymer_correction=True, singletons=[], sample_threshold=1, checkpoint=None, resume=False) :
+        self.create_clusters(keys=keys.keys(), homopolymer_correction=homopolymer_correction, checkpoint=checkpoint, resume=resume)
+        self.remove_rare(keys, singletons, sample_threshold)
+
+class MultiCluster(object) :
+    """clusters the same input at several similarity thresholds in a single
+    sweep, each similarity is calculated once and reused by every threshold"""
+
+    def __init__(self, db, similarity_thresholds, verbose, threads=1, **kwargs) :
+        self.levels = [ Cluster(db, t, verbose, threads=threads, **kwargs) for t in similarity_thresholds ]
+        self.threads = threads
+        self.log = logging.getLogger('seance')
+
+    def __iter__(self) :
+        return iter(self.levels)
+
+    def __len__(self) :
+        return len(self.levels)
+
+    def create_clusters(self, keys=None, homopolymer_correction=True, checkpoint=None, resume=False) :
+        order = None
+        for level in self.levels :
+            order = level.prepare(keys, homopolymer_correction)
+
+        start = 0
+        if resume and (checkpoint is not None) :
+            start = checkpoint.restore(self.levels, order)
+
+        p = Progress("Clustering (%s)" % ', '.join([ str(l.similarity_threshold) for l in self.levels ]), len(order))
+        p.current = start
+        p.start()
+
+        if self.threads > 1 :
+            create_clusters_parallel(self.levels, order, homopolymer_correction, self.threads, p, start, checkpoint)
+        else :
+            for index in range(start, len(order)) :
+                known = collections.defaultdict(dict)
+
+                for level in self.levels :
+                    level.assign(order[index], homopolymer_correction, known[level.method()])
+
+                p.increment()
+
+                if (checkpoint is not None) and checkpoint.due(index + 1) :
+                    checkpoint.save(self.levels, order, index + 1)
+
+        p.end()
+
+        for level in self.levels :
+            level.finish()
+
+    def create_clusters2(self, keys, homopolymer_correction=True, singletons=[], sample_threshold=1, checkpoint=None, resume=False) :
+        self.create_clusters(keys=keys.keys(), homopolymer_correction=homopolymer_correction, checkpoint=checkpoint, resume=resume)
+
+        for level in self.levels :
+            level.remove_rare(keys, singletons, sample_threshold)
+
+def create_clusters_parallel(levels, order, homopolymer_correction, threads, progress, first=0, checkpoint=None) :
+    # queries are speculatively compared in batches, but committed one
+    # at a time in the original order, anything the speculative phase did
+    # not calculate (e.g. centroids created earlier in the same batch) is
+    # calculated on demand so the result is identical to the serial case
+    # (checkpoints are only taken between batches)
+    pool = multiprocessing.Pool(threads)
+
+    try :
+        for start in range(first, len(order), threads) :
+            queries = order[start : start + threads]
+            known = dict([ (key, collections.defaultdict(dict)) for key in queries ])
+
+            for level in levels :
+                level.speculate(pool, queries, homopolymer_correction, 
+                                dict([ (key, known[key][level.method()]) for key in queries ]))
+
+            for key in queries :
+                for level in levels :
+                    level.assign(key, homopolymer_correction, known[key][level.method()])
+
+                progress.increment()
+
+            position = min(start + threads, len(order))
+            if (checkpoint is not None) and checkpoint.due(position) :
+                checkpoint.save(levels, order, position)
+
+    finally :
+        pool.close()
+        pool.join()
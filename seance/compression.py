@@ -0,0 +1,253 @@
+import os
+import gzip
+import bz2
+import shutil
+import threading
+import subprocess
+import Queue
+
+from distutils.spawn import find_executable
+
+
+class CompressionError(Exception) :
+    pass
+
+# files are recognised by their first bytes rather than their names
+formats = ('gzip', 'bz2', 'xz')
+
+magic = {
+        'gzip' : '\x1f\x8b',
+        'bz2'  : 'BZh',
+        'xz'   : '\xfd7zXZ\x00'
+    }
+
+# added to the names of files that are written compressed
+suffixes = {
+        'gzip' : '.gz',
+        'bz2'  : '.bz2',
+        'xz'   : '.xz'
+    }
+
+# (de)compression runs in another process so it overlaps with parsing,
+# parallel versions are used if they are installed
+programs = {
+        'gzip' : ('pigz', 'gzip'),
+        'bz2'  : ('pbzip2', 'lbzip2', 'bzip2'),
+        'xz'   : ('xz',)
+    }
+
+# used in a background thread if none of the programs are installed
+modules = {
+        'gzip' : lambda fname,mode : gzip.GzipFile(fname, mode),
+        'bz2'  : lambda fname,mode : bz2.BZ2File(fname, mode)
+    }
+
+def detect(fname) :
+    """the compression format of fname, None if it is not compressed"""
+    with open(fname, 'rb') as f :
+        start = f.read(max(map(len, magic.values())))
+
+    for fmt in formats :
+        if start.startswith(magic[fmt]) :
+            return fmt
+
+    return None
+
+def compressed_name(fname, compression) :
+    """fname with the suffix for compression, if it does not already have it"""
+    if (compression is None) or fname.endswith(suffixes[compression]) :
+        return fname
+
+    return fname + suffixes[compression]
+
+def uncompressed_name(fname) :
+    """fname without a compression suffix"""
+    for suffix in suffixes.values() :
+        if fname.endswith(suffix) :
+            return fname[:-len(suffix)]
+
+    return fname
+
+def find_file(fname) :
+    """fname if it exists, otherwise fname with a compression suffix if that
+    exists (fname if neither do)"""
+    if not os.path.exists(fname) :
+        for fmt in formats :
+            if os.path.exists(fname + suffixes[fmt]) :
+                return fname + suffixes[fmt]
+
+    return fname
+
+def program(fmt) :
+    for p in programs[fmt] :
+        path = find_executable(p)
+
+        if path :
+            return path
+
+    return None
+
+def open_file(fname, mode='r', compression=None) :
+    """opens fname for reading, decompressing it if necessary, or for
+    writing, compressed with compression (one of formats) if it is given"""
+    if mode.startswith('r') :
+        compression = detect(fname)
+
+    elif (compression is not None) and (compression not in formats) :
+        raise CompressionError("'%s' is not a compression format (options = %s)" % (compression, ', '.join(formats)))
+
+    if compression is None :
+        return open(fname, mode)
+
+    path = program(compression)
+
+    if path :
+        return ProcessFile(path, fname, mode)
+
+    if compression not in modules :
+        raise CompressionError("cannot open %s, none of %s are installed" % (fname, ', '.join(programs[compression])))
+
+    if mode.startswith('r') :
+        return ThreadFile(modules[compression](fname, 'rb'))
+
+    return modules[compression](fname, 'wb')
+
+def decompress(fname, dest) :
+    """writes fname to dest uncompressed"""
+    src = open_file(fname)
+    f = open(dest, 'wb')
+
+    shutil.copyfileobj(src, f, 1 << 20)
+
+    f.close()
+    src.close()
+
+class ProcessFile(object) :
+    """a file (de)compressed by another program, reads come from its output
+    and writes go to its input"""
+
+    def __init__(self, path, fname, mode='r') :
+        self.name = fname
+        self.reading = mode.startswith('r')
+        self.softspace = 0
+
+        if self.reading :
+            self.proc = subprocess.Popen([path, '-d', '-c', fname], stdout=subprocess.PIPE, bufsize=-1)
+            self.f = self.proc.stdout
+        else :
+            self.out = open(fname, 'wb')
+            self.proc = subprocess.Popen([path, '-c'], stdin=subprocess.PIPE, stdout=self.out, bufsize=-1)
+            self.f = self.proc.stdin
+
+    def read(self, size=-1) :
+        tmp = self.f.read(size)
+
+        # a program that failed part way through only looks like the end of the file
+        if (tmp == "") and (self.proc.wait() != 0) :
+            raise CompressionError("could not decompress %s (exit status %d)" % (self.name, self.proc.returncode))
+
+        return tmp
+
+    def write(self, s) :
+        self.f.write(s)
+
+    def close(self) :
+        if self.f.closed :
+            return
+
+        if self.reading and (self.proc.poll() is None) :
+            # closed before the end
+            self.proc.terminate()
+
+        self.f.close()
+        self.proc.wait()
+
+        if not self.reading :
+            self.out.close()
+
+            if self.proc.returncode != 0 :
+                raise CompressionError("could not compress %s (exit status %d)" % (self.name, self.proc.returncode))
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+class ThreadFile(object) :
+    """reads from f in a background thread, so that (for gzip and bz2 files
+    at least) decompression overlaps with parsing"""
+
+    chunk_size = 1 << 20
+
+    def __init__(self, f) :
+        self.name = f.name
+        self.queue = Queue.Queue(maxsize=16)
+        self.buffer = ""
+        self.finished = False
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.__run, args=(f,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self, f) :
+        try :
+            while not self.stopped :
+                tmp = f.read(self.chunk_size)
+                self.queue.put(tmp)
+
+                if tmp == "" :
+                    break
+
+        except Exception, e :
+            self.queue.put(e)
+
+        finally :
+            f.close()
+
+    def __get(self) :
+        tmp = self.queue.get()
+
+        if isinstance(tmp, Exception) :
+            raise CompressionError("could not decompress %s (%s)" % (self.name, str(tmp)))
+
+        if tmp == "" :
+            self.finished = True
+
+        return tmp
+
+    def read(self, size=-1) :
+        tmp = [ self.buffer ]
+        length = len(self.buffer)
+
+        while (not self.finished) and ((size < 0) or (length < size)) :
+            s = self.__get()
+            tmp.append(s)
+            length += len(s)
+
+        tmp = ''.join(tmp)
+
+        if size < 0 :
+            self.buffer = ""
+            return tmp
+
+        self.buffer = tmp[size:]
+        return tmp[:size]
+
+    def close(self) :
+        # the thread might be waiting to add to a full queue
+        self.stopped = True
+
+        while self.thread.is_alive() :
+            try :
+                self.queue.get(timeout=0.1)
+
+            except Queue.Empty :
+                pass
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
@@ -1,6 +1,7 @@
 import math
 import datetime
 
+from array import array
 from functools import total_ordering
 
 class SequenceError(Exception) :
@@ -50,31 +51,109 @@ class IUPAC(object) :
 
     @staticmethod
     def close_enough(primer, sequence, diff) :
+        """True if primer matches the start of sequence with at most diff
+        edits (or the start of primer matches all of sequence)"""
+        return IUPAC.match_end(primer, sequence, diff, first=True) != -1
+
+    @staticmethod
+    def match_end(primer, sequence, diff, first=False) :
+        """returns how many bases at the start of sequence primer matches with 
+        at most diff edits, -1 if there is no such match. if there are several
+        the one with the fewest edits is used (then the one closest to the 
+        length of primer), with first=True the first one found is returned
+
+        banded edit distance, only cells within diff of the diagonal can
+        be <= diff and the minimum of each row never decreases, so this is
+        O(len(primer) * diff)"""
         if diff < 0 :
-            return False
+            return -1
+
+        n = len(primer)
+        m = len(sequence)
+
+        if (n == 0) or (m == 0) :
+            return 0
+
+        masks = IUPAC.masks
+        inf = diff + 1
+        width = (2 * diff) + 1
+        best = None
+
+        # row i, column j is stored at index j - i + diff
+        prev = [inf] * width
+        for j in range(0, min(m, diff) + 1) :
+            prev[j + diff] = j
+
+        if m <= diff :
+            if first :
+                return m
+            best = (m, abs(m - n), m)
+
+        pmasks = [ masks.get(c, 0) for c in primer ]
+
+        for i in range(1, n + 1) :
+            cur = [inf] * width
+            pm = pmasks[i-1]
+            rowmin = inf
+
+            for j in range(max(0, i - diff), min(m, i + diff) + 1) :
+                k = j - i + diff
+
+                if j == 0 :
+                    d = i
+                else :
+                    d = prev[k] + (0 if (pm & masks.get(sequence[j-1], 0)) else 1)
+
+                    if k + 1 < width :
+                        d = min(d, prev[k+1] + 1)
 
-        if (len(primer) == 0) or (len(sequence) == 0) :
-            return True
+                    if k > 0 :
+                        d = min(d, cur[k-1] + 1)
 
-        m = IUPAC.equal(sequence[0], primer[0])
+                if d > inf :
+                    d = inf
 
-        return IUPAC.close_enough(primer[1:], sequence[1:], diff if m else diff-1) or \
-               IUPAC.close_enough(primer[1:], sequence,     diff-1) or \
-               IUPAC.close_enough(primer,     sequence[1:], diff-1)
+                cur[k] = d
+                rowmin = min(rowmin, d)
+
+                if (d <= diff) and ((i == n) or (j == m)) :
+                    if first :
+                        return j
+
+                    tmp = (d, abs(j - n), j)
+                    if (best is None) or (tmp < best) :
+                        best = tmp
+
+            if rowmin > diff :
+                break
+
+            prev = cur
+
+        if best is None :
+            return -1
+
+        return best[2]
+
+    # compiled primer searches, keyed by (primer, diff)
+    searchers = {}
+
+    @staticmethod
+    def searcher(primer, diff) :
+        key = (primer, diff)
+
+        if key not in IUPAC.searchers :
+            from seance.primers import PrimerSearch
+            IUPAC.searchers[key] = PrimerSearch(primer, diff)
+
+        return IUPAC.searchers[key]
 
     @staticmethod
     def seq_position(primer, sequence, diff) :
-        for i in range(len(sequence) - len(primer)) :
-            if IUPAC.close_enough(primer, sequence[i:], diff) :
-                return i
-        return -1
+        return IUPAC.searcher(primer, diff).first(sequence)
     
     @staticmethod
     def seq_position_reverse(primer, sequence, diff) :
-        for i in range(len(sequence) - len(primer))[::-1] :
-            if IUPAC.close_enough(primer, sequence[i:], diff) :
-                return i
-        return -1
+        return IUPAC.searcher(primer, diff).last(sequence)
 
 #    @staticmethod
 #    def equal(base, iupac) :
@@ -108,51 +187,102 @@ class IUPAC(object) :
         except KeyError, ke :
             raise SequenceError("No IUPAC code for \"%s\"" % ''.join(sorted(bases)))
 
+# bases each code stands for as a bitmask, codes are equal if they share a bit
+IUPAC.masks = dict([ (code, sum([ 1 << 'ACGTU'.index(b) for b in bases ])) for code,bases in IUPAC.reverse_mapping.items() ])
+
+# phred+33 character --> quality (as a character)
+_QUAL_DECODE = ''.join([ chr(max(i - 33, 0)) for i in range(256) ])
+
+# characters that are valid phred+33 qualities (see Sequence.quality_to_int)
+_QUAL_VALID = ''.join([ chr(i) for i in range(33, 33 + 127) ])
+
 @total_ordering
 class Sequence(object) :
-    def __init__(self, seq, qual_str=None) :
+    # there are millions of these, so there is no __dict__ and qualities
+    # are kept as the original string plus the offsets of the part still
+    # in use, they are only decoded when asked for
+    __slots__ = ('sequence', 'duplicates', 'id', '_qual', '_qstart', '_qend')
+
+    def __init__(self, seq, qual_str=None, check=True) :
+        # (the same as setting qual_str, but this is called for every read)
         self.sequence = seq
-        self.qual_str = qual_str
+        self._qual = qual_str
+        self._qstart = 0
+        self._qend = 0
 
-        if self.qual_str :
-            if len(self.sequence) != len(self.qual_str) :
+        if qual_str :
+            self._qend = len(qual_str)
+
+            if len(seq) != self._qend :
                 raise SequenceError("lengths of sequence and qualities are not equal (s=%d q=%d)" % 
-                    (len(self.sequence), len(self.qual_str)))
+                    (len(seq), self._qend))
+
+            # FastqFile checks qualities a block at a time
+            if check :
+                for q in qual_str.translate(None, _QUAL_VALID)[:1] :
+                    Sequence.quality_to_int(q)
 
-        self.qualities = self.__generate_quals(qual_str)
         self.duplicates = 1
         self.id = None
 
-    def __generate_quals(self, qual_str) :
-        if qual_str is None :
+    @property
+    def qual_str(self) :
+        if self._qual is None :
+            return None
+
+        if (self._qstart == 0) and (self._qend == len(self._qual)) :
+            return self._qual
+
+        return self._qual[self._qstart : self._qend]
+
+    @qual_str.setter
+    def qual_str(self, qual_str) :
+        self._qual = qual_str
+        self._qstart = 0
+        self._qend = 0 if qual_str is None else len(qual_str)
+
+    @property
+    def qualities(self) :
+        if not self._qual :
             return []
 
-        return map(Sequence.quality_to_int, qual_str)
+        return array('B', self.qual_str.translate(_QUAL_DECODE))
+
+    @qualities.setter
+    def qualities(self, qualities) :
+        self.qual_str = ''.join(map(Sequence.int_to_quality, qualities))
+
+    def __slice_qualities(self, start, stop) :
+        # same as qual_str[start:stop], but only moves the offsets
+        if self._qual is None :
+            return
+
+        start,stop,step = slice(start, stop).indices(self._qend - self._qstart)
+
+        self._qend = self._qstart + max(start, stop)
+        self._qstart += start
+
+    def __getstate__(self) :
+        return (self.sequence, self.qual_str, self.duplicates, self.id)
+
+    def __setstate__(self, state) :
+        self.sequence, self.qual_str, self.duplicates, self.id = state
 
     def truncate(self, length) :
         self.sequence = self.sequence[:length]
-
-        if self.qual_str :
-            self.qual_str = self.qual_str[:length]
-            self.qualities = self.qualities[:length]
+        self.__slice_qualities(None, length)
 
     def rtrim(self, char='-') :
         self.truncate(len(self.sequence.rstrip(char)))
 
     def ltrim(self, char='-') :
+        tmp = len(self.sequence)
         self.sequence = self.sequence.lstrip(char)
-
-        if self.qual_str :
-            tmp = len(self.qual_str) - len(self.sequence)
-            self.qual_str = self.qual_str[tmp:]
-            self.qualities = self.qualities[tmp:]
+        self.__slice_qualities(tmp - len(self.sequence), None)
 
     def remove_mid(self, mid_length) :
         self.sequence = self.sequence[mid_length:]
-
-        if self.qual_str :
-            self.qual_str = self.qual_str[mid_length:]
-            self.qualities = self.qualities[mid_length:]
+        self.__slice_qualities(mid_length, None)
 
     def ungap(self) :
         self.sequence = self.sequence.replace('-','')
@@ -173,6 +303,11 @@ class Sequence(object) :
         
         return qu
 
+    @staticmethod
+    def invalid_qualities(qual_str) :
+        # characters in qual_str that quality_to_int would reject
+        return qual_str.translate(None, _QUAL_VALID)
+
     @staticmethod
     def int_to_quality(i) :
         return chr(i + 33)
@@ -185,8 +320,11 @@ class Sequence(object) :
             self.sequence = seq2.sequence
 
         if self.qual_str :
-            self.qualities = map(lambda y : max(y), map(lambda *x : tuple(x), self.qualities, seq2.qualities))
-            self.qual_str = ''.join(map(Sequence.int_to_quality, self.qualities))
+            # best quality at each position, the longer one's tail is kept
+            q1 = self.qual_str
+            q2 = seq2.qual_str or ''
+            n = min(len(q1), len(q2))
+            self.qual_str = ''.join(map(max, q1[:n], q2[:n])) + q1[n:] + q2[n:]
         
         self.duplicates += seq2.duplicates
 
@@ -1,9 +1,20 @@
+import hashlib
+import itertools
+import sqlite3
+import collections
+
+from array import array
+
 from seance.datatypes import Sequence, SequenceError, IUPAC
 
 class SequenceDB(object) :
-    def __init__(self, preprocessed=False) :
-        if preprocessed :
+    def __init__(self, preprocessed=False, packed=False, fname=None) :
+        if fname is not None :
+            self._db = SqliteDict(fname)
+        elif preprocessed :
             self._db = WrapperDict()
+        elif packed :
+            self._db = PackedDict()
         else :
             self._db = SequenceDict()
 
@@ -13,6 +24,9 @@ class SequenceDB(object) :
     def get(self, key) :
         return self._db.get(key)
 
+    def num_duplicates(self, key) :
+        return self._db.num_duplicates(key)
+
     def num_reads(self) :
         return self._db.num_reads()
 
@@ -22,6 +36,20 @@ class SequenceDB(object) :
     def print_database(self, fname) :
         self._db.print_database(fname)
 
+    def add_sample(self, name, mtime, seqs) :
+        self._db.add_sample(name, mtime, seqs)
+
+    def get_sample(self, name, mtime) :
+        return self._db.get_sample(name, mtime)
+
+    def close(self) :
+        self._db.close()
+
+    def dereplicate(self) :
+        """merges sequences that are a prefix of another (see Sequence.is_duplicate)
+        into the longest one, returns a dictionary of merged key --> key"""
+        return self._db.dereplicate()
+
     def __contains__(self, obj) :
         return obj in self._db
 
@@ -60,9 +88,40 @@ class SequenceDict(object) :
     def get(self, key) :
         return self.db[key]
 
+    def num_duplicates(self, key) :
+        return self.db[key].duplicates
+
+    def close(self) :
+        pass
+
     def finalise(self, length) :
         pass
 
+    def dereplicate(self) :
+        # in reverse sorted order a sequence comes straight after 
+        # the sequences it is a prefix of
+        keys = sorted(self.db, key=lambda x : self.db[x].sequence, reverse=True)
+        merged = {}
+        rep = None
+
+        for key in keys :
+            seq = self.db[key]
+
+            if (rep is not None) and self.db[rep].sequence.startswith(seq.sequence) :
+                self.db[rep].merge(seq)
+                merged[key] = rep
+            else :
+                rep = key
+
+        for key,rep in merged.iteritems() :
+            del self.db[key]
+
+        for tkey,key in self.translate.iteritems() :
+            if key in merged :
+                self.translate[tkey] = merged[key]
+
+        return merged
+
     def print_database(self, fname) :
         f = open(fname, 'w')
 
@@ -91,6 +150,377 @@ class SequenceDict(object) :
         return "%s: added = %d, unique = %d" % \
                 (type(self).__name__, self.count, len(self))
 
+class PackedDict(object) :
+    """same as SequenceDict, but sequences are packed into one buffer 2 bits 
+    per base (4 bits if they contain IUPAC codes, 8 bits for anything else)
+    and found by their md5 digest, get() unpacks a new Sequence each time
+
+    qualities are not kept"""
+
+    bits = {
+        2 : 'ACGT',
+        4 : IUPAC.codes
+    }
+
+    def __init__(self) :
+        self.buffer = bytearray()
+        self.offsets = array('L')
+        self.lengths = array('L')
+        self.encodings = array('B')
+        self.duplicates = array('L')
+        self.translate = {} # digest --> key
+        self.merged = {} # key --> key it was merged into
+        self.count = 0
+
+        # per encoding : (chunk of bases --> byte, byte --> chunk of bases)
+        self.tables = {}
+
+        for b,alphabet in PackedDict.bits.items() :
+            per_byte = 8 / b
+            pack = {}
+            unpack = []
+
+            for chunk in itertools.product(range(len(alphabet)), repeat=per_byte) :
+                value = 0
+                for i in chunk :
+                    value = (value << b) | i
+
+                pack[''.join([ alphabet[i] for i in chunk ])] = chr(value)
+
+            for value in range(256) :
+                tmp = ''
+                for i in range(per_byte) :
+                    tmp = alphabet[(value >> (b * i)) & ((1 << b) - 1)] + tmp
+
+                unpack.append(tmp)
+
+            self.tables[b] = (pack, unpack)
+
+    def digest(self, s) :
+        return hashlib.md5(s).digest()
+
+    def encoding(self, s) :
+        # smallest encoding that can hold s
+        if s.strip('ACGT') == '' :
+            return 2
+
+        if s.strip(IUPAC.codes) == '' :
+            return 4
+
+        return 8
+
+    def pack(self, s, b) :
+        if b == 8 :
+            return s
+
+        pack = self.tables[b][0]
+        per_byte = 8 / b
+
+        # pad the last byte with the first letter of the alphabet
+        padded = s + (PackedDict.bits[b][0] * (-len(s) % per_byte))
+
+        return ''.join([ pack[padded[i:i+per_byte]] for i in range(0, len(padded), per_byte) ])
+
+    def unpack(self, key) :
+        b = self.encodings[key]
+        offset = self.offsets[key]
+        length = self.lengths[key]
+
+        if b == 8 :
+            return str(self.buffer[offset : offset + length])
+
+        unpack = self.tables[b][1]
+        nbytes = -(-length * b // 8)
+
+        return ''.join([ unpack[i] for i in self.buffer[offset : offset + nbytes] ])[:length]
+
+    def put(self, seq) :
+        tkey = self.digest(seq.sequence)
+
+        if tkey in self.translate :
+            key = self.translate[tkey]
+            self.duplicates[key] += seq.duplicates
+        else :
+            key = len(self.offsets)
+            b = self.encoding(seq.sequence)
+
+            self.translate[tkey] = key
+            self.offsets.append(len(self.buffer))
+            self.lengths.append(len(seq.sequence))
+            self.encodings.append(b)
+            self.duplicates.append(seq.duplicates)
+
+            self.buffer.extend(self.pack(seq.sequence, b))
+
+            seq.id = str(key) # overwrite the original name
+
+        self.count += 1
+
+        return key
+
+    def dereplicate(self) :
+        keys = sorted([ key for key in range(len(self.offsets)) if key not in self.merged ], key=self.unpack, reverse=True)
+        merged = {}
+        rep = None
+        rep_seq = None
+
+        for key in keys :
+            s = self.unpack(key)
+
+            if (rep is not None) and rep_seq.startswith(s) :
+                self.duplicates[rep] += self.duplicates[key]
+                self.duplicates[key] = 0
+                merged[key] = rep
+            else :
+                rep = key
+                rep_seq = s
+
+        self.merged.update(merged)
+
+        for tkey,key in self.translate.iteritems() :
+            if key in self.merged :
+                self.translate[tkey] = self.merged[key]
+
+        return merged
+
+    def get(self, key) :
+        key = self.merged.get(key, key)
+        seq = Sequence(self.unpack(key))
+        seq.id = str(key)
+        seq.duplicates = self.duplicates[key]
+
+        return seq
+
+    def num_duplicates(self, key) :
+        return self.duplicates[self.merged.get(key, key)]
+
+    def close(self) :
+        pass
+
+    def finalise(self, length) :
+        pass
+
+    def print_database(self, fname) :
+        f = open(fname, 'w')
+
+        for key in sorted([ key for key in range(len(self.offsets)) if key not in self.merged ], reverse=True, key=lambda x : self.lengths[x]) :
+            print >> f, ">seq%d NumDuplicates=%d" % (key, self.duplicates[key])
+            print >> f, self.unpack(key)
+
+        f.close()
+
+    def has_sequence(self, cseq) :
+        return self.digest(cseq) in self.translate
+
+    def __contains__(self, cseq) :
+        return self.has_sequence(cseq)
+
+    def num_reads(self) :
+        return sum(self.duplicates)
+
+    def num_sequences(self) :
+        return len(self)
+
+    def __len__(self) :
+        return len(self.offsets) - len(self.merged)
+
+    def __str__(self) :
+        return "%s: added = %d, unique = %d, packed = %d bytes" % \
+                (type(self).__name__, self.count, len(self), len(self.buffer))
+
+class SqliteDict(object) :
+    """per-sample sequences and counts kept on disk in an sqlite database
+
+    written by preprocess one sample at a time, so later commands can get
+    the samples without reading every .sample file. reading a sample only
+    loads its keys and counts, keys are given out in the same order as
+    parsing the .sample files would, so keys, duplicate counts and everything
+    derived from them (e.g. OTU names) are the same. only the counts are kept
+    in memory (like PackedDict), get() reads the sequence from the database
+    and the most recently used ones are cached
+
+    (sequences are not packed here, the database holds them as text)"""
+
+    # stores written with a different layout are emptied
+    version = 2
+
+    # number of sequences get() keeps in memory
+    cache_size = 1 << 16
+
+    def __init__(self, fname) :
+        self.fname = fname
+
+        self.keys = array('l') # key --> key in the database
+        self.duplicates = array('L')
+        self.translate = {} # key in the database --> key
+        self.merged = {} # key --> key it was merged into
+        self.cache = collections.OrderedDict() # key --> sequence
+
+        self.conn = sqlite3.connect(fname, timeout=300)
+        self.conn.text_factory = str
+
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SqliteDict.version :
+            self.conn.executescript("""
+                DROP TABLE IF EXISTS sequences;
+                DROP TABLE IF EXISTS samples;
+                DROP TABLE IF EXISTS counts;
+                PRAGMA user_version = %d;
+                """ % SqliteDict.version)
+
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sequences (
+                key INTEGER PRIMARY KEY,
+                sequence TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS samples (
+                name TEXT PRIMARY KEY,
+                mtime REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS counts (
+                sample TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                key INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (sample, position));
+            """)
+        self.conn.commit()
+
+    def __key(self, dbkey, count) :
+        # keys are handed out in the order database keys are first seen
+        key = self.translate.get(dbkey)
+
+        if key is None :
+            key = len(self.keys)
+            self.translate[dbkey] = key
+            self.keys.append(dbkey)
+            self.duplicates.append(0)
+
+        self.duplicates[key] += count
+
+        return key
+
+    def put(self, seq) :
+        with self.conn :
+            self.conn.execute("INSERT OR IGNORE INTO sequences (sequence) VALUES (?)", (seq.sequence,))
+
+        dbkey = self.conn.execute("SELECT key FROM sequences WHERE sequence = ?", (seq.sequence,)).fetchone()[0]
+        key = self.__key(dbkey, seq.duplicates)
+        seq.id = str(key) # overwrite the original name
+
+        return key
+
+    def get(self, key) :
+        key = self.merged.get(key, key)
+        s = self.cache.pop(key, None)
+
+        if s is None :
+            s = self.conn.execute("SELECT sequence FROM sequences WHERE key = ?", (self.keys[key],)).fetchone()[0]
+
+            if len(self.cache) >= self.cache_size :
+                self.cache.popitem(last=False)
+
+        self.cache[key] = s
+
+        seq = Sequence(s)
+        seq.id = str(key)
+        seq.duplicates = self.duplicates[key]
+
+        return seq
+
+    def num_duplicates(self, key) :
+        return self.duplicates[self.merged.get(key, key)]
+
+    def add_sample(self, name, mtime, seqs) :
+        """replaces the sample called name with seqs, a list of (sequence, count)
+        in the order they are in the sample's file, mtime is the modification 
+        time of the file"""
+        with self.conn :
+            self.conn.execute("DELETE FROM counts WHERE sample = ?", (name,))
+            self.conn.executemany("INSERT OR IGNORE INTO sequences (sequence) VALUES (?)", 
+                                  [ (s,) for s,count in seqs ])
+            self.conn.executemany("INSERT INTO counts (sample, position, key, count) SELECT ?, ?, key, ? FROM sequences WHERE sequence = ?",
+                                  [ (name, position, count, s) for position,(s,count) in enumerate(seqs) ])
+            self.conn.execute("INSERT OR REPLACE INTO samples (name, mtime) VALUES (?, ?)", (name, mtime))
+
+    def get_sample(self, name, mtime) :
+        """loads the sample called name and returns key --> count, None if it 
+        is missing or its file has changed since it was added"""
+        row = self.conn.execute("SELECT mtime FROM samples WHERE name = ?", (name,)).fetchone()
+
+        if (row is None) or (row[0] != mtime) :
+            return None
+
+        seqcounts = collections.Counter()
+
+        for dbkey,count in self.conn.execute("SELECT key, count FROM counts WHERE sample = ? ORDER BY position", (name,)) :
+            seqcounts[self.__key(dbkey, count)] += count
+
+        return seqcounts
+
+    def close(self) :
+        self.conn.close()
+
+    def finalise(self, length) :
+        pass
+
+    def dereplicate(self) :
+        # sqlite compares text byte by byte, so this is the same
+        # order as sorting the sequences in python
+        merged = {}
+        rep = None
+        rep_seq = None
+
+        for dbkey,s in self.conn.execute("SELECT key, sequence FROM sequences ORDER BY sequence DESC") :
+            key = self.translate.get(dbkey)
+
+            if (key is None) or (key in self.merged) :
+                continue
+
+            if (rep is not None) and rep_seq.startswith(s) :
+                self.duplicates[rep] += self.duplicates[key]
+                self.duplicates[key] = 0
+                merged[key] = rep
+            else :
+                rep = key
+                rep_seq = s
+
+        self.merged.update(merged)
+
+        for dbkey,key in self.translate.iteritems() :
+            if key in self.merged :
+                self.translate[dbkey] = self.merged[key]
+
+        return merged
+
+    def print_database(self, fname) :
+        f = open(fname, 'w')
+
+        seqs = [ self.get(key) for key in range(len(self.keys)) if key not in self.merged ]
+
+        for seq in sorted(seqs, reverse=True, key=len) :
+            print >> f, ">seq%s NumDuplicates=%d" % (seq.id, seq.duplicates)
+            print >> f, seq.sequence
+
+        f.close()
+
+    def has_sequence(self, cseq) :
+        row = self.conn.execute("SELECT key FROM sequences WHERE sequence = ?", (cseq,)).fetchone()
+        return (row is not None) and (row[0] in self.translate)
+
+    def __contains__(self, cseq) :
+        return self.has_sequence(cseq)
+
+    def num_reads(self) :
+        return sum(self.duplicates)
+
+    def num_sequences(self) :
+        return len(self)
+
+    def __len__(self) :
+        return len(self.keys) - len(self.merged)
+
+    def __str__(self) :
+        return "%s: %s, unique = %d, cached = %d" % \
+                (type(self).__name__, self.fname, len(self), len(self.cache))
+
 class WrapperDict(dict) :
     def __init__(self) :
         super(WrapperDict, self).__init__()
@@ -106,6 +536,12 @@ class WrapperDict(dict) :
 
         return key
 
+    def num_duplicates(self, key) :
+        return self[key].duplicates
+
+    def close(self) :
+        pass
+
     def num_reads(self) :
         return sum([ i.duplicates for i in self.values() ])
 
@@ -0,0 +1,480 @@
+import logging
+import multiprocessing
+
+import numpy
+
+from os.path import basename
+
+from seance.progress import Progress
+
+
+class DenoiserError(Exception) :
+    pass
+
+# signals are binned in steps of 0.01 up to 9.99, flows past the end of a
+# flowgram are put in an extra bin that costs nothing against anything
+BINS = 1000
+BIN_SIZE = 0.01
+PAST_END = BINS
+
+# how many table lookups are done at once
+_BLOCK_ELEMENTS = 1 << 22
+
+def _logsumexp(a, axis) :
+    m = numpy.max(a, axis=axis, keepdims=True)
+    m[~numpy.isfinite(m)] = 0.0
+    return (m + numpy.log(numpy.sum(numpy.exp(a - m), axis=axis, keepdims=True))).squeeze(axis)
+
+def _mean_lookup(table, a, b, alen, blen) :
+    # table[a[i,k], b[j,k]] averaged over the flows of each pair of rows of
+    # a and b, (len(a) x len(b)), the extra row and column of the table are
+    # zeros so only flows that are in both rows count
+    out = numpy.empty((len(a), len(b)), dtype=numpy.float32)
+    step = max(1, _BLOCK_ELEMENTS / max(1, len(a) * a.shape[1]))
+
+    for j in range(0, len(b), step) :
+        k = min(len(b), j + step)
+        tmp = table[a[:, None, :], b[None, j:k, :]].sum(axis=2, dtype=numpy.float64)
+        out[:, j:k] = tmp / numpy.maximum(numpy.minimum(alen[:, None], blen[None, j:k]), 1)
+
+    return out
+
+# flowgrams and tables in worker processes
+_bins = None
+_lengths = None
+_model = None
+
+def _init_denoiser(bins, lengths, model) :
+    global _bins, _lengths, _model
+    _bins = bins
+    _lengths = lengths
+    _model = model
+
+def _distance_rows(args) :
+    # pairs of flowgrams at most cutoff apart (i, j, distance) where i is
+    # from start to end - 1 and j > i
+    start,end,cutoff = args
+    tmp = _mean_lookup(_model.distances, _bins[start:end], _bins[start:], _lengths[start:end], _lengths[start:])
+
+    i,j = numpy.nonzero((tmp.astype(numpy.float64) <= cutoff) & (numpy.arange(tmp.shape[1])[None, :] > numpy.arange(end - start)[:, None]))
+    return start, (i + start).astype(numpy.int32), (j + start).astype(numpy.int32), tmp[i, j]
+
+def _responsibilities(args) :
+    # tau for flowgrams start to end - 1, only values of at least min_tau
+    # are kept (renormalised), the most likely centroid is always kept
+    centroids,clens,logweights,sigma,min_tau,start,end = args
+    cost = _mean_lookup(_model.costs, centroids, _bins[start:end], clens, _lengths[start:end]).T.astype(numpy.float64)
+
+    logtau = logweights[None, :] - (sigma * cost)
+    tau = numpy.exp(logtau - _logsumexp(logtau, 1)[:, None])
+    assigned = tau.argmax(axis=1)
+
+    keep = tau >= min_tau
+    keep[numpy.arange(len(tau)), assigned] = True
+    tau[~keep] = 0.0
+    tau /= tau.sum(axis=1)[:, None]
+
+    i,j = numpy.nonzero(tau)
+    return start, assigned, i + start, j, tau[i, j]
+
+class FlowgramModel(object) :
+    """how likely each binned signal is for each homopolymer length, either
+    from an AmpliconNoise LookUp.dat (-log probabilities, BINS values for
+    each homopolymer length starting from 0) or, without one, gaussians
+    whose standard deviation grows with the homopolymer length
+
+    costs[s,b] is -log P(b|s) relative to the most likely homopolymer for b
+    and distances[b1,b2] is -log of the cosine between the likelihoods of b1
+    and b2 over homopolymer lengths, which is 0 for signals that point to the
+    same homopolymer. both have an extra row and column of zeros (PAST_END)"""
+
+    # default model
+    homopolymers = 10
+    sd_intercept = 0.1
+    sd_slope = 0.06
+
+    def __init__(self, fname=None) :
+        logp = self.__read(fname) if fname else self.__gaussian()
+        logp = numpy.maximum(logp, -1000.0)
+
+        homopolymers = len(logp)
+
+        self.costs = numpy.zeros((homopolymers + 1, BINS + 1), dtype=numpy.float32)
+        self.costs[:homopolymers, :BINS] = logp.max(axis=0) - logp
+
+        # each bin's likelihoods are scaled to unit length, the distance
+        # between two bins is then -log of their dot product
+        u = logp - (0.5 * _logsumexp(2.0 * logp, 0))
+        acc = numpy.full((BINS, BINS), -numpy.inf)
+
+        for s in range(homopolymers) :
+            acc = numpy.logaddexp(acc, u[s][:, None] + u[s][None, :])
+
+        self.distances = numpy.zeros((BINS + 1, BINS + 1), dtype=numpy.float32)
+        self.distances[:BINS, :BINS] = numpy.clip(-acc, 0.0, 1000.0)
+
+    def __read(self, fname) :
+        try :
+            with open(fname) as f :
+                values = numpy.array(f.read().split(), dtype=numpy.float64)
+
+        except (IOError, ValueError), e :
+            raise DenoiserError("could not read %s (%s)" % (fname, str(e)))
+
+        if (len(values) == 0) or (len(values) % BINS) :
+            raise DenoiserError("%s : expected a multiple of %d values, read %d" % (fname, BINS, len(values)))
+
+        return -values.reshape(-1, BINS)
+
+    def __gaussian(self) :
+        s = numpy.arange(self.homopolymers, dtype=numpy.float64)[:, None]
+        x = numpy.arange(BINS, dtype=numpy.float64)[None, :] * BIN_SIZE
+        sd = self.sd_intercept + (self.sd_slope * s)
+
+        logp = (-0.5 * ((x - s) / sd) ** 2) - numpy.log(sd)
+
+        return logp - _logsumexp(logp, 1)[:, None]
+
+def read_flows(fname) :
+    """names, lengths and binned signals (reads x flows) from a PyroNoise
+    flows.dat, flows past each flowgram's length are in bin PAST_END"""
+    names = []
+    lengths = []
+    rows = []
+
+    with open(fname) as f :
+        f.readline()
+
+        for line in f :
+            fields = line.split(None, 2)
+
+            if len(fields) < 2 :
+                continue
+
+            names.append(fields[0])
+            lengths.append(int(fields[1]))
+            rows.append(fields[2] if len(fields) > 2 else "")
+
+    lengths = numpy.array(lengths, dtype=numpy.int64)
+    bins = numpy.full((len(rows), lengths.max() if len(rows) else 0), PAST_END, dtype=numpy.int16)
+
+    for i,row in enumerate(rows) :
+        signal = numpy.array(row.split()[:lengths[i]], dtype=numpy.float64)
+        lengths[i] = len(signal)
+        bins[i, :len(signal)] = numpy.minimum(numpy.rint(signal / BIN_SIZE), BINS - 1)
+
+    return names, lengths, bins
+
+def complete_linkage(d, cutoff) :
+    """clusters (lists of indices) joined by complete linkage while they are
+    at most cutoff apart, d is the flowgrams at most cutoff from each other
+    and their distances as (indices, distances, bounds), row i is from
+    bounds[i] to bounds[i+1] - 1 sorted by index, missing pairs are further
+    apart. d is overwritten
+
+    uses a nearest neighbour chain, a flowgram whose nearest neighbour is
+    further away than cutoff is finished, complete linkage distances only
+    grow as clusters are joined"""
+    indices,distances,bounds = d
+    n = len(bounds) - 1
+
+    members = [ [i] for i in range(n) ]
+    active = numpy.ones(n, dtype=bool)
+    clusters = []
+    chain = []
+    first = 0
+
+    # rows only get shorter, so stay in place
+    start = bounds[:-1].copy()
+    end = bounds[1:].copy()
+
+    def row(i) :
+        # distances from i to the other active clusters
+        idx = indices[start[i]:end[i]]
+        dist = distances[start[i]:end[i]]
+        keep = active[idx] & numpy.isfinite(dist)
+
+        idx = idx[keep]
+        dist = dist[keep]
+        end[i] = start[i] + len(idx)
+        indices[start[i]:end[i]] = idx
+        distances[start[i]:end[i]] = dist
+
+        return idx, dist
+
+    def find(rows, i) :
+        # where i is in each of rows (it must be there)
+        lo = start[rows]
+        hi = end[rows]
+
+        while True :
+            search = lo < hi
+            if not search.any() :
+                return lo
+
+            mid = (lo + hi) // 2
+            less = indices[numpy.minimum(mid, len(indices) - 1)] < i
+            lo = numpy.where(search & less, mid + 1, lo)
+            hi = numpy.where(search & ~less, mid, hi)
+
+    while chain or (first < n) :
+        if not chain :
+            chain.append(first)
+
+        a = chain[-1]
+        idx,dist = row(a)
+
+        # ties go to the lowest index, or to the previous link so the chain ends
+        if len(idx) :
+            k = int(numpy.argmin(dist))
+
+            if len(chain) > 1 :
+                p = idx.searchsorted(chain[-2])
+                if (p < len(idx)) and (idx[p] == chain[-2]) and (dist[p] == dist[k]) :
+                    k = p
+
+        if (len(idx) == 0) or not (float(dist[k]) <= cutoff) :
+            clusters.append(members[a])
+            active[a] = False
+            chain.pop()
+
+        elif (len(chain) > 1) and (idx[k] == chain[-2]) :
+            b = chain[-2]
+            bidx,bdist = row(b)
+
+            # a cluster missing from either is more than cutoff away
+            common,i,j = numpy.intersect1d(idx, bidx, assume_unique=True, return_indices=True)
+            joined = numpy.maximum(dist[i], bdist[j])
+
+            tmp = numpy.full(len(idx), numpy.inf, dtype=distances.dtype)
+            tmp[i] = joined
+            distances[find(idx[idx != b], a)] = tmp[idx != b]
+
+            end[a] = start[a] + len(common)
+            indices[start[a]:end[a]] = common
+            distances[start[a]:end[a]] = joined
+
+            members[a].extend(members[b])
+            active[b] = False
+            chain = chain[:-2]
+
+        else :
+            chain.append(int(idx[k]))
+
+        while (first < n) and not active[first] :
+            first += 1
+
+    return clusters
+
+class FlowgramDenoiser(object) :
+    """denoises flowgrams without AmpliconNoise: distances between every pair
+    of flowgrams (in blocks, in parallel, only pairs within cutoff are kept),
+    complete linkage clustering and then EM with each cluster's centroid a
+    homopolymer length for each flow, as PyroDist, FCluster and PyroNoise do.
+    the output has the same format as PyroNoise's _cd.fa, one sequence per
+    centroid named _INDEX_COUNT"""
+
+    # smaller responsibilities are dropped, so each flowgram is only
+    # compared with the centroids it is likely to belong to
+    min_tau = 1e-6
+
+    def __init__(self, lookup=None, threads=1, cutoff=0.01, sigma=60.0, iterations=50) :
+        self.log = logging.getLogger('seance')
+        self.lookup = lookup
+        self.threads = threads
+        self.cutoff = cutoff
+        self.sigma = sigma
+        self.iterations = iterations
+
+    def __map(self, pool, func, tasks) :
+        return pool.imap_unordered(func, tasks) if pool else map(func, tasks)
+
+    def __row_blocks(self, n, size) :
+        return [ (i, min(n, i + size)) for i in range(0, n, size) ]
+
+    def __block_size(self, n, parts, columns) :
+        # rows in each block, so there are enough blocks to share between
+        # the threads and no block's distances or costs take too much memory
+        return max(1, min(n / (self.threads * parts), _BLOCK_ELEMENTS / max(1, columns)))
+
+    def distances(self, pool, n) :
+        """the flowgrams at most cutoff from each flowgram and their
+        distances, as (indices, distances, bounds), see complete_linkage"""
+        blocks = self.__row_blocks(n, self.__block_size(n, 16, n))
+        parts = []
+
+        p = Progress("Calculating flowgram distances", len(blocks))
+        p.start()
+
+        for tmp in self.__map(pool, _distance_rows, [ (s, e, self.cutoff) for s,e in blocks ]) :
+            parts.append(tmp)
+            p.increment()
+
+        p.end()
+
+        # each row is the pairs where it is j (sorted by i) then the pairs
+        # where it is i (sorted by j), blocks are put in place in order of i
+        parts.sort(key=lambda x : x[0])
+
+        lower = numpy.zeros(n, dtype=numpy.int64)
+        upper = numpy.zeros(n, dtype=numpy.int64)
+
+        for start,rows,columns,dist in parts :
+            for counts,x in ((lower, columns), (upper, rows)) :
+                values,freq = numpy.unique(x, return_counts=True)
+                counts[values] += freq
+
+        bounds = numpy.r_[0, numpy.cumsum(lower + upper)]
+        indices = numpy.empty(bounds[-1], dtype=numpy.int32)
+        distances = numpy.empty(bounds[-1], dtype=numpy.float32)
+
+        filled = bounds[:-1].copy()
+
+        for k in range(len(parts)) :
+            start,rows,columns,dist = parts[k]
+            parts[k] = None
+
+            # after the pairs from earlier blocks where the row is j
+            order = numpy.argsort(columns, kind='mergesort')
+            c = columns[order]
+            position = filled[c] + numpy.arange(len(c)) - c.searchsorted(c)
+            indices[position] = rows[order]
+            distances[position] = dist[order]
+
+            values,freq = numpy.unique(c, return_counts=True)
+            filled[values] += freq
+
+            # after all the pairs where the row is j
+            position = bounds[rows] + lower[rows] + numpy.arange(len(rows)) - rows.searchsorted(rows)
+            indices[position] = columns
+            distances[position] = dist
+
+        return indices, distances, bounds
+
+    def __centroids(self, tau, bins, lengths, assigned) :
+        # the homopolymer length of each flow that costs least over the
+        # flowgrams in each cluster, weighted by tau (flowgrams, clusters
+        # and values of the non-zero entries, every cluster has at least one)
+        costs = self.model.costs
+        homopolymers = len(costs) - 1
+        rows,columns,values = tau
+        k = columns.max() + 1
+        best = numpy.full((k, bins.shape[1]), numpy.inf)
+        centroids = numpy.zeros((k, bins.shape[1]), dtype=numpy.int16)
+
+        # entries are summed a block at a time, sorted by cluster
+        order = numpy.argsort(columns, kind='mergesort')
+        rows = rows[order]
+        columns = columns[order]
+        values = values[order]
+        step = max(1, _BLOCK_ELEMENTS / bins.shape[1])
+
+        for s in range(homopolymers) :
+            tmp = numpy.zeros((k, bins.shape[1]))
+
+            for i in range(0, len(rows), step) :
+                c = columns[i:i+step]
+                starts = numpy.flatnonzero(numpy.r_[True, c[1:] != c[:-1]])
+                tmp[c[starts]] += numpy.add.reduceat(values[i:i+step, None] * costs[s][bins[rows[i:i+step]]], starts, axis=0)
+
+            better = tmp < best
+            best[better] = tmp[better]
+            centroids[better] = s
+
+        clens = numpy.zeros(k, dtype=numpy.int64)
+        numpy.maximum.at(clens, assigned, lengths)
+
+        centroids[numpy.arange(bins.shape[1])[None, :] >= clens[:, None]] = homopolymers
+
+        return centroids, clens
+
+    def refine(self, pool, clusters, bins, lengths) :
+        """EM from the initial clusters, returns the centroids, their lengths
+        and which of them each flowgram belongs to"""
+        n = len(bins)
+        assigned = numpy.zeros(n, dtype=numpy.int64)
+
+        for j,members in enumerate(clusters) :
+            assigned[members] = j
+
+        # tau is kept sparse, (flowgrams, clusters, values)
+        tau = (numpy.arange(n), assigned.copy(), numpy.ones(n))
+
+        for iteration in range(self.iterations) :
+            centroids,clens = self.__centroids(tau, bins, lengths, assigned)
+            k = len(centroids)
+            weights = numpy.bincount(tau[1], weights=tau[2], minlength=k) / n
+            logweights = numpy.log(numpy.maximum(weights, 1e-300))
+
+            blocks = self.__row_blocks(n, self.__block_size(n, 4, k))
+            tasks = [ (centroids, clens, logweights, self.sigma, self.min_tau, s, e) for s,e in blocks ]
+            parts = sorted(self.__map(pool, _responsibilities, tasks), key=lambda x : x[0])
+
+            previous = assigned
+            assigned = numpy.concatenate([ x[1] for x in parts ])
+            tau = tuple([ numpy.concatenate([ x[i] for x in parts ]) for i in (2, 3, 4) ])
+
+            # clusters nothing belongs to are dropped
+            counts = numpy.bincount(assigned, minlength=k)
+            keep = numpy.flatnonzero(counts)
+
+            if len(keep) < k :
+                rows,columns,values = tau
+                kept = counts[columns] > 0
+                rows,columns,values = rows[kept], columns[kept], values[kept]
+                values = values / numpy.bincount(rows, weights=values, minlength=n)[rows]
+
+                index = numpy.cumsum(counts > 0) - 1
+                tau = (rows, index[columns], values)
+                assigned = index[assigned]
+                previous = None
+
+            self.log.debug("denoising iteration %d, %d clusters" % (iteration + 1, len(keep)))
+
+            if (previous is not None) and numpy.array_equal(previous, assigned) :
+                break
+
+        centroids,clens = self.__centroids(tau, bins, lengths, assigned)
+
+        return centroids, clens, assigned
+
+    @staticmethod
+    def sequence(centroid, length, flow_chars, key) :
+        tmp = ''.join([ flow_chars[i] * int(s) for i,s in enumerate(centroid[:length]) ])
+        return tmp[len(key):] if tmp.startswith(key) else tmp
+
+    def run(self, datfile, outfile, flow_chars, key) :
+        names,lengths,bins = read_flows(datfile)
+        n = len(names)
+
+        self.model = FlowgramModel(self.lookup)
+        _init_denoiser(bins, lengths, self.model)
+
+        pool = multiprocessing.Pool(self.threads, _init_denoiser, (bins, lengths, self.model)) if (self.threads > 1) and (n > 1) else None
+
+        try :
+            clusters = complete_linkage(self.distances(pool, n), self.cutoff)
+            self.log.info("%d flowgrams in %d initial clusters" % (n, len(clusters)))
+
+            centroids,clens,assigned = self.refine(pool, clusters, bins, lengths)
+
+        finally :
+            if pool is not None :
+                pool.close()
+                pool.join()
+
+        counts = numpy.bincount(assigned, minlength=len(centroids))
+        self.log.info("%d flowgrams denoised to %d sequences" % (n, numpy.count_nonzero(counts)))
+
+        fname = "%s_cd.fa" % outfile
+        prefix = basename(outfile)
+
+        with open(fname, 'w') as f :
+            for index,j in enumerate(numpy.argsort(-counts, kind='mergesort')) :
+                if counts[j] == 0 :
+                    break
+
+                print >> f, ">%s_%d_%d" % (prefix, index, counts[j])
+                print >> f, self.sequence(centroids[j], clens[j], flow_chars, key)
+
+        return fname
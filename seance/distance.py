@@ -0,0 +1,145 @@
+import numpy
+
+from seance.datatypes import IUPAC
+
+
+GAP = ord('-')
+
+def _iupac_masks() :
+    # bitmask of the bases each code can stand for, '-' and anything
+    # unknown are 0 so never compare equal
+    bits = {}
+    for c in IUPAC.reverse_mapping['N'] + 'U' :
+        bits[c] = 1 << len(bits)
+
+    masks = numpy.zeros(256, dtype=numpy.uint8)
+    for code,bases in IUPAC.reverse_mapping.items() :
+        for b in bases :
+            masks[ord(code)] |= bits[b]
+
+    return masks
+
+IUPAC_MASKS = _iupac_masks()
+
+def terminal_homopolymer(aligned) :
+    # terminal homopolymer can cause problems
+    #
+    # pagan does
+    # XYYYY
+    # X-YYY
+    #
+    # instead of
+    # XYYYYZ
+    # XYYY-Z
+    aligned = list(aligned)
+    last = aligned[0][-1]
+
+    a0 = aligned[0].rstrip(last)
+    a1 = aligned[1].rstrip(last)
+
+    if (len(a0) < len(a1)) and (a1[-1] == '-') :
+        aligned[1] = a1[:-1] + (last * (len(a1) - len(a0)))
+
+    elif (len(a1) < len(a0)) and (a0[-1] == '-') :
+        aligned[0] = a0[:-1] + (last * (len(a0) - len(a1)))
+
+    return aligned
+
+def identity(pairs, homopolymer_correction=False, iupac=False, ignore_double_gaps=False) :
+    """identity of each aligned pair of strings, calculated over all pairs at once
+
+    terminal gaps are ignored and each run of gaps counts as a single
+    difference, with homopolymer_correction gaps that extend a homopolymer
+    are not counted either, iupac compares ambiguity codes as equal if they
+    share a base and ignore_double_gaps skips columns that are gaps in both
+
+    (this is what Cluster.distance, Cluster.distance2 and
+    IdentifiabilityScore.distance used to calculate one column at a time)"""
+    if len(pairs) == 0 :
+        return []
+
+    # identity is relative to the length before any terminal homopolymer
+    # is fixed up, which can shorten one of the strings
+    leng = numpy.array([ min(len(p[0]), len(p[1])) for p in pairs ], dtype=numpy.float64)
+
+    if homopolymer_correction :
+        pairs = [ terminal_homopolymer(p) for p in pairs ]
+
+    lengths = numpy.array([ min(len(p[0]), len(p[1])) for p in pairs ], dtype=numpy.int64)
+
+    A = numpy.frombuffer(''.join([ p[0][:l] for p,l in zip(pairs, lengths) ]), dtype=numpy.uint8)
+    B = numpy.frombuffer(''.join([ p[1][:l] for p,l in zip(pairs, lengths) ]), dtype=numpy.uint8)
+    seg = numpy.repeat(numpy.arange(len(pairs)), lengths)
+
+    if ignore_double_gaps :
+        keep = ~((A == GAP) & (B == GAP))
+        A = A[keep]
+        B = B[keep]
+        seg = seg[keep]
+        lengths = numpy.bincount(seg, minlength=len(pairs))
+
+    n = len(A)
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    nonempty = lengths > 0
+
+    is_start = numpy.zeros(n, dtype=bool)
+    is_start[offsets[nonempty]] = True
+    is_end = numpy.zeros(n, dtype=bool)
+    is_end[(offsets + lengths - 1)[nonempty]] = True
+
+    gap = (A == GAP) | (B == GAP)
+    plain_eq = A == B
+
+    if iupac :
+        eq = (IUPAC_MASKS[A] & IUPAC_MASKS[B]) != 0
+    else :
+        eq = plain_eq
+
+    # every column outside of a gap is counted
+    diff = numpy.bincount(seg[~gap & ~eq], minlength=len(pairs)).astype(numpy.float64)
+
+    # runs of gaps
+    prev_gap = numpy.concatenate(([False], gap[:-1]))
+    next_gap = numpy.concatenate((gap[1:], [False]))
+    run_start = numpy.flatnonzero(gap & (~prev_gap | is_start))
+    run_end = numpy.flatnonzero(gap & (~next_gap | is_end))
+    nruns = len(run_start)
+
+    # runs at the start of an alignment are always skipped
+    leading = is_start[run_start]
+
+    if homopolymer_correction :
+        # the first column of a run that does not extend the last matching
+        # base is the one that gets counted
+        before = numpy.where(leading, 0, run_start - 1)
+        last_match = numpy.where(plain_eq[before], A[before], GAP)
+
+        gapcols = numpy.flatnonzero(gap)
+        run_id = numpy.cumsum(numpy.in1d(gapcols, run_start)) - 1
+        c = numpy.where(A[gapcols] != GAP, A[gapcols], B[gapcols])
+
+        candidate = numpy.where(c != last_match[run_id], gapcols, n)
+        bounds = numpy.searchsorted(gapcols, run_start)
+        processed = numpy.minimum.reduceat(candidate, bounds) if nruns else numpy.array([], dtype=numpy.int64)
+    else :
+        processed = run_start.copy()
+
+    counted = ~leading & (processed < n)
+    hits = processed[counted]
+    diff += numpy.bincount(seg[hits], weights=(~eq[hits]).astype(numpy.float64), minlength=len(pairs))
+
+    # a trailing gap (if it was counted) is removed again, as is an
+    # alignment that contains nothing but skipped columns
+    last_gap = ~nonempty
+
+    if nruns :
+        trailing = is_end[run_end]
+        tseg = seg[run_end[trailing]]
+        last_gap[tseg] = leading[trailing] | counted[trailing]
+
+    diff -= last_gap
+
+    with numpy.errstate(divide='ignore', invalid='ignore') :
+        result = (leng - diff) / leng
+
+    return [ float(r) if l > 0 else 0.0 for r,l in zip(result, leng) ]
@@ -1,10 +1,41 @@
 import sys
 import os
 import re
+import struct
 import datetime
 import logging
+import collections
+
+import numpy
+
+from itertools import imap, repeat
+from operator import attrgetter
 
 from seance.datatypes import Sequence, SampleMetadata, IUPAC
+from seance.compression import open_file, detect
+
+
+_NUM_DUPLICATES = re.compile(">(\S+)\ NumDuplicates=(\d+)$")
+
+# characters allowed in sequences, alignments are read as well so gaps are
+# included, whatever is left after deleting these is invalid
+_SEQUENCE_CHARS = IUPAC.codes + '-'
+
+def _invalid_codes(s) :
+    return s.translate(None, _SEQUENCE_CHARS)
+
+# sff qualities are bytes, fastq qualities are characters
+_PHRED33 = ''.join([ chr(min(i + 33, 255)) for i in range(256) ])
+
+def _discard(f, n) :
+    # moves n bytes forward in a file that cannot seek (compressed files)
+    while n > 0 :
+        tmp = f.read(min(n, FastqFile.block_size))
+
+        if tmp == "" :
+            break
+
+        n -= len(tmp)
 
 
 class DataFileError(Exception):
@@ -37,10 +68,196 @@ class DataFile(object) :
     def get_extension(self) :
         return self.extension
 
+class SffRead(object) :
+    """a read from an sff file, flows (uint16, 100 x the signal), flow_index,
+    bases and qualities (uint8) are views of the memory mapped file. clip
+    points are as biopython has them, lefts count from 0 and rights are as
+    stored (0 if there is no clip)"""
+
+    __slots__ = ('name', 'flows', 'flow_index', 'bases', 'qualities', 
+                 'clip_qual_left', 'clip_qual_right', 'clip_adapter_left', 'clip_adapter_right')
+
+    def __init__(self, name, flows, flow_index, bases, qualities, clips) :
+        self.name = name
+        self.flows = flows
+        self.flow_index = flow_index
+        self.bases = bases
+        self.qualities = qualities
+
+        qual_left,self.clip_qual_right,adapter_left,self.clip_adapter_right = clips
+        self.clip_qual_left = max(qual_left - 1, 0)
+        self.clip_adapter_left = max(adapter_left - 1, 0)
+
+    def clip(self) :
+        """(left, right) of the part of the read that was not clipped"""
+        n = len(self.bases)
+        right = min(self.clip_qual_right or n, self.clip_adapter_right or n)
+
+        return max(self.clip_qual_left, self.clip_adapter_left), right
+
+    def sequence(self, trim=True) :
+        """the bases left after clipping, with trim=False every base with the 
+        clipped ones in lower case (like biopython and the roche tools)"""
+        left,right = self.clip()
+        s = self.bases.tostring()
+
+        if trim :
+            return s[left:right].upper() if left < right else ""
+
+        if left >= right :
+            return s.lower()
+
+        return s[:left].lower() + s[left:right].upper() + s[right:].lower()
+
+    def quality_string(self) :
+        """qualities of the bases left after clipping, phred + 33"""
+        left,right = self.clip()
+        return self.qualities[left:right].tostring().translate(_PHRED33)
+
 class SffFile(DataFile) :
+    """reads 454 sff files without converting them to fastq first, the file
+    is memory mapped and each read's flowgram, bases and qualities are views 
+    of it. reads() yields SffRead objects, opening and iterating yields the 
+    clipped reads as sequences, so an SffFile can be used like a FastqFile"""
+
+    magic = 0x2E736666
+    header_format = '>IIQIIHHHB'
+    read_header_format = '>HHIHHHH'
+
+    # the same as FastqFile, but there is nothing to check
+    validation = 'off'
+
     def __init__(self, fname) :
         DataFile.__init__(self, fname, ".sff")
 
+        self._data = None
+        self._reads = None
+
+    @staticmethod
+    def __padded(n) :
+        # sections are padded to a multiple of 8 bytes
+        return (n + 7) & ~7
+
+    def __unpack(self, fmt, offset) :
+        return struct.unpack_from(fmt, self._data, offset)
+
+    def __map(self) :
+        if self._data is not None :
+            return
+
+        if os.path.getsize(self.get_filename()) < struct.calcsize(SffFile.header_format) :
+            raise DataFileError("%s : not an sff file" % self.get_filename())
+
+        # slices of a plain array are much cheaper than slices of a memmap,
+        # the memmap stays open as long as something is using it
+        self._data = numpy.memmap(self.get_filename(), dtype=numpy.uint8, mode='r').view(numpy.ndarray)
+
+        magic,version,self.index_offset,self.index_length,self.number_of_reads,header_length, \
+            key_length,self.number_of_flows,flowgram_format = self.__unpack(SffFile.header_format, 0)
+
+        if magic != SffFile.magic :
+            raise DataFileError("%s : not an sff file" % self.get_filename())
+
+        if flowgram_format != 1 :
+            raise DataFileError("%s : unknown flowgram format (%d)" % (self.get_filename(), flowgram_format))
+
+        offset = struct.calcsize(SffFile.header_format)
+        self.flow_chars = self._data[offset : offset + self.number_of_flows].tostring()
+        offset += self.number_of_flows
+        self.key_sequence = self._data[offset : offset + key_length].tostring()
+
+        self._header_length = header_length
+
+    def reads(self) :
+        """yields every read in the file"""
+        self.__map()
+
+        data = self._data
+        nflows = self.number_of_flows
+        header_size = struct.calcsize(SffFile.read_header_format)
+        offset = self._header_length
+
+        for i in xrange(self.number_of_reads) :
+            # the index can be anywhere between reads
+            if self.index_length and (offset == self.index_offset) :
+                offset += SffFile.__padded(self.index_length)
+
+            if offset + header_size > len(data) :
+                raise DataFileError("%s : ends after %d of %d reads" % (self.get_filename(), i, self.number_of_reads))
+
+            read_header_length,name_length,nbases,qual_left,qual_right,adapter_left,adapter_right = \
+                    self.__unpack(SffFile.read_header_format, offset)
+
+            name = data[offset + header_size : offset + header_size + name_length].tostring()
+            offset += read_header_length
+
+            flows = data[offset : offset + (2 * nflows)].view('>u2')
+            offset += 2 * nflows
+            flow_index = data[offset : offset + nbases]
+            offset += nbases
+            bases = data[offset : offset + nbases]
+            offset += nbases
+            qualities = data[offset : offset + nbases]
+            offset += nbases
+
+            offset = SffFile.__padded(offset)
+
+            if offset > len(data) :
+                raise DataFileError("%s : ends after %d of %d reads" % (self.get_filename(), i, self.number_of_reads))
+
+            yield SffRead(name, flows, flow_index, bases, qualities, (qual_left, qual_right, adapter_left, adapter_right))
+
+    def flowgrams(self, size=10000) :
+        """yields the reads in lists of at most size reads, each with a 
+        (reads x flows) uint16 array of their flowgrams"""
+        tmp = []
+
+        for r in self.reads() :
+            tmp.append(r)
+
+            if len(tmp) == size :
+                yield tmp, numpy.vstack([ r.flows for r in tmp ])
+                tmp = []
+
+        if tmp :
+            yield tmp, numpy.vstack([ r.flows for r in tmp ])
+
+    def __len__(self) :
+        self.__map()
+        return self.number_of_reads
+
+    def __nonzero__(self) :
+        return True
+
+    # FastqFile interface
+
+    def __iter__(self) :
+        return self
+
+    def next(self) :
+        return self.read()
+
+    def open(self) :
+        self._reads = self.reads()
+
+    def close(self) :
+        # views of the file can outlive it, the mapping goes when they do
+        self._reads = None
+        self._data = None
+
+    def read(self) :
+        r = self._reads.next()
+
+        qualities = r.quality_string()
+        tmp = Sequence(r.sequence(), qualities if qualities else None, check=False)
+        tmp.id = '@' + r.name
+        tmp.duplicates = 1
+
+        return tmp
+
+    def ranges(self, n) :
+        return [ (0, None) ]
+
 class State(object) :
     def __init__(self, states) :
         self.__counter = 0
@@ -59,66 +276,258 @@ class State(object) :
 class ParseError(Exception) :
     pass
 
-class FastqFile(DataFile) :
-    SEQID = 0
-    SEQ = 1
-    QUALID = 2
-    QUAL = 3
+# name is the first word of the id line, description the rest of it, length
+# is in bytes and seqlen in bases
+IndexEntry = collections.namedtuple('IndexEntry', 'name offset length seqlen duplicates description')
+
+class FastqIndex(object) :
+    """where every record of a fasta/fastq file starts, kept next to it in 
+    fname.idx so it only has to be built once. the index is rebuilt if the 
+    size or modification time of the file changes. offsets in compressed
+    files are offsets in the decompressed data"""
+
+    extension = '.idx'
+    magic = '#seance-index'
 
     def __init__(self, fname) :
+        self.fname = fname
+        self.index_fname = fname + FastqIndex.extension
+        self.log = logging.getLogger('seance')
+
+        self.stamp = self.__stamp()
+        self.count = None
+        self._entries = None
+        self._positions = None
+
+        if not self.__check() :
+            self.__build()
+            self.__save()
+
+    def __stamp(self) :
+        st = os.stat(self.fname)
+        return [ str(st.st_size), repr(st.st_mtime) ]
+
+    def __check(self) :
+        # the number of records is in the header, so that is all that
+        # is read until an entry is needed
+        try :
+            with open(self.index_fname) as f :
+                fields = f.readline().rstrip('\n').split('\t')
+
+        except IOError :
+            return False
+
+        if (len(fields) != 4) or (fields[0] != FastqIndex.magic) or (fields[1:3] != self.stamp) :
+            return False
+
+        self.count = int(fields[3])
+        return True
+
+    def __load(self) :
+        tmp = []
+
+        with open(self.index_fname) as f :
+            f.readline()
+
+            for line in f :
+                name,offset,length,seqlen,duplicates,description = line.rstrip('\n').split('\t', 5)
+                tmp.append(IndexEntry(name, int(offset), int(length), int(seqlen), int(duplicates), description))
+
+        if len(tmp) != self.count :
+            raise DataFileError("%s : expected %d entries, read %d" % (self.index_fname, self.count, len(tmp)))
+
+        return tmp
+
+    def __lines(self, f) :
+        # (offset, line) for every line in f
+        offset = 0
+        partial = ""
+
+        while True :
+            block = f.read(FastqFile.block_size)
+            tmp = (partial + block).split('\n')
+            partial = tmp.pop() if block else ""
+
+            for line in tmp :
+                yield offset, line
+                offset += len(line) + 1
+
+            if block == "" :
+                break
+
+    def __entry(self, seqid, offset, end, seqlen) :
+        duplicates = 1
+        mat = _NUM_DUPLICATES.match(seqid) if "NumDuplicates" in seqid else None
+
+        if mat :
+            name,description = mat.group(1), ""
+            duplicates = int(mat.group(2))
+        else :
+            fields = seqid[1:].split(None, 1)
+            name = fields[0] if fields else ""
+            description = fields[1] if len(fields) > 1 else ""
+
+        return IndexEntry(name, offset, end - offset, seqlen, duplicates, description)
+
+    def __build(self) :
+        # records are found the same way FastqFile reads them, a '>' line in
+        # a sequence starts the next record, a '+' line starts the qualities
+        # and the record ends when there are as many qualities as bases
+        tmp = []
+        seqid = None
+        start = seqlen = qlen = 0
+        qualities = False
+
+        self.log.info("indexing %s ..." % self.fname)
+
+        f = open_file(self.fname)
+
+        for offset,line in self.__lines(f) :
+            s = line.strip()
+
+            if seqid is None :
+                if s :
+                    seqid,start,seqlen,qualities = s,offset,0,False
+
+            elif qualities :
+                qlen += len(s)
+
+                if qlen == seqlen :
+                    tmp.append(self.__entry(seqid, start, offset + len(line) + 1, seqlen))
+                    seqid = None
+
+            elif s.startswith('>') :
+                tmp.append(self.__entry(seqid, start, offset, seqlen))
+                seqid,start,seqlen = s,offset,0
+
+            elif s.startswith('+') :
+                if seqlen == 0 :
+                    tmp.append(self.__entry(seqid, start, offset + len(line) + 1, seqlen))
+                    seqid = None
+                else :
+                    qualities,qlen = True,0
+
+            else :
+                seqlen += len(s)
+
+        f.close()
+
+        # fastq records without qualities at the end of the file are dropped
+        if (seqid is not None) and (not qualities) and seqid.startswith('>') :
+            tmp.append(self.__entry(seqid, start, offset + len(line), seqlen))
+
+        self._entries = tmp
+        self.count = len(tmp)
+
+    def __save(self) :
+        # written to a temporary file first, another process could be reading it
+        tmp_fname = self.index_fname + '.tmp'
+
+        try :
+            with open(tmp_fname, 'w') as f :
+                print >> f, '\t'.join([ FastqIndex.magic ] + self.stamp + [ str(self.count) ])
+
+                for e in self._entries :
+                    print >> f, '\t'.join(map(str, e))
+
+            os.rename(tmp_fname, self.index_fname)
+
+        except (IOError, OSError), e :
+            # read-only directories are fine, the index is just not kept
+            self.log.debug("could not write %s (%s)" % (self.index_fname, str(e)))
+
+    @property
+    def entries(self) :
+        if self._entries is None :
+            self._entries = self.__load()
+
+        return self._entries
+
+    def position(self, name) :
+        """where the (first) record called name is in entries, KeyError if there is none"""
+        if self._positions is None :
+            self._positions = {}
+
+            for i,e in enumerate(self.entries) :
+                self._positions.setdefault(e.name, i)
+
+        return self._positions[name]
+
+    def __getitem__(self, name) :
+        return self.entries[self.position(name)]
+
+    def __contains__(self, name) :
+        try :
+            self.position(name)
+
+        except KeyError :
+            return False
+
+        return True
+
+    def __iter__(self) :
+        return iter(self.entries)
+
+    def __len__(self) :
+        return self.count
+
+class FastqFile(DataFile) :
+    # sequence files are read in blocks of this many bytes, the lines of
+    # each block are split and stripped in bulk and most records are then
+    # taken four lines at a time without going through the general parser
+    block_size = 1 << 22
+
+    # full checks ids, sequences and qualities, fast only ids and qualities
+    # and off nothing at all (for files written by seance or otherwise trusted),
+    # the default is changed with --validation
+    validation_modes = ('full', 'fast', 'off')
+    validation = 'fast'
+
+    # how far past a split point to look for the start of a record
+    sync_window = 1 << 20
+
+    def __init__(self, fname, validation=None) :
         super(FastqFile, self).__init__(fname, ".fastq")
+
+        if validation is not None :
+            if validation not in FastqFile.validation_modes :
+                raise DataFileError("'%s' is not a validation mode" % validation)
+
+            self.validation = validation
+
+        self._index = None
         self._reset()
 
     def _reset(self) :
         self._filehandle = None #open(self.get_filename())
-        self._state = FastqFile.SEQID
         self._linenum = 0
+        self._parser = None
+        self._batch = iter([])
 
-        self._validators = {
-                FastqFile.SEQID  : self.__validate_seqid,
-                FastqFile.SEQ    : self.__validate_sequence,
-                FastqFile.QUALID : self.__validate_qualid,
-                FastqFile.QUAL   : self.__validate_qualities
-            }
-
-        self._current = {  
-                FastqFile.SEQID  : None,
-                FastqFile.SEQ    : None,
-                FastqFile.QUALID : None,
-                FastqFile.QUAL   : None 
-            }
-
-    def __validate_seqid(self, s) :
-        if not (s.startswith('@') or s.startswith('>')) :
+    def __validate_seqid(self, s, linenum) :
+        if (s[0] not in '@>') and (self.validation != 'off') :
             raise ParseError("%s : expected line %d to start with a @ or > (started with %s)" % \
-                    (self.get_filename(), self._linenum, s[0]))
+                    (self.get_filename(), linenum, s[0]))
 
-    def __validate_sequence(self, s) :
-        uniq = set(s)
+    def __check(self, lines, start, end, step, invalid, message) :
+        # lines[start:end:step] are checked together, then line by line to 
+        # report the first that failed
+        if not invalid(''.join(lines[start : end : step])) :
+            return
 
-        for i in uniq :
-            if i not in IUPAC.codes :
-                raise ParseError("%s : line %d contained an invalid UIPAC code (%s)" % \
-                        (self.get_filename(), self._linenum, i))
+        for j in range(start, end, step) :
+            for i in invalid(lines[j])[:1] :
+                raise ParseError(message % (self.get_filename(), self._linenum + j + 1, i))
 
-    def __validate_qualid(self, s) :
-        if not s.startswith('+') :
-            raise ParseError("%s : expected line %d to start with a +" % \
-                    (self.get_filename(), self._linenum))
+    def __validate_sequences(self, lines, start, end, step=1) :
+        if self.validation == 'full' :
+            self.__check(lines, start, end, step, _invalid_codes, 
+                    "%s : line %d contained an invalid UIPAC code (%s)")
 
-    def __validate_qualities(self, s) :
-        uniq = set(s)
-
-        for i in uniq :
-            try :
-                Sequence.quality_to_int(i)
-        
-            except ValueError, ve :
-                raise ParseError("%s : line %d contained an invalid quality value (%s)" % \
-                        (self.get_filename(), self._linenum, i))
-
-    def __validate(self, s, state) :
-        self._validators[state](s)
+    def __validate_qualities(self, lines, start, end, step=1) :
+        if self.validation != 'off' :
+            self.__check(lines, start, end, step, Sequence.invalid_qualities, 
+                    "%s : line %d contained an invalid quality value (%s)")
 
     def __iter__(self) :
         return self
@@ -126,11 +535,22 @@ class FastqFile(DataFile) :
     def next(self) :
         return self.read()
 
-    def open(self) :
+    def open(self, start=0, end=None) :
+        """with start and end only the records in that byte range are read,
+        see ranges"""
         if self._filehandle :
             self._filehandle.close()
 
-        self._filehandle = open(self.get_filename())
+        self._reset()
+        self._filehandle = open_file(self.get_filename())
+
+        if start :
+            if isinstance(self._filehandle, file) :
+                self._filehandle.seek(start)
+            else :
+                _discard(self._filehandle, start)
+
+        self._parser = self.__parse_file(None if end is None else end - start)
 
     def close(self) :
         if self._filehandle :
@@ -138,82 +558,336 @@ class FastqFile(DataFile) :
 
         self._reset()
 
-    def seq(self) :
-        seqid = self._current[FastqFile.SEQID]
+    def seq(self, seqid, sequence, qualities) :
         duplicates = 1
 
-        if "NumDuplicates" in self._current[FastqFile.SEQID] :
-            mat = re.match(">(\S+)\ NumDuplicates=(\d+)$", self._current[FastqFile.SEQID])
+        if "NumDuplicates" in seqid :
+            mat = _NUM_DUPLICATES.match(seqid)
 
             if not mat :
-                raise DataFileError("'%s' is a malformed sequence id" % self._current[FastqFile.SEQID])
+                raise DataFileError("'%s' is a malformed sequence id" % seqid)
 
-            seqid = mat.group(1)
             duplicates = int(mat.group(2))
+            seqid = mat.group(1)
+
+        # qualities were checked with the rest of the block
+        tmp = Sequence(sequence, qualities if qualities else None, check=False)
 
-        tmp = Sequence(self._current[FastqFile.SEQ], 
-                None if self._current[FastqFile.QUAL] == "" else self._current[FastqFile.QUAL])
-        
         # hack, maybe make more documented
         tmp.id = seqid
         tmp.duplicates = duplicates
 
         return tmp
 
-    def read(self) :
-        for line in self._filehandle :
-            line = line.strip()
+    def __four_line_records(self, lines, i, bulk=False) :
+        # how many records from lines[i] have an id, a sequence, a '+' line
+        # and qualities of the same length, these are read the same way
+        # whatever else the file contains. with bulk every remaining line is 
+        # tried at once first, which is what a plain fastq file looks like
+        if bulk :
+            end = i + (((len(lines) - i) / 4) * 4)
+            seqs = lines[i+1 : end : 4]
+
+            if all(imap(str.startswith, lines[i : end : 4], repeat(('@', '>')))) and \
+                    all(seqs) and not any(imap(str.startswith, seqs, repeat(('>', '+')))) and \
+                    all(imap(str.startswith, lines[i+2 : end : 4], repeat('+'))) and \
+                    (map(len, seqs) == map(len, lines[i+3 : end : 4])) :
+                return (end - i) / 4
+
+        j = i
+        n = len(lines) - 3
+
+        while j < n :
+            s = lines[j+1]
+
+            if (lines[j][:1] not in ('@', '>')) or (s[:1] in ('', '>', '+')) or \
+                    (lines[j+2][:1] != '+') or (len(s) != len(lines[j+3])) :
+                break
 
-            self._linenum += 1
+            j += 4
 
-            if line == "" :
+        return (j - i) / 4
+
+    def __parse_lines(self, lines, final) :
+        # parses stripped lines into sequences, returns the sequences and how 
+        # many lines were used, an incomplete record at the end is left for
+        # the next block unless this is the last one
+        tmp = []
+        n = len(lines)
+        i = 0
+
+        while i < n :
+            seqid = lines[i]
+
+            if seqid == "" :
+                i += 1
                 continue
 
-            # both '@' and '>' are legitimate quality scores
-            # but '+' is a genuine delimiter
-            # edit: unfortunately so is '+', so i also need to be in the SEQ state
-            if line.startswith('+') and (self._state == FastqFile.SEQ) :
-                self._current[FastqFile.QUALID] = line
-                self._state = FastqFile.QUAL
+            self.__validate_seqid(seqid, self._linenum + i + 1)
+
+            # runs of fastq records on exactly four lines are taken together
+            m = self.__four_line_records(lines, i, bulk=(i == 0))
+
+            if m :
+                end = i + (4 * m)
+
+                self.__validate_sequences(lines, i + 1, end, 4)
+                self.__validate_qualities(lines, i + 3, end, 4)
+
+                tmp.extend(map(self.seq, lines[i : end : 4], lines[i+1 : end : 4], lines[i+3 : end : 4]))
+                i = end
                 continue
 
-            if self._state == FastqFile.SEQID :
-                self.__validate(line, self._state)
+            # anything else, sequences can be split over any number of lines,
+            # a line starting with '>' starts the next fasta record and a line 
+            # starting with '+' separates sequence and qualities
+            # (both '@' and '>' are legitimate quality scores, but only '+' 
+            # ends the sequence)
+            j = i + 1
+            while (j < n) and (lines[j][:1] not in ('>', '+')) :
+                j += 1
+
+            if (j < n) or final :
+                self.__validate_sequences(lines, i + 1, j)
+
+            if j == n :
+                if not final :
+                    break
+
+                # fastq records without qualities at the end of the file are dropped
+                if seqid.startswith('>') :
+                    tmp.append(self.seq(seqid, ''.join(lines[i+1:j]), None))
+
+                i = n
+                break
+
+            s = ''.join(lines[i+1:j])
+
+            if lines[j][0] == '>' :
+                tmp.append(self.seq(seqid, s, None))
+                i = j
+                continue
 
-                self._current[FastqFile.SEQID] = line
-                self._current[FastqFile.SEQ] = ""
-                self._current[FastqFile.QUALID] = ""
-                self._current[FastqFile.QUAL] = ""
+            # qualities can be split over several lines as well
+            k = j + 1
+            q = []
+            qlen = 0
 
-                self._state = FastqFile.SEQ
+            while (k < n) and (qlen != len(s)) :
+                if lines[k] :
+                    self.__validate_qualities(lines, k, k + 1)
+                    q.append(lines[k])
+                    qlen += len(lines[k])
+                k += 1
 
-            elif self._state == FastqFile.SEQ :
-                # if we are reading a fasta file
-                if line.startswith('>') :
-                    tmp = self.seq()
-                    self._current[FastqFile.SEQID] = line
-                    self._current[FastqFile.SEQ] = ""
-                    return tmp
+            if qlen != len(s) :
+                if not final :
+                    break
 
-                self._current[FastqFile.SEQ] += line
-                # note: sequence can be across an arbitrary number of lines, so we have
-                # to stay in state SEQ 
+                i = n
+                break
 
-            elif self._state == FastqFile.QUAL :
-                self.__validate(line, self._state)
+            tmp.append(self.seq(seqid, s, ''.join(q)))
+            i = k
 
-                self._current[FastqFile.QUAL] += line
+        return tmp, i
 
-                if len(self._current[FastqFile.SEQ]) == len(self._current[FastqFile.QUAL]) :
-                    self._state = FastqFile.SEQID
-                    return self.seq()
+    def __parse_file(self, remaining=None) :
+        # yields lists of sequences, one per block, at most remaining 
+        # bytes are read
+        lines = []
+        partial = ""
 
-        if self._current[FastqFile.SEQID] is not None and self._current[FastqFile.SEQID].startswith('>') :
-            tmp = self.seq()
-            self._current[FastqFile.SEQID] = ""
-            return tmp
+        while True :
+            size = self.block_size if remaining is None else min(self.block_size, remaining)
+            block = self._filehandle.read(size)
+            final = (block == "")
+
+            if remaining is not None :
+                remaining -= len(block)
+
+            tmp = (partial + block).split('\n')
+            partial = tmp.pop() if not final else ""
+            lines.extend(map(str.strip, tmp))
+
+            seqs,used = self.__parse_lines(lines, final)
+
+            self._linenum += used
+            lines = lines[used:]
+
+            if seqs :
+                yield seqs
+
+            if final :
+                break
+
+    @staticmethod
+    def __fastq_record(lines, i) :
+        # lines[i] starts a record with every field on one line, a quality
+        # line can start with '@' or '>' but then the next line is an id, 
+        # not a sequence
+        if i + 3 >= len(lines) :
+            return False
+
+        seqid,s,plus,q = [ x.strip() for x in lines[i : i + 4] ]
+
+        return (seqid[:1] in ('@', '>')) and (s[:1] not in ('', '@', '>', '+')) and \
+                (plus[:1] == '+') and (len(s) == len(q))
+
+    def __record_start(self, f, offset, fastq) :
+        # offset of the first record that starts after offset, None if
+        # there is not one in the sync window
+        f.seek(offset - 1)
+        lines = f.read(self.sync_window + 1).split('\n')
+
+        # the line offset is in is skipped (it is empty if offset starts
+        # a line) as is the last line, which may have been cut short
+        offset += len(lines[0])
+        lines = lines[1:-1]
+
+        for i,line in enumerate(lines) :
+            if fastq :
+                if FastqFile.__fastq_record(lines, i) :
+                    return offset
+
+            elif line.startswith('>') :
+                return offset
+
+            offset += len(line) + 1
+
+        return None
+
+    def ranges(self, n) :
+        """splits the file into at most n byte ranges (start, end) that each start
+        on a record, end is None for the last one. each range can then be read
+        on its own with open(start, end). only fasta and fastq files with every 
+        field on one line are split, compressed files are not"""
+        fname = self.get_filename()
+        size = os.path.getsize(fname)
+
+        if (n < 2) or (detect(fname) is not None) :
+            return [ (0, None) ]
+
+        f = open(fname, 'rb')
+        start = f.read(self.sync_window).lstrip().split('\n')[:-1]
+
+        # the sequence of the first record is followed by a '+' line in a
+        # fastq file and by the next id in a fasta file
+        after = [ line[:1] for line in start[1:] if line[:1] in ('>', '+') ]
+
+        if FastqFile.__fastq_record(start, 0) :
+            fastq = True
+        elif start and start[0].startswith('>') and (after[:1] == ['>']) :
+            fastq = False
+        else :
+            f.close()
+            return [ (0, None) ]
+
+        offsets = [0]
+
+        for i in range(1, n) :
+            if (i * size) / n == 0 :
+                continue
+
+            tmp = self.__record_start(f, (i * size) / n, fastq)
+
+            if (tmp is not None) and (tmp > offsets[-1]) and (tmp < size) :
+                offsets.append(tmp)
+
+        f.close()
+
+        return zip(offsets, offsets[1:] + [None])
+
+    def index(self) :
+        """the FastqIndex of this file, read or built the first time it is needed"""
+        if self._index is None :
+            self._index = FastqIndex(self.get_filename())
+
+        return self._index
+
+    def __len__(self) :
+        return len(self.index())
+
+    def __nonzero__(self) :
+        # not the number of records
+        return True
+
+    def select(self, names) :
+        """yields the records called names (ids without the '>' or '@') in the
+        order they are in the file, names that are not in the file are ignored.
+        compressed files are read up to the last of them"""
+        index = self.index()
+        entries = sorted([ index[name] for name in set(names) if name in index ], key=attrgetter('offset'))
+
+        if not entries :
+            return
+
+        f = open_file(self.get_filename())
+        seekable = isinstance(f, file)
+        pos = 0
+
+        try :
+            for e in entries :
+                if seekable :
+                    f.seek(e.offset)
+                else :
+                    _discard(f, e.offset - pos)
+
+                block = f.read(e.length)
+                pos = e.offset + len(block)
+
+                seqs,used = self.__parse_lines(map(str.strip, block.split('\n')), True)
+
+                for seq in seqs :
+                    yield seq
+
+        finally :
+            f.close()
+
+    def get(self, name) :
+        """the record called name, KeyError if there is none"""
+        for seq in self.select([name]) :
+            return seq
+
+        raise KeyError(name)
+
+    def records(self, start=0, stop=None) :
+        """yields the records from start to stop - 1 (counting from 0, as in 
+        the index) without reading the rest of the file"""
+        entries = self.index().entries[start:stop]
+
+        if not entries :
+            return
+
+        tmp = FastqFile(self.get_filename(), validation=self.validation)
+        tmp.open(entries[0].offset, entries[-1].offset + entries[-1].length)
+
+        try :
+            for batch in tmp.batches() :
+                for seq in batch :
+                    yield seq
+
+        finally :
+            tmp.close()
+
+    def batches(self) :
+        """yields the remaining sequences in lists, one per block read"""
+        tmp = list(self._batch)
+
+        if tmp :
+            yield tmp
+
+        for batch in self._parser :
+            yield batch
+
+    def read(self) :
+        try :
+            return self._batch.next()
 
-        raise StopIteration
+        except StopIteration :
+            # the parser only yields non-empty lists
+            self._batch = iter(self._parser.next())
+            return self._batch.next()
 
 class MetadataReader(object) :
     def __init__(self, metadata_fname) :
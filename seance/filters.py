@@ -1,15 +1,50 @@
 import sys
 import abc
+import copy
 import operator
 import logging
+import collections
 
 from seance.datatypes import IUPAC
 
 class FilterError(Exception) :
     pass
 
+class PrefixCache(object) :
+    """bounded memo of read prefix --> result, most reads share a handful of
+    prefixes so this saves recomputing them, the least recently used entry
+    is dropped once there are max_entries"""
+
+    def __init__(self, max_entries=100000) :
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prefix, func) :
+        try :
+            value = self.entries.pop(prefix)
+            self.hits += 1
+
+        except KeyError :
+            value = func(prefix)
+            self.misses += 1
+
+            if len(self.entries) >= self.max_entries :
+                self.entries.popitem(last=False)
+
+        self.entries[prefix] = value
+
+        return value
+
+    def __str__(self) :
+        return "%d hits, %d misses" % (self.hits, self.misses)
+
 class Filter(object) :
     __metaclass__ = abc.ABCMeta
+
+    # filters that memoise their results by read prefix
+    cache = None
     
     def __init__(self) :
         pass
@@ -42,6 +77,32 @@ class MultiFilter(Filter) :
         for i in range(len(self.counts)) :
             self.counts[i] = 0
 
+    def fresh_copy(self) :
+        # copy for another process with all counts at zero, so the counts it
+        # comes back with can be passed to add_counts as they are
+        tmp = copy.deepcopy(self)
+        tmp.reset()
+
+        for f in tmp.filters :
+            if f.cache is not None :
+                f.cache.hits = 0
+                f.cache.misses = 0
+
+        return tmp
+
+    def add_counts(self, counts, cache_counts) :
+        # counts from a copy of these filters used in another process,
+        # cache_counts are (hits, misses) or None for filters without a cache
+        for index,f in enumerate(self.filters) :
+            self.counts[index] += counts[index]
+
+            if cache_counts[index] is not None :
+                f.cache.hits += cache_counts[index][0]
+                f.cache.misses += cache_counts[index][1]
+
+    def cache_counts(self) :
+        return [ None if f.cache is None else (f.cache.hits, f.cache.misses) for f in self.filters ]
+
     def __len__(self) :
         return len(self.filters)
 
@@ -51,7 +112,12 @@ class MultiFilter(Filter) :
     def __str__(self) :
         s = ""
         for index,f in enumerate(self.filters) :
-            s += "%s %d\n" % (f.__class__.__name__, self.counts[index])
+            s += "%s %d" % (f.__class__.__name__, self.counts[index])
+
+            if f.cache is not None :
+                s += " (prefix cache: %s)" % str(f.cache)
+
+            s += "\n"
         return s[:-1]
 
 class LengthFilter(Filter) :
@@ -164,17 +230,21 @@ class MidFilter(Filter) :
         self.mid = mid
         self.midlen = len(mid)
         self.err = err
+        self.cache = PrefixCache()
 
     def _hamming(self, mid, seq) :
         return len(filter(lambda x: x[0] != x[1], zip(mid, seq)))
 
+    def _verdict(self, seqmid) :
+        return self._hamming(self.mid, seqmid) <= self.err
+
     def accept(self, seq) :
         seqmid = seq.sequence[:self.midlen]
         seq.remove_mid(self.midlen)
 
         #print self.mid, seqmid, self._hamming(self.mid, seqmid)
 
-        return self._hamming(self.mid, seqmid) <= self.err
+        return self.cache.get(seqmid, self._verdict)
 
     def __str__(self) :
         return "MID(%d)" % self.err
@@ -186,20 +256,24 @@ class PrimerFilter(Filter) :
         self.len = len(primer)
         self.err = err
         self.clip = clip
+        self.cache = PrefixCache()
 
-    def accept(self, seq) :
-        seqprimer = seq.sequence[:self.len]
+    def _match_end(self, prefix) :
+        return IUPAC.match_end(self.primer, prefix, self.err, first=not self.clip)
 
-        ret = IUPAC.close_enough(self.primer, seq.sequence, self.err)
+    def accept(self, seq) :
+        # a match cannot use more than len + err bases, so
+        # the result only depends on this much of the read
+        end = self.cache.get(seq.sequence[:self.len + self.err], self._match_end)
+        ret = end != -1
 
         #print self.primer, seq.sequence[:self.len], ret
 
         if ret and self.clip :
-            # primer part of sequence may be longer or
-            # shorter, but it does not really matter
-            # as terminal gaps are not included in our
-            # definition of identity
-            seq.remove_mid(self.len)
+            # the primer part of the sequence may be longer 
+            # or shorter than the primer, so clip where the
+            # match ended
+            seq.remove_mid(end)
             
         return ret
 
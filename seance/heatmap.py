@@ -3,6 +3,8 @@ from math import log10, pi
 import re
 import json
 
+from seance.compression import open_file
+
 try :
     #import cairo
     import cairocffi as cairo
@@ -42,7 +44,7 @@ def parse_newick(newick_file, ladderise) :
     return dendropy2internal(tree.seed_node)
 
 def parse_biom(biom_file) :
-    with open(biom_file) as f :
+    with open_file(biom_file) as f :
         s = f.read()
 
     return json.loads(s)
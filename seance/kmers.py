@@ -0,0 +1,97 @@
+import collections
+import itertools
+
+
+def homopolymer_compress(s) :
+    return ''.join([ c for c,run in itertools.groupby(s) ])
+
+class KmerIndex(object) :
+    """incremental k-mer index over cluster centroids
+
+    candidates are ranked by the number of distinct k-mers they share with the
+    query and centroids that share too few are skipped. this is lossy and so
+    off by default: the bound assumes each difference destroys at most k
+    k-mers (k + 2 when sequences are homopolymer compressed, as a substitution
+    can merge neighbouring runs), which holds for substitutions and short
+    indels only. Cluster.distance2 counts a whole run of gaps as one
+    difference, forgives homopolymer gaps and ignores terminal gaps, so a pair
+    that passes the threshold can share arbitrarily few k-mers (e.g. a long
+    indel) and no bound on shared k-mers is safe for every pair. a q-gram
+    lemma bound does not help: a run of gaps with bases from both sequences
+    is one difference however long it is, so it can remove any number of
+    k-mers from both sides"""
+
+    def __init__(self, k, similarity_threshold, homopolymer_correction=True) :
+        if k <= 0 :
+            raise ValueError("k-mer length must be > 0 (read %d)" % k)
+
+        self.k = k
+        self.similarity_threshold = similarity_threshold
+        self.homopolymer_correction = homopolymer_correction
+
+        self.index = collections.defaultdict(list) # kmer --> centroid keys
+        self.counts = {} # centroid key --> (number of distinct kmers, sequence length)
+
+        self.pruned = 0
+        self.queries = 0
+
+    def __len__(self) :
+        return len(self.counts)
+
+    def __contains__(self, key) :
+        return key in self.counts
+
+    def kmers(self, s) :
+        if self.homopolymer_correction :
+            s = homopolymer_compress(s)
+
+        k = self.k
+        return set([ s[i:i+k] for i in range(len(s) - k + 1) ])
+
+    def add(self, key, seq) :
+        kmers = self.kmers(seq.sequence)
+
+        for kmer in kmers :
+            self.index[kmer].append(key)
+
+        self.counts[key] = (len(kmers), len(seq))
+
+    def min_shared(self, kmers1, len1, kmers2, len2) :
+        # similarity is (leng - diff) / leng where leng is at least the
+        # length of the longer sequence (a heuristic, see above)
+        max_diff = int((1.0 - self.similarity_threshold) * max(len1, len2)) + 1
+        per_diff = self.k + 2 if self.homopolymer_correction else self.k
+
+        return min(kmers1, kmers2) - (max_diff * per_diff)
+
+    def candidates(self, seq, clusters) :
+        """returns the clusters whose centroids can pass the similarity threshold
+        ordered by the number of shared k-mers (ties keep cluster order)"""
+        kmers = self.kmers(seq.sequence)
+        shared = collections.Counter()
+
+        for kmer in kmers :
+            for key in self.index.get(kmer, []) :
+                shared[key] += 1
+
+        tmp = []
+        for c in clusters :
+            key = c[0]
+
+            if key not in self.counts :
+                tmp.append((len(kmers), c))
+                continue
+
+            nkmers,length = self.counts[key]
+            count = shared[key]
+
+            if count >= self.min_shared(len(kmers), len(seq), nkmers, length) :
+                tmp.append((count, c))
+            else :
+                self.pruned += 1
+
+        self.queries += 1
+
+        tmp.sort(key=lambda x : x[0], reverse=True)
+
+        return [ c for count,c in tmp ]
@@ -23,6 +23,7 @@ from os.path import splitext, join
 
 from seance.workflow import WorkFlow
 from seance.system import System
+from seance.compression import compressed_name, uncompressed_name, find_file
 
 
 __program__ = "seance"
@@ -39,6 +40,8 @@ def get_default_options(command, fillin=False) :
             'metadata'          : None,
 
             'denoise'           : False,
+            'denoiser'          : 'ampliconnoise',
+            'lookup'            : None,
             'forwardprimer'     : None,
             'reverseprimer'     : None,
             'clipprimers'       : False,
@@ -57,9 +60,25 @@ def get_default_options(command, fillin=False) :
             'total-duplicate-threshold'     : 1,
             'sample-threshold'              : 1,
             'duplicate-threshold'           : 2,
-            'otu-similarity'                : 0.99,
+            'otu-similarity'                : [0.99],
             'merge-blast-hits'              : False,
             'no-homopolymer-correction'     : False,
+            'aligner'                       : 'pagan',
+            'kmer-length'                   : 0,
+            'threads'                       : 1,
+            'no-cache'                      : False,
+            'cache-size'                    : 1000000,
+            'similarity-cache'              : None,
+            'reference'                     : None,
+            'reference-biom'                : None,
+            'checkpoint'                    : None,
+            'checkpoint-time'               : 600,
+            'checkpoint-seqs'               : 0,
+            'resume'                        : False,
+            'dereplicate'                   : False,
+            'merge-prefixes'                : False,
+            'sequence-db'                   : None,
+            'reparse'                       : False,
 
             'summary-file'      : None,
 
@@ -96,6 +115,11 @@ def get_default_options(command, fillin=False) :
             'wasabi-url'        : 'http://wasabi2.biocenter.helsinki.fi:8000',
             'wasabi-user'       : None,
 
+            'packed-db'         : False,
+            'no-store'          : False,
+            'validation'        : 'fast',
+            'compress'          : None,
+
             'verbose'           : False
            }
 
@@ -112,12 +136,28 @@ def apply_prefix(d, command='all') :
     tmp = join(d['outdir'], tmp)
 
     d['summary-file'] = join(d['outdir'], 'summary.csv')
+    d['similarity-cache'] = join(d['outdir'], 'similarity.cache')
+    d['checkpoint'] = join(d['outdir'], 'cluster.checkpoint')
+    d['sequence-db'] = join(d['outdir'], 'sequences.db')
+
+    # prior.cluster.fasta -> prior.cluster.biom
+    if d['reference'] and not d['reference-biom'] :
+        d['reference-biom'] = find_file(splitext(uncompressed_name(d['reference']))[0] + '.biom')
 
     if not d['cluster-fasta'] :
         d['cluster-fasta']   = tmp + '.cluster.fasta'
 
     if not d['cluster-biom'] :
         d['cluster-biom']    = tmp + '.cluster.biom'
+
+    # cluster output is written with a suffix for its compression (and
+    # without one if it is not compressed), commands that read it find
+    # it with or without one
+    for i in ('cluster-fasta', 'cluster-biom') :
+        if d['compress'] :
+            d[i] = compressed_name(d[i], d['compress'])
+        elif command in ('label', 'showcounts', 'showlabels', 'phylogeny', 'heatmap', 'wasabi') :
+            d[i] = find_file(d[i])
     
     if not d['phylogeny-fasta'] :
         d['phylogeny-fasta'] = tmp + '.phylogeny.fasta'
@@ -129,18 +169,19 @@ def apply_prefix(d, command='all') :
         d['phylogeny-xml'] = tmp + '.phylogeny.xml'
 
 def get_all_programs() :
-    return ['sff2fastq', 'pagan', 'raxml', 'bppphysamp', 'exonerate', 'uchime', 'blastn', 'makeblastdb', 'PyroDist', 'FCluster', 'PyroNoise']
+    return ['pagan', 'raxml', 'bppphysamp', 'exonerate', 'uchime', 'blastn', 'makeblastdb', 'PyroDist', 'FCluster', 'PyroNoise']
 
 def test_system(command=None, options=None, exit_on_failure=False, output=False) :
     binaries = { 
         'preprocess' : {
-            '*'         : ['sff2fastq'],
             'chimeras'  : ['uchime'],
             'denoise'   : ['PyroDist', 'FCluster', 'PyroNoise'],
+            'compress'  : ['xz']
         },
         'cluster' : {
-            '*'         : ['pagan'],
-            'labels'    : ['blastn', 'makeblastdb']
+            'aligner'   : ['pagan'],
+            'labels'    : ['blastn', 'makeblastdb'],
+            'compress'  : ['xz']
         },
         'label' : {
             '*'         : ['blastn', 'makeblastdb']
@@ -164,13 +205,28 @@ def test_system(command=None, options=None, exit_on_failure=False, output=False)
             if 'not found' in s :
                 print >> stderr, s.lstrip()
 
+    def needed(o) :
+        # the native denoiser does not use ampliconnoise
+        if (o == 'denoise') and (options['denoiser'] == 'native') :
+            return False
+
+        # nor does the banded aligner need pagan
+        if o == 'aligner' :
+            return options['aligner'] in ('pagan', 'pagan-batch')
+
+        # gzip and bz2 can be written without an external program
+        if o == 'compress' :
+            return options['compress'] == 'xz'
+
+        return options[o]
+
     fail = False
 
     for b in [command] if command else binaries :
         if binaries[b] :
             print_out("checking system for %s command dependancies :" % bold(b))
             for o in binaries[b] :
-                if o == '*' or not options or options[o] :
+                if o == '*' or not options or needed(o) :
                     for p in binaries[b][o] :
                         installed = System.is_installed(p)
                         print_out("    %s %s%s" % (p, "" if o == "*" else "(needed for --%s) " % o, 
@@ -237,8 +293,14 @@ Legal commands are %s (see below for options).
     print >> stderr, """    Common options:
         -o DIR          --outdir=DIR            (default = %s)
         -p FILEPREFIX   --prefix=FILEPREFIX     (default = %s, overrided by biom,tree,clusters,xml)
+                        --packeddb              (store unique sequences packed 2 bits per base)
+                        --validation=X          (default = %s, options = (full, fast, off), 
+                                                 checks of input files, fast does not check sequences)
+                        --compress=X            (default = none, options = (gzip, bz2, xz), compress .sample, 
+                                                 cluster fasta and biom files, compressed input is always read)
+                        --threads=NUM           (default = %s, preprocess splits large input files between threads)
         -v              --verbose\n""" % \
-                (options['outdir'], options['prefix'])
+                (options['outdir'], options['prefix'], options['validation'], str(options['threads']))
 
     if command in ('preprocess','all') :
         print >> stderr, """    Preprocess options:
@@ -259,7 +321,12 @@ Legal commands are %s (see below for options).
         -w NUM          --windowlength=NUM      (default = %s)
 
         -d              --denoise               (default = %s)
-                        --chimeras              (default = %s)\n""" % \
+                        --denoiser=X            (default = %s, options = (ampliconnoise, native), native 
+                                                 does not need PyroDist, FCluster or PyroNoise)
+                        --lookup=FILE           (default = LookUp.dat next to PyroDist if it is installed, 
+                                                 flowgram signal probabilities for --denoiser=native)
+                        --chimeras              (default = %s)
+                        --nostore               (do not write OUTDIR/sequences.db, cluster will parse the .sample files)\n""" % \
                (str(options['forwardprimer']),
                 str(options['reverseprimer']),
                 str(options['clipprimers']),
@@ -273,6 +340,7 @@ Legal commands are %s (see below for options).
                 str(options['quality']), 
                 str(options['windowlength']),
                 str(options['denoise']),
+                options['denoiser'],
                 str(options['chimeras']))
 
     if command in ('cluster','all') :
@@ -283,19 +351,41 @@ Legal commands are %s (see below for options).
         -b NUM          --samples=NUM           (default = %s)
         -c NUM          --duplicates=NUM        (default = %s)
         
-        -t REAL         --similarity=REAL       (default = %s)
+        -t REAL         --similarity=REAL       (default = %s, comma separated values cluster at each threshold)
         
                         --labels=X              (default = none, options = (none, blast, taxonomy))
                         --cutoff=REAL      (default = 0.95)
                         --mergeclusters         (default = %s)
-                        --nohomopolymer         (default = %s)\n""" % \
+                        --nohomopolymer         (default = %s)
+                        --aligner=X             (default = %s, options = (banded, pagan, pagan-batch),
+                                                 banded runs in-process, check it against pagan on your data
+                                                 with misc/aligner_parity.py before relying on it)
+                        --kmer=NUM              (default = %s, k-mer length used to skip dissimilar centroids, 0 = off,
+                                                 lossy: can miss centroids that differ by long indels, so the
+                                                 clusters can differ from a run without it)
+                        --nocache               (do not cache similarities in OUTDIR/similarity.cache)
+                        --cachesize=NUM         (default = %s, maximum number of cached similarities)
+                        --reference=FILE        (centroids from a previous run, only new samples are clustered
+                                                 and the previous run's biom file is extended)
+                        --resume                (continue from OUTDIR/cluster.checkpoint)
+                        --dereplicate           (cluster sequences that only differ in homopolymer lengths 
+                                                 (or are prefixes of one another) as one)
+                        --mergeprefixes         (merge sequences that are a prefix of another sequence before clustering)
+                        --reparse               (read the .sample files instead of OUTDIR/sequences.db)
+                        --checkpointtime=NUM    (default = %s, seconds between checkpoints, 0 = off)
+                        --checkpointseqs=NUM    (default = %s, sequences between checkpoints, 0 = off)\n""" % \
                (options['metadata'],
                 str(options['total-duplicate-threshold']),
                 str(options['sample-threshold']), 
                 str(options['duplicate-threshold']),
-                str(options['otu-similarity']),
+                ','.join(map(str, options['otu-similarity'])),
                 str(options['merge-blast-hits']),
-                str(options['no-homopolymer-correction']))
+                str(options['no-homopolymer-correction']),
+                options['aligner'],
+                str(options['kmer-length']),
+                str(options['cache-size']),
+                str(options['checkpoint-time']),
+                str(options['checkpoint-seqs']))
 
     if command in ('label', 'all') :
         print >> stderr, """    Label options:
@@ -459,7 +549,25 @@ def parse_args(command, args) :
                             "delimiter=",
                             "missing",
                             "primererrors=",
-                            "ladderise"
+                            "ladderise",
+                            "aligner=",
+                            "kmer=",
+                            "threads=",
+                            "nocache",
+                            "cachesize=",
+                            "reference=",
+                            "resume",
+                            "checkpointtime=",
+                            "checkpointseqs=",
+                            "dereplicate",
+                            "mergeprefixes",
+                            "reparse",
+                            "nostore",
+                            "packeddb",
+                            "validation=",
+                            "compress=",
+                            "denoiser=",
+                            "lookup="
                         ]
                     )
 
@@ -476,6 +584,27 @@ def parse_args(command, args) :
         elif o in ('-v', '--verbose') :
             options['verbose'] = True
 
+        elif o in ('--packeddb',) :
+            options['packed-db'] = True
+
+        elif o in ('--validation',) :
+            modes = ['full', 'fast', 'off']
+            if a in modes :
+                options['validation'] = a
+            else :
+                print >> stderr, "ERROR %s is not a valid validation mode (valid options: %s)" % \
+                        (bold(a), list_sentence(bold_all(modes)))
+                exit(1)
+
+        elif o in ('--compress',) :
+            formats = ['gzip', 'bz2', 'xz']
+            if a in formats :
+                options['compress'] = a
+            else :
+                print >> stderr, "ERROR %s is not a valid compression format (valid options: %s)" % \
+                        (bold(a), list_sentence(bold_all(formats)))
+                exit(1)
+
         elif o in ('-o', '--outdir') :
             options['outdir'] = a
 
@@ -485,6 +614,18 @@ def parse_args(command, args) :
         elif o in ('-d', '--denoise') :
             options['denoise'] = True
 
+        elif o in ('--denoiser',) :
+            denoisers = ['ampliconnoise', 'native']
+            if a in denoisers :
+                options['denoiser'] = a
+            else :
+                print >> stderr, "ERROR %s is not a valid denoiser (valid options: %s)" % \
+                        (bold(a), list_sentence(bold_all(denoisers)))
+                exit(1)
+
+        elif o in ('--lookup',) :
+            options['lookup'] = a
+
         elif o in ('-f', '--forwardprimer') :
             options['forwardprimer'] = expect_iupac("forwardprimer", a)
 
@@ -534,7 +675,7 @@ def parse_args(command, args) :
             options['duplicate-threshold'] = expect_int("duplicates", a)
 
         elif o in ('-t', '--similarity') :
-            options['otu-similarity'] = expect_float("similarity", a)
+            options['otu-similarity'] = [ expect_float("similarity", i) for i in a.split(',') ]
 
         elif o in ('--refalignment',) :
             options['silva-fasta'] = a
@@ -638,6 +779,51 @@ def parse_args(command, args) :
         elif o in ('--ladderise',) :
             options['heatmap-ladderise'] = True
 
+        elif o in ('--aligner',) :
+            methods = ['banded', 'pagan', 'pagan-batch']
+            if a in methods :
+                options['aligner'] = a
+            else :
+                print >> stderr, "ERROR %s is not a valid aligner (valid options: %s)" % \
+                        (bold(a), list_sentence(bold_all(methods)))
+                exit(1)
+
+        elif o in ('--kmer',) :
+            options['kmer-length'] = expect_int("kmer", a)
+
+        elif o in ('--threads',) :
+            options['threads'] = expect_int("threads", a)
+
+        elif o in ('--nocache',) :
+            options['no-cache'] = True
+
+        elif o in ('--cachesize',) :
+            options['cache-size'] = expect_int("cachesize", a)
+
+        elif o in ('--reference',) :
+            options['reference'] = a
+
+        elif o in ('--resume',) :
+            options['resume'] = True
+
+        elif o in ('--checkpointtime',) :
+            options['checkpoint-time'] = expect_int("checkpointtime", a)
+
+        elif o in ('--checkpointseqs',) :
+            options['checkpoint-seqs'] = expect_int("checkpointseqs", a)
+
+        elif o in ('--dereplicate',) :
+            options['dereplicate'] = True
+
+        elif o in ('--mergeprefixes',) :
+            options['merge-prefixes'] = True
+
+        elif o in ('--reparse',) :
+            options['reparse'] = True
+
+        elif o in ('--nostore',) :
+            options['no-store'] = True
+
         else :
             assert False, "unhandled option %s" % o
 
@@ -664,11 +850,18 @@ def check_options(command, options, log) :
         if not system.check_files(options['input-files']) :
             exit(1)
 
+        if options['threads'] <= 0 :
+            log.error("threads must be > 0 (read %d)" % options['threads'])
+            exit(1)
+
         if options['denoise'] :
             if not options['forwardprimer'] :
                 log.error("for denoising you must specify the forward primer!")
                 exit(1)
 
+            if options['lookup'] and not system.check_file(options['lookup']) :
+                exit(1)
+
     elif command == 'cluster' :
         #if options['metadata'] is None :
         #    print >> stderr, "Error: you must specify a metadata file"
@@ -677,16 +870,34 @@ def check_options(command, options, log) :
         if (options['metadata'] is not None) and (not system.check_file(options['metadata'])) :
             exit(1)
 
-        for i in ('duplicate-threshold', 'total-duplicate-threshold', 'sample-threshold') :
+        for i in ('duplicate-threshold', 'total-duplicate-threshold', 'sample-threshold', 'threads') :
             if options[i] <= 0 :
                 log.error("%s must be > 0 (read %d)" % (i, options[i]))
                 exit(1)
 
         # i think pagan's sensitivity limit is ~80%
-        if options['otu-similarity'] < 0.8 or options['otu-similarity'] > 1.0 :
-            log.error("similarity must be between 0.8 and 1.0 (read %.2f)" % options['otu-similarity'])
+        for i in options['otu-similarity'] :
+            if i < 0.8 or i > 1.0 :
+                log.error("similarity must be between 0.8 and 1.0 (read %.2f)" % i)
+                exit(1)
+
+        for i in ('kmer-length', 'checkpoint-time', 'checkpoint-seqs') :
+            if options[i] < 0 :
+                log.error("%s must be >= 0 (read %d)" % (i, options[i]))
+                exit(1)
+
+        if len(set(options['otu-similarity'])) != len(options['otu-similarity']) :
+            log.error("similarity thresholds must be unique")
             exit(1)
 
+        if options['reference'] :
+            if len(options['otu-similarity']) != 1 :
+                log.error("--reference can only be used with a single similarity threshold")
+                exit(1)
+
+            if not system.check_files([options['reference'], options['reference-biom']]) :
+                exit(1)
+
         if options['labels'] :
             if options['labels'] == 'blastlocal' :
                 if not options['labels_db'] :
@@ -0,0 +1,132 @@
+import re
+
+from seance.datatypes import IUPAC
+
+
+class PrimerSearch(object) :
+    """approximate search for a degenerate primer
+
+    a match with at most errors edits must contain at least one of
+    errors + 1 pieces of the primer unchanged, so each piece is compiled
+    to a regular expression (a character class per IUPAC code) and only
+    offsets near an exact piece are checked with IUPAC.close_enough, giving
+    the same offsets as checking every offset"""
+
+    complement = {
+        'A' : 'T', 'C' : 'G', 'G' : 'C', 'T' : 'A', 'U' : 'A',
+        'M' : 'K', 'R' : 'Y', 'W' : 'W', 'S' : 'S', 'Y' : 'R', 'K' : 'M',
+        'V' : 'B', 'H' : 'D', 'D' : 'H', 'B' : 'V', 'N' : 'N', '-' : '-'
+    }
+
+    def __init__(self, primer, errors) :
+        self.primer = primer
+        self.errors = errors
+        self.pieces = [] # (offset in primer, compiled piece)
+
+        npieces = errors + 1
+
+        # primers shorter than that cannot be seeded,
+        # every offset gets checked
+        if (errors >= 0) and (len(primer) >= npieces) :
+            for i in range(npieces) :
+                start = (i * len(primer)) / npieces
+                end = ((i + 1) * len(primer)) / npieces
+                self.pieces.append((start, re.compile("(?=%s)" % self.pattern(primer[start:end]))))
+
+    @staticmethod
+    def pattern(s) :
+        tmp = []
+
+        for c in s :
+            codes = ''.join([ x for x in IUPAC.codes if IUPAC.equal(c, x) ])
+            tmp.append(("[%s]" % codes) if codes else "(?!)")
+
+        return ''.join(tmp)
+
+    @staticmethod
+    def reverse_complement(s) :
+        return ''.join([ PrimerSearch.complement.get(c, 'N') for c in s[::-1] ])
+
+    def __candidates(self, sequence) :
+        n = len(self.primer)
+        last = len(sequence) - n
+
+        if last <= 0 :
+            return []
+
+        if not self.pieces :
+            return range(last)
+
+        tmp = set()
+
+        for offset,piece in self.pieces :
+            for m in piece.finditer(sequence) :
+                i = m.start() - offset
+                tmp.update(range(max(0, i - self.errors), min(last, i + self.errors + 1)))
+
+        # close to the end the match can run out of sequence before
+        # the primer is used up, then the pieces do not help
+        tmp.update(range(max(0, last - self.errors), last))
+
+        return sorted(tmp)
+
+    def __verify(self, sequence, i) :
+        # no match uses more than len(primer) + errors bases
+        return IUPAC.close_enough(self.primer, sequence[i : i + len(self.primer) + self.errors + 1], self.errors)
+
+    def find_all(self, sequence) :
+        """offsets i < len(sequence) - len(primer) where the primer matches"""
+        return [ i for i in self.__candidates(sequence) if self.__verify(sequence, i) ]
+
+    def first(self, sequence) :
+        for i in self.__candidates(sequence) :
+            if self.__verify(sequence, i) :
+                return i
+
+        return -1
+
+    def last(self, sequence) :
+        for i in self.__candidates(sequence)[::-1] :
+            if self.__verify(sequence, i) :
+                return i
+
+        return -1
+
+class StrandedPrimerSearch(object) :
+    """searches for a primer and its reverse complement"""
+
+    def __init__(self, primer, errors) :
+        self.forward = PrimerSearch(primer, errors)
+        self.reverse = PrimerSearch(PrimerSearch.reverse_complement(primer), errors)
+
+    def find_all(self, sequence) :
+        """(offset, strand) of every match on either strand, offsets are on
+        the given sequence, strand is '+' or '-'"""
+        return sorted([ (i, '+') for i in self.forward.find_all(sequence) ] + \
+                      [ (i, '-') for i in self.reverse.find_all(sequence) ])
+
+    def first(self, sequence) :
+        """(offset, strand) of the first match on the forward strand, or of
+        the first on the reverse strand if there is none, (-1, None) if the
+        primer is on neither"""
+        i = self.forward.first(sequence)
+        if i != -1 :
+            return i, '+'
+
+        i = self.reverse.first(sequence)
+        if i != -1 :
+            return i, '-'
+
+        return -1, None
+
+    def orient(self, sequence) :
+        """(sequence, offset) with the sequence turned around if the primer is
+        only on its reverse strand and the offset of the first match in it,
+        offset is -1 if the primer is on neither strand"""
+        i,strand = self.first(sequence)
+
+        if strand == '-' :
+            sequence = PrimerSearch.reverse_complement(sequence)
+            i = self.forward.first(sequence)
+
+        return sequence, i
@@ -4,28 +4,60 @@ import os
 import copy
 import math
 import logging
+import multiprocessing
 
 from functools import total_ordering
 
 from seance.filetypes import FastqFile
+from seance.compression import open_file, compressed_name
 from seance.tools import Uchime
 from seance.filters import Filter
-from seance.db import SequenceDB
+from seance.db import SequenceDB, SequenceDict
 
 
+def _filter_range(args) :
+    # filters the reads in one byte range of a file in a worker process,
+    # duplicates are merged and sequences are returned in the order they 
+    # were first seen, so keys are the same as reading the file in one go
+    fname,start,end,filters,validation = args
+
+    fastq = FastqFile(fname, validation=validation)
+    db = SequenceDict()
+
+    fastq.open(start, end)
+
+    for seq in fastq :
+        if filters.accept(seq) :
+            db.put(seq)
+
+    fastq.close()
+
+    return [ db.get(key) for key in sorted(db.db) ], filters.counts, filters.cache_counts()
+
 class Sample(object) :
-    def __init__(self, fastq, outdir, seqdb, filters=None, chimeras=False) :
+    # the smallest part of a file worth reading in another process
+    range_size = 1 << 24
+
+    def __init__(self, fastq, outdir, seqdb, filters=None, chimeras=False, seqcounts=None, threads=1) :
         self.log = logging.getLogger('seance')
         self.fastq = fastq
         self.outdir = outdir
         self.filters = filters
         self.db = seqdb
+        self.threads = threads
 
         self.seqcounts = collections.Counter()
         self.chimeras = []
 
-        if self.filters != None :
-            self.__filter_load()
+        # counts from the sequence store do not need the file to be read
+        if seqcounts is not None :
+            self.seqcounts = seqcounts
+
+        elif self.filters != None :
+            if self.threads > 1 :
+                self.__parallel_filter_load()
+            else :
+                self.__filter_load()
 
             if chimeras :
                 self.__detect_chimeras()
@@ -40,6 +72,16 @@ class Sample(object) :
     def __contains__(self, seqkey) :
         return seqkey in self.seqcounts
 
+    def remap(self, translation) :
+        # after the database merged sequences, see SequenceDB.dereplicate
+        tmp = collections.Counter()
+
+        for key,freq in self.seqcounts.iteritems() :
+            tmp[translation.get(key, key)] += freq
+
+        self.seqcounts = tmp
+        self.chimeras = [ translation.get(key, key) for key in self.chimeras ]
+
     # True if at least one of the keys is present
     def contains(self, keys) :
         for k in keys :
@@ -59,7 +101,38 @@ class Sample(object) :
 
         self.fastq.close()
 
-        #self.log.info("filter results\n" + str(self.filters))
+        self.log.info("filter results\n" + str(self.filters))
+        self.log.info("accepted %d sequences" % (sum(self.seqcounts.values())))
+
+    def __parallel_filter_load(self) :
+        # the file is split into byte ranges that are filtered in parallel
+        # and merged in order
+        size = os.path.getsize(self.fastq.get_filename())
+        ranges = self.fastq.ranges(min(self.threads * 4, size / self.range_size))
+
+        if len(ranges) == 1 :
+            self.__filter_load()
+            return
+
+        self.log.info("reading %s in %d parts" % (self.fastq.get_filename(), len(ranges)))
+
+        # tasks are pickled while results are merged into self.filters,
+        # so they all get one copy taken before anything is merged
+        filters = self.filters.fresh_copy()
+        tasks = [ (self.fastq.get_filename(), start, end, filters, self.fastq.validation) for start,end in ranges ]
+        pool = multiprocessing.Pool(self.threads)
+
+        try :
+            for seqs,counts,cache_counts in pool.imap(_filter_range, tasks) :
+                for seq in seqs :
+                    self.seqcounts[self.db.put(seq)] += seq.duplicates
+
+                self.filters.add_counts(counts, cache_counts)
+
+        finally :
+            pool.terminate()
+
+        self.log.info("filter results\n" + str(self.filters))
         self.log.info("accepted %d sequences" % (sum(self.seqcounts.values())))
 
     def __raw_load(self) :
@@ -92,8 +165,9 @@ class Sample(object) :
         self.log.info("%d chimeric sequences" % len(self.chimeras))
         self.log.info("%d sequences in sample (minus chimeras)" % len(self))
 
-    def print_sample(self, duplicate_label=" NumDuplicates", extension=".sample") :
-        f = open(os.path.join(self.outdir, self.fastq.get_basename() + extension), 'w')
+    def print_sample(self, duplicate_label=" NumDuplicates", extension=".sample", compression=None) :
+        fname = compressed_name(os.path.join(self.outdir, self.fastq.get_basename() + extension), compression)
+        f = open_file(fname, 'w', compression)
 
         for key,freq in self.seqcounts.most_common() :
             if key not in self.chimeras :
@@ -102,7 +176,7 @@ class Sample(object) :
 
         f.close()
 
-        return f.name
+        return fname
     
     def __len__(self) :
         return sum([freq for key,freq in self.seqcounts.most_common() if key not in self.chimeras])
@@ -113,17 +187,22 @@ class Sample(object) :
 
 @total_ordering
 class MetadataSample(Sample) :
-    def __init__(self, fastq, outdir, seqdb, metadata) :
-        super(MetadataSample, self).__init__(fastq, outdir, seqdb)
+    def __init__(self, fastq, outdir, seqdb, metadata, seqcounts=None) :
+        super(MetadataSample, self).__init__(fastq, outdir, seqdb, seqcounts=seqcounts)
         self.metadata = metadata
 
     def description(self) :
-        if (self.metadata['id'], self.metadata['location'], self.metadata['lemur']) == ('','','') :
-            return self.metadata['file']
+        return MetadataSample.describe(self.metadata)
+
+    @staticmethod
+    def describe(metadata) :
+        # available before the sample is loaded
+        if (metadata['id'], metadata['location'], metadata['lemur']) == ('','','') :
+            return metadata['file']
 
-        d = self.metadata['date']
+        d = metadata['date']
         date = '/'.join(map(str, [d.day, d.month, d.year]))
-        return ' '.join([self.metadata['id'], self.metadata['location'], self.metadata['lemur'], date])
+        return ' '.join([metadata['id'], metadata['location'], metadata['lemur'], date])
 
     def __eq__(self, other) :
         return (self.metadata['location'], self.metadata['lemur'], self.metadata['date']) == \
@@ -2,6 +2,8 @@ import sys
 import logging
 import json
 import collections
+import multiprocessing
+import itertools
 
 from copy import deepcopy
 from os.path import join
@@ -10,11 +12,23 @@ from seance.tools import Pagan
 from seance.datatypes import Sequence, IUPAC
 from seance.filetypes import FastqFile
 from seance.progress import Progress
+from seance.distance import identity
+from seance.primers import StrandedPrimerSearch
 
 import dendropy
 from dendropy import treecalc
 
 
+# primer search in worker processes
+_searcher = None
+
+def _init_primer_search(primer, errors) :
+    global _searcher
+    _searcher = StrandedPrimerSearch(primer, errors)
+
+def _primer_position(seq) :
+    return _searcher.orient(seq)
+
 class IdentifiabilityScore(object) :
     def __init__(self) :
         self.log = logging.getLogger('seance')
@@ -24,18 +38,14 @@ class IdentifiabilityScore(object) :
             for label,seq in seqs :
                 print >> f, ">%s\n%s" % (label, seq)
 
-    def read_nematodes(self, fastq_fname, fprimer, rprimer, diffs, length) :
+    def read_nematodes(self, fastq_fname, fprimer, rprimer, diffs, length, threads=1) :
         tmp = []
         acc2name = {}
 
-        # read in sequences
+        # read in sequences, only the nematodes are read using the index
         fq = FastqFile(fastq_fname)
-        fq.open()
 
-        for seq in fq :
-            if 'Nematoda' not in seq.id :
-                continue
-    
+        for seq in fq.select([ e.name for e in fq.index() if 'Nematoda' in e.description ]) :
             seq.ungap()
             seq.back_translate()
 
@@ -44,57 +54,45 @@ class IdentifiabilityScore(object) :
     
             acc2name[new_id] = seq.id[seq.id.find('Nematoda'):]
 
-        fq.close()
-
 
         # test sequences
-        p = Progress("Looking for primer sequences", len(tmp), False)
+        p = Progress("Looking for primer sequences", len(tmp))
         p.start()
 
+        seqs = [ seq for label,seq in tmp ]
         tmp2 = []
+        pool = None
+
+        try :
+            if threads > 1 :
+                pool = multiprocessing.Pool(threads, _init_primer_search, (fprimer, diffs))
+                positions = pool.imap(_primer_position, seqs, chunksize=max(1, len(seqs) / (4 * threads)))
+            else :
+                search = StrandedPrimerSearch(fprimer, diffs)
+                positions = ( search.orient(seq) for seq in seqs )
 
-        for label,seq in tmp :
-            findex = IUPAC.seq_position(fprimer, seq, diffs)
- 
-            if findex != -1 :
-                #if IUPAC.seq_position_reverse(rprimer, seq, diffs) != -1 :
+            # sequences with the primer on the reverse strand come back
+            # reverse complemented
+            for label,(seq,findex) in itertools.izip([ label for label,seq in tmp ], positions) :
+                if findex != -1 :
+                    #if IUPAC.seq_position_reverse(rprimer, seq, diffs) != -1 :
 
-                shortseq = seq[findex + len(fprimer) : findex + len(fprimer) + length]
-                if 'N' not in shortseq :
-                    tmp2.append((label, shortseq))          
+                    shortseq = seq[findex + len(fprimer) : findex + len(fprimer) + length]
+                    if 'N' not in shortseq :
+                        tmp2.append((label, shortseq))          
 
-            p.increment()
+                p.increment()
+
+        finally :
+            if pool is not None :
+                pool.terminate()
 
         p.end()
 
         return tmp2,acc2name
 
-    # XXX   this code is duplicated so many places with tiny tweaks, 
-    #       maybe abstract out...
     def distance(self, aligned) :
-        leng = float(min(len(aligned[0]), len(aligned[1])))
-
-        last_gap = True
-        diff = 0
-
-        for c1,c2 in zip(aligned[0], aligned[1]) :
-            if (c1 == '-') and (c2 == '-') :
-                continue
-
-            gap = '-' in (c1,c2)
-
-            if last_gap and gap :
-                continue
-
-            if not IUPAC.equal(c1, c2) :
-                diff += 1
-
-            last_gap = gap
-
-        if last_gap :
-            diff -= 1
-
-        return (leng - diff) / leng
+        return identity([aligned], iupac=True, ignore_double_gaps=True)[0]
 
     def build_distance_matrix(self, fname) :
         tmp = []
@@ -114,10 +112,15 @@ class IdentifiabilityScore(object) :
         for index, labelseq in enumerate(tmp) :
             label1,seq1 = labelseq
             dist[(label1,label1)] = 1.0
-            for label2,seq2 in tmp[index+1:] :
+
+            # whole row at once
+            rest = tmp[index+1:]
+            sims = identity([ [seq1,seq2] for label2,seq2 in rest ], iupac=True, ignore_double_gaps=True)
+
+            for (label2,seq2),sim in zip(rest, sims) :
                 dist[(label1,label2)] = \
                         dist[(label2,label1)] = \
-                        self.distance([seq1,seq2])
+                        sim
                 
                 p.increment()
 
@@ -194,11 +197,11 @@ class IdentifiabilityScore(object) :
 
         return tmp
 
-    def score(self, silva_fasta, silva_tree, outdir, fprimer, rprimer=None, diffs=2, length=250, threshold=0.99) :
+    def score(self, silva_fasta, silva_tree, outdir, fprimer, rprimer=None, diffs=2, length=250, threshold=0.99, threads=1) :
         # read nematodes that the primer would hit, trim to length
         # seqs is list of tuples [(label,seq), (label,seq), ...]
         self.log.info("extracting sequences that match '%s' from '%s' ..." % (fprimer, silva_fasta))
-        seqs,acc2name = self.read_nematodes(silva_fasta, fprimer, rprimer, diffs, length)
+        seqs,acc2name = self.read_nematodes(silva_fasta, fprimer, rprimer, diffs, length, threads)
 
         # write out nematodes and align using the silva tree
         self.log.info("aligning with pagan...")
@@ -311,5 +314,5 @@ class IdentifiabilityScore(object) :
 #                    print >> f, t1.label, t2.label, pdm(t1,t2), dist[(t1.label,t2.label)]
 
 if __name__ == '__main__' :
-    IdentifiabilityScore().score('SSU_reference_l5_Silva.fasta', 'SSU_reference_l5_Silva.tree', '.', 'AGRGGTGAAATYCGTGGAC', 'TCTCGCTCGTTATCGGAAT', 2, 250, 0.99)
+    IdentifiabilityScore().score('SSU_reference_l5_Silva.fasta', 'SSU_reference_l5_Silva.tree', '.', 'AGRGGTGAAATYCGTGGAC', 'TCTCGCTCGTTATCGGAAT', 2, 250, 0.99, multiprocessing.cpu_count())
 
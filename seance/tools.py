@@ -11,10 +11,13 @@ import collections
 import socket
 import xml.sax
 
+import numpy
+
 from os.path import abspath, join, dirname
 from seance.filetypes import SffFile, FastqFile
 from seance.datatypes import IUPAC
 from seance.progress import Progress
+from seance.denoise import FlowgramDenoiser, DenoiserError
 
 
 class ExternalProgramError(Exception) :
@@ -61,28 +64,6 @@ class ExternalProgram(object) :
         if retcode != 0 :
             raise ExternalProgramError("'%s' return code %d" % (' '.join(command.split()), retcode))
 
-class Sff2Fastq(ExternalProgram) :
-    def __init__(self) :
-        super(Sff2Fastq, self).__init__('sff2fastq')
-        self.command = "sff2fastq -o %s %s"
-
-    def run(self, sff, outdir) :
-        if not isinstance(sff, SffFile) :
-            raise ExternalProgramError("argument is not an SffFile")
-
-        fastq_fname = outdir + os.sep + sff.get_basename() + ".fastq"
-
-        self.log.info("running sff2fastq (%s, %s)" % (sff.get_filename(), fastq_fname))
-
-        try :
-            self.system(self.command % (fastq_fname, sff.get_filename()))
-        
-        except ExternalProgramError, epe :
-            self.log.error(str(epe))
-            sys.exit(1)
-        
-        return FastqFile(fastq_fname)
-
 class GetMID2(object) :
     def __init__(self, length) :
         self.length = length
@@ -411,27 +392,19 @@ class BlastN(ExternalProgram) :
             sys.exit(1)
 
         # build query_name -> query_length dict
+        # (both come from the index, sequences are not read)
         query_length = {}
-        f = FastqFile(fasta_fname)
-        f.open()
-        for s in f :
-            query_name = s.id[1:s.id.index(' ')] if ' ' in s.id else s.id[1:]
-            query_length[query_name] = float(len(s))
-
-        f.close()
+        for e in FastqFile(fasta_fname).index() :
+            query_length[e.name] = float(e.seqlen)
         # built
 
         if db_fname is not None :
             print "reading %s ..." % db_fname
             acc2tax = {}
-            f = FastqFile(db_fname)
-            f.open()
-            for s in f :
-                acc,tax = s.id.strip().split(' ', 1)
-                if ";" not in tax :
-                    print "Warning: sequence with accession %s has strange taxonomical identifier (%s)" % (acc[1:], tax)
-                acc2tax[acc[1:]] = tax
-            f.close()
+            for e in FastqFile(db_fname).index() :
+                if ";" not in e.description :
+                    print "Warning: sequence with accession %s has strange taxonomical identifier (%s)" % (e.name, e.description)
+                acc2tax[e.name] = e.description
             print "%d database sequences map to %d taxonomical identifiers..." % (len(acc2tax), len(set(acc2tax.values())))
 
             self.make_local_db(db_fname)
@@ -595,100 +568,92 @@ class AmpliconNoise(ExternalProgram) :
         return err_count <= errors
 
     def close_enough(self, primer, sequence, diff) :
-        if diff < 0 :
-            return False
+        return IUPAC.close_enough(primer, sequence, diff)
 
-        if (len(primer) == 0) or (len(sequence) == 0) :
-            return True
+    @staticmethod
+    def flowgram_lengths(flows, max_homopolymer) :
+        """flows is a (reads x flows) array of flowgrams (100 x signal), returns
+        the number of flows in whole cycles of four before the first cycle 
+        with a weak signal (0.5 - 0.7) or no signal at all, at most 450. flows 
+        after one longer than max_homopolymer do not count in its cycle"""
+        cycles = flows.shape[1] / 4
+        f = flows[:, : cycles * 4].reshape(len(flows), cycles, 4) / 100.0
 
-        m = IUPAC.equal(sequence[0], primer[0])
+        counted = numpy.cumsum((f + 0.5).astype(numpy.int64) > max_homopolymer, axis=2) == 0
+        signal = counted & (f > 0.5)
+        noise = signal & (f < 0.7)
 
-        return self.close_enough(primer[1:], sequence[1:], diff if m else diff-1) or \
-               self.close_enough(primer[1:], sequence, diff-1) or \
-               self.close_enough(primer, sequence[1:], diff-1)
+        good = signal.any(axis=2) & ~noise.any(axis=2)
 
-    def extract(self, sff, outdir, primer, primer_errors, barcode, barcode_errors, max_homopolymer) :
-        try :
-            from Bio import SeqIO
-        except ImportError :
-            print >> sys.stderr, "BioPython not installed (only required for working with SFF files)"
-            sys.exit(1)
+        return numpy.minimum(numpy.logical_and.accumulate(good, axis=1).sum(axis=1) * 4, 450)
 
+    def extract(self, sff, outdir, primer, primer_errors, barcode, barcode_errors, max_homopolymer) :
         barcode_len = len(barcode)
         primer_len = len(primer)
 
         raw_seq_total = 0
+        kept = 0
 
-        names = []
-        flows = []
-        flowlens = []
-
-        for record in SeqIO.parse(sff.get_filename(), "sff") :
-            raw_seq_total += 1
-            good_bases = record.seq[record.annotations["clip_qual_left"] : record.annotations["clip_qual_right"]]
-            barcode_seq = good_bases[:barcode_len]
-            primer_seq = good_bases[barcode_len : barcode_len + primer_len]
-
-            new_length = 0
+        # flows are formatted by lookup, the table grows to the largest flow seen
+        table = numpy.array([], dtype=object)
 
-            for i in range(0, len(record.annotations["flow_values"]), 4) : 
-                signal = 0
-                noise = 0
+        # the header needs the number of sequences, so it is written 
+        # after everything else has been
+        fname = join(outdir, "flows.dat")
+        tmp = open(fname + '.tmp', 'w')
 
-                for j in range(4) :
-                    f = float(record.annotations["flow_values"][i + j]) / 100.0
-
-                    if int(f + 0.5) > max_homopolymer :
-                        break
-
-                    if f > 0.5 :
-                        signal += 1
-                        if f < 0.7 :
-                            noise += 1
-
-                if noise > 0 or signal == 0 :
-                    break
+        for reads,flows in sff.flowgrams() :
+            raw_seq_total += len(reads)
+            lengths = self.flowgram_lengths(flows, max_homopolymer)
+            lines = []
 
-                new_length += 1
+            for i in numpy.flatnonzero(lengths >= 360) :
+                record = reads[i]
+                good_bases = record.sequence(trim=False)[record.clip_qual_left : record.clip_qual_right]
+                barcode_seq = good_bases[:barcode_len]
+                primer_seq = good_bases[barcode_len : barcode_len + primer_len]
 
-            new_length *= 4
+                if IUPAC.close_enough(barcode, barcode_seq, barcode_errors) and \
+                        IUPAC.close_enough(primer, primer_seq, primer_errors) :
 
-            if new_length > 450 :
-                new_length = 450
+                    if flows[i].max() >= len(table) :
+                        table = numpy.array([ "%.2f" % (float(j) / 100.0) for j in range(flows[i].max() + 1) ], dtype=object)
 
-            if new_length >= 360 and \
-                    IUPAC.close_enough(barcode, barcode_seq, barcode_errors) and \
-                    IUPAC.close_enough(primer, primer_seq, primer_errors) :
-                flows.append(record.annotations["flow_values"])
-                flowlens.append(new_length)
-                names.append(record.id)
+                    lines.append(" ".join([ record.name, str(lengths[i]) ] + table[flows[i]].tolist()))
 
+            if lines :
+                tmp.write("\n".join(lines) + "\n")
+                kept += len(lines)
 
+        tmp.close()
 
-        if len(flows) == 0 :
+        if kept == 0 :
+            os.remove(tmp.name)
             self.log.info("kept 0/%d sequences" % raw_seq_total)
             return 0, None
 
         # output pyronoise input file
         # see http://userweb.eng.gla.ac.uk/christopher.quince/Software/PyroNoise.html
-        f = open(join(outdir, "flows.dat"), 'w')
+        f = open(fname, 'w')
 
-        print >> f, "%d %d" % (len(flows), max([ len(i) for i in flows ]))
-        for i in range(len(flows)) :
-            print >> f, " ".join([ names[i], str(flowlens[i]) ] + [ "%.2f" % (float(i) / 100.0) for i in flows[i] ])
+        print >> f, "%d %d" % (kept, sff.number_of_flows)
+
+        with open(tmp.name) as tmp :
+            shutil.copyfileobj(tmp, f, 1 << 20)
 
         f.close()
+        os.remove(tmp.name)
 
-        self.log.info("kept %d/%d sequences" % (len(flows), raw_seq_total))
-        return len(flows), f.name
+        self.log.info("kept %d/%d sequences" % (kept, raw_seq_total))
+        return kept, f.name
 
-    def run(self, sff, outdir, forward_primer, barcode, barcode_errors, max_homopolymer) :
+    def run(self, sff, outdir, forward_primer, primer_errors, barcode, barcode_errors, max_homopolymer, denoiser='ampliconnoise', lookup=None, threads=1) :
         if not isinstance(sff, SffFile) :
             raise ExternalProgramError("argument is not an SffFile")
 
         output_name = abspath(join(outdir, sff.get_basename() + '.fasta'))
 
-        numseq,fname = self.extract(sff, outdir, forward_primer, barcode, barcode_errors, max_homopolymer)
+        numseq,fname = self.extract(sff, outdir, forward_primer, primer_errors, barcode, barcode_errors, max_homopolymer)
 
         # just so the rest of the pipeline can be run and there be a record
         # of the sample containing zero sequences
@@ -699,16 +664,10 @@ class AmpliconNoise(ExternalProgram) :
         # well... this is a mess
         # PyroDist does not like being given 1 sequence
         if numseq == 1 :
-            try :
-                from Bio import SeqIO
-            except ImportError: 
-                print >> sys.stderr, "BioPython not installed (only required for working with SFF files)"
-                sys.exit(1)
-
             fout = open(output_name, 'w')
 
-            for r in SeqIO.parse(sff.get_filename(), 'sff-trim') :
-                print >> fout, ">seq0 NumDuplicates=1\n%s" % r.seq
+            for r in sff.reads() :
+                print >> fout, ">seq0 NumDuplicates=1\n%s" % r.sequence()
             
             fout.close()
             
@@ -716,9 +675,22 @@ class AmpliconNoise(ExternalProgram) :
 
         outfile = join(outdir, "flows")
         
-        distfile = PyroDist().run(fname, outfile)
-        listfile = FCluster().run(distfile, outfile)
-        fafile   = PyroNoise().run(fname, listfile, outfile)
+        if denoiser == 'native' :
+            # the same probabilities as PyroDist and PyroNoise if they are installed
+            if (lookup is None) and ExternalProgram.exists('PyroDist') :
+                tmp = join(dirname(ExternalProgram.get_path('PyroDist')), "LookUp.dat")
+                lookup = tmp if os.path.exists(tmp) else None
+
+            try :
+                FlowgramDenoiser(lookup, threads).run(fname, outfile, sff.flow_chars, sff.key_sequence)
+
+            except DenoiserError, de :
+                self.log.error(str(de))
+                sys.exit(1)
+        else :
+            distfile = PyroDist().run(fname, outfile)
+            listfile = FCluster().run(distfile, outfile)
+            fafile   = PyroNoise().run(fname, listfile, outfile)
 
         # read fa file
         # add NumDulicates fields
@@ -748,7 +720,9 @@ class AmpliconNoise(ExternalProgram) :
         fout.close()
 
         # delete intermediate files
-        shutil.rmtree(outfile)
+        if os.path.isdir(outfile) :
+            shutil.rmtree(outfile)
+
         for fname in glob.glob(outfile + '*') :
             os.remove(fname)
 
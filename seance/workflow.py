@@ -4,6 +4,7 @@ import collections
 import logging
 import operator
 import json
+import copy
 
 from sys import exit
 from os.path import splitext, join, basename, exists
@@ -11,12 +12,15 @@ from glob import glob
 
 from seance.sample import Sample, MetadataSample
 from seance.filetypes import MetadataReader, DataFileError, FastqFile, SffFile
+from seance.compression import open_file, detect, decompress, suffixes
 from seance.datatypes import SampleMetadata
 from seance.filters import *
 from seance.db import SequenceDB
 from seance.progress import Progress
-from seance.tools import Sff2Fastq, GetMID2, Pagan, BlastN, AmpliconNoise
-from seance.cluster import Cluster
+from seance.tools import GetMID2, Pagan, BlastN, AmpliconNoise
+from seance.cluster import Cluster, MultiCluster
+from seance.cache import SimilarityCache
+from seance.checkpoint import Checkpoint, CheckpointError
 from seance.biom import BiomFile
 from seance.heatmap import heatmap as phylogenetic_heatmap
 from seance.wasabi import wasabi as view_in_wasabi
@@ -30,6 +34,9 @@ class WorkFlow(object) :
         self.log = logging.getLogger('seance')
         self.seqdb = None
 
+        # every sequence file is read with the same checks
+        FastqFile.validation = self.options['validation']
+
     def __filters(self, mid) :
         mf = MultiFilter()
 
@@ -76,12 +83,6 @@ class WorkFlow(object) :
 
         return mf
 
-    def __mid_sff(self, sff) :
-        fastq = Sff2Fastq().run(sff, self.options['outdir'])
-        mid = self.__mid_fastq(fastq)
-        os.remove(fastq.get_filename())
-        return mid
-
     def __mid_fastq(self, fastq) :
         #return GetMID(self.options['midlength']).run(fastq.get_filename())
         return GetMID2(self.options['midlength']).run(fastq)
@@ -97,6 +98,7 @@ class WorkFlow(object) :
                     self.log.info("skipping %s (already preprocessed)" % fname)
                     continue
 
+                # sff files are read directly, without converting them to fastq
                 sff = SffFile(fname)
 
                 # annoyingly, mid is figured out twice if we are
@@ -106,13 +108,15 @@ class WorkFlow(object) :
                             self.options['outdir'],
                             self.options['forwardprimer'],
                             self.options['primererrors'],
-                            self.__mid_sff(sff),
+                            self.__mid_fastq(sff),
                             self.options['miderrors'], 
-                            self.options['maxhomopolymer']
+                            self.options['maxhomopolymer'],
+                            denoiser=self.options['denoiser'],
+                            lookup=self.options['lookup'],
+                            threads=self.options['threads']
                             )
                 else :
-                    yield Sff2Fastq().run(sff, 
-                        self.options['outdir'])
+                    yield sff
 
             else :
                 yield FastqFile(fname)
@@ -122,13 +126,19 @@ class WorkFlow(object) :
             self.log.error("nothing to do")
             sys.exit(1)
 
-        self.seqdb = SequenceDB(preprocessed=False)
+        self.seqdb = SequenceDB(preprocessed=False, packed=self.options['packed-db'])
 
         p = Progress("Preprocessing", len(self.options['input-files']))
         p.start()
 
         samples = []
 
+        # read counts are also kept in a store that cluster can open
+        # instead of parsing every .sample file again
+        store = None
+        if not self.options['no-store'] :
+            store = SequenceDB(fname=self.options['sequence-db'])
+
         for f in self.__get_files(self.options['input-files']) :
             mid = self.__mid_fastq(f)
 
@@ -136,15 +146,25 @@ class WorkFlow(object) :
                         self.options['outdir'],
                         self.seqdb, 
                         self.__filters(mid),
-                        chimeras=self.options['chimeras'])
+                        chimeras=self.options['chimeras'],
+                        threads=self.options['threads'])
+
+            fname = sample.print_sample(compression=self.options['compress'])
+
+            # (in the same order as the .sample file)
+            if store is not None :
+                store.add_sample(basename(fname), os.path.getmtime(fname), 
+                        [ (self.seqdb.get(key).sequence, freq) for key,freq in sample.seqcounts.most_common() if key not in sample.chimeras ])
 
-            sample.print_sample()
             samples.append(sample)
 
             p.increment()
 
         p.end()
 
+        if store is not None :
+            store.close()
+
         rejected_reads = sum([ sum(s.filters.counts) for s in samples ])
         accepted_reads = sum([ len(s) for s in samples ])
         unique_seq = sum([ len(s.seqcounts) for s in samples ])
@@ -165,15 +185,49 @@ class WorkFlow(object) :
 
         return 0
 
-    def __preprocessed_samples(self) :
+    def __preprocessed_sample(self, fname, md, stored) :
+        # with stored, counts come from the sequence store and None is
+        # returned if the .sample file changed since it was stored
+        seqcounts = None
+
+        if stored :
+            seqcounts = self.seqdb.get_sample(basename(fname), os.path.getmtime(fname))
+
+            if seqcounts is None :
+                return None
+
+        return MetadataSample(FastqFile(fname), self.options['outdir'], self.seqdb, md, seqcounts=seqcounts)
+
+    def __sample_files(self) :
+        # .sample files written with --compress have a suffix, sorted so
+        # samples are read in the same order whatever the directory order
+        tmp = glob(join(self.options['outdir'], '*.sample'))
+
+        for suffix in suffixes.values() :
+            tmp += glob(join(self.options['outdir'], '*.sample' + suffix))
+
+        return sorted(tmp)
+
+    def __preprocessed_samples(self, exclude=(), stored=False) :
+        # samples whose description is in exclude are not loaded
         if self.options['metadata'] is None :
             tmp = []
-            for sample in glob(join(self.options['outdir'], '*.sample')) :
+            for sample in self.__sample_files() :
                 md = SampleMetadata()
                 md.defaults()
                 s = basename(sample)
                 md['file'] = s[:s.find('.')]
-                tmp.append(MetadataSample(FastqFile(sample), self.options['outdir'], self.seqdb, md))
+
+                if MetadataSample.describe(md) in exclude :
+                    continue
+
+                ms = self.__preprocessed_sample(sample, md, stored)
+
+                if ms is None :
+                    self.log.info("%s is newer than %s" % (basename(sample), self.options['sequence-db']))
+                    return None
+
+                tmp.append(ms)
             return tmp
 
         mdr = MetadataReader(self.options['metadata'])
@@ -182,7 +236,7 @@ class WorkFlow(object) :
         tmp = []
         md_used = []
 
-        for sample in glob(join(self.options['outdir'], '*.sample')) :
+        for sample in self.__sample_files() :
             md = mdr.get(basename(sample))
 
             if md == None :
@@ -194,9 +248,19 @@ class WorkFlow(object) :
                 #self.log.warn("skipping %s, metadata missing..." % basename(sample))
                 #continue
 
-            tmp.append(MetadataSample(FastqFile(sample), self.options['outdir'], self.seqdb, md))
             md_used.append(md['file'])
 
+            if MetadataSample.describe(md) in exclude :
+                continue
+
+            ms = self.__preprocessed_sample(sample, md, stored)
+
+            if ms is None :
+                self.log.info("%s is newer than %s" % (basename(sample), self.options['sequence-db']))
+                return None
+
+            tmp.append(ms)
+
         # warn about used metadata
         for i in mdr.metadata.keys() :
             if i not in md_used :
@@ -214,7 +278,7 @@ class WorkFlow(object) :
         # first collect keys for all sequences that fit number of reads
         for sample in samples :
             for key,freq in sample.seqcounts.most_common() :
-                if self.seqdb.get(key).duplicates >= duplicate_threshold :
+                if self.seqdb.num_duplicates(key) >= duplicate_threshold :
                     ref_count[key] += 1
 
         # then for these keys see how many samples they occurred in
@@ -232,7 +296,7 @@ class WorkFlow(object) :
                 count = 0
 
                 for key,freq in sample.seqcounts.most_common() :
-                    if self.seqdb.get(key).duplicates >= duplicate_threshold :
+                    if self.seqdb.num_duplicates(key) >= duplicate_threshold :
                         if key not in cluster_input_keys :
                             cluster_input_keys.add(key)
                             count += 1
@@ -254,7 +318,7 @@ class WorkFlow(object) :
             is_singleton = sample.metadata['allow-singletons']
 
             for key,freq in sample.seqcounts.most_common() :
-                if is_singleton or (self.seqdb.get(key).duplicates >= duplicate_threshold) :
+                if is_singleton or (self.seqdb.num_duplicates(key) >= duplicate_threshold) :
                     seq2samp[key].append(index)
 
                 if is_singleton :
@@ -262,15 +326,65 @@ class WorkFlow(object) :
 
         return seq2samp, singletons
 
+    def __stored_samples(self, exclude) :
+        # samples from the store written by preprocess, None if it cannot be
+        # used and the .sample files need to be parsed
+        if self.options['reparse'] or not exists(self.options['sequence-db']) :
+            return None
+
+        # the store stays open, sequences are read from it as they are needed
+        self.seqdb = SequenceDB(fname=self.options['sequence-db'])
+        samples = self.__preprocessed_samples(exclude=exclude, stored=True)
+
+        if samples is None :
+            self.seqdb.close()
+            return None
+
+        self.log.info("read %d samples from %s" % (len(samples), self.options['sequence-db']))
+        return samples
+
     def cluster(self) :
-        # rebuild the database from preprocessed samples in outdir
-        self.seqdb = SequenceDB(preprocessed=False) # setting this to true causes things to be overwritten if we merge mulitiple preprocessing steps
-        samples = self.__preprocessed_samples()
-        
+        # with a reference only samples missing from the previous run are
+        # loaded and clustered against the previous centroids
+        reference = None
+        labels = {}
+        clustered_samples = ()
+        prior = None
+
+        # the previous biom file is read once, it may be overwritten by
+        # the output of this run
+        if self.options['reference'] :
+            reference,labels = self.__read_reference(self.options['reference'])
+            prior = BiomFile()
+            prior.read_from(self.options['reference-biom'])
+            clustered_samples = set(prior.samples)
+            self.log.info("read %d centroids and %d samples from previous run" % (len(reference), len(clustered_samples)))
+
+        samples = self.__stored_samples(clustered_samples)
+
+        if samples is None :
+            # rebuild the database from preprocessed samples in outdir
+            self.seqdb = SequenceDB(preprocessed=False, packed=self.options['packed-db']) # setting this to true causes things to be overwritten if we merge mulitiple preprocessing steps
+            samples = self.__preprocessed_samples(exclude=clustered_samples)
+
+        if reference and not samples :
+            self.log.info("no new samples to cluster")
+            return 0
+
         if self.seqdb.num_sequences() == 0 :
             self.log.error("no sequences loaded")
             exit(1)
 
+        # reads that are a prefix of another read are duplicates
+        if self.options['merge-prefixes'] :
+            before = self.seqdb.num_sequences()
+            translation = self.seqdb.dereplicate()
+
+            for sample in samples :
+                sample.remap(translation)
+
+            self.log.info("merged prefixes, %d sequences reduced to %d" % (before, self.seqdb.num_sequences()))
+
         # to prove the rebuild of the database is the same
         #for sample in samples :
         #    sample.print_sample(extension=".rebuild")
@@ -287,45 +401,114 @@ class WorkFlow(object) :
 
         # get some info
 #        num_reads = sum([ self.seqdb.get(i).duplicates for i in input_keys ])
-        num_reads = sum([ self.seqdb.get(i).duplicates for i in input_keys.keys() ])
+        num_reads = sum([ self.seqdb.num_duplicates(i) for i in input_keys.keys() ])
         self.log.info("clustering %d/%d (%.2f%%) sequences (%d/%d (%.2f%%) reads)" % \
                         (len(input_keys), self.seqdb.num_sequences(), \
                         len(input_keys) * 100 / float(self.seqdb.num_sequences()), \
                         num_reads, self.seqdb.num_reads(), \
                         num_reads * 100 / float(self.seqdb.num_reads())))
 
+        # similarities are cached between runs
+        cache = None
+        if not self.options['no-cache'] :
+            cache = SimilarityCache(self.options['similarity-cache'], self.options['cache-size'])
+
         # clustering
-        c = Cluster(self.seqdb, self.options['otu-similarity'], self.options['verbose'])
+        thresholds = self.options['otu-similarity']
+        cluster_args = {
+                'aligner' : self.options['aligner'],
+                'kmer'    : self.options['kmer-length'],
+                'threads' : self.options['threads'],
+                'cache'   : cache,
+                'dereplicate' : self.options['dereplicate']
+            }
+
+        if reference :
+            cluster_args['reference'] = reference
+            cluster_args['reference_abundance'] = prior.otu_abundances()
+
+        if len(thresholds) == 1 :
+            c = Cluster(self.seqdb, thresholds[0], self.options['verbose'], **cluster_args)
+            outputs = [ (c, self.options['cluster-fasta'], self.options['cluster-biom']) ]
+        else :
+            c = MultiCluster(self.seqdb, thresholds, self.options['verbose'], **cluster_args)
+            outputs = [ (level, 
+                         self.__threshold_filename(self.options['cluster-fasta'], level.similarity_threshold), 
+                         self.__threshold_filename(self.options['cluster-biom'], level.similarity_threshold)) for level in c ]
+
+        # snapshots of the clusters so far, in case we get killed
+        # (a snapshot is only resumed with the same clustering options)
+        checkpoint_settings = dict([ (o, self.options[o]) for o in ('aligner', 'kmer-length', 'no-homopolymer-correction', 
+                                                                     'dereplicate', 'merge-prefixes', 'duplicate-threshold', 
+                                                                     'total-duplicate-threshold', 'reference') ])
+
+        checkpoint = Checkpoint(self.options['checkpoint'], 
+                                self.options['checkpoint-time'], 
+                                self.options['checkpoint-seqs'],
+                                checkpoint_settings)
+
 #        c.create_clusters(keys=input_keys, homopolymer_correction=not self.options['no-homopolymer-correction'])
-        c.create_clusters2(keys=input_keys, 
-                           homopolymer_correction=not self.options['no-homopolymer-correction'], 
-                           singletons=singleton_keys,
-                           sample_threshold=self.options['sample-threshold'])
+        try :
+            c.create_clusters2(keys=input_keys, 
+                               homopolymer_correction=not self.options['no-homopolymer-correction'], 
+                               singletons=singleton_keys,
+                               sample_threshold=self.options['sample-threshold'],
+                               checkpoint=checkpoint,
+                               resume=self.options['resume'])
+
+        except CheckpointError, ce :
+            self.log.error(str(ce))
+            exit(1)
 
+        checkpoint.remove()
+
+        if cache is not None :
+            cache.close()
+
+        for clustering,centroid_fname,biom_fname in outputs :
+            self.__write_clusters(clustering, samples, centroid_fname, biom_fname, labels, prior)
+
+        self.seqdb.close()
+        
+        return 0
+
+    def __threshold_filename(self, filename, threshold) :
+        # seance.cluster.fasta -> seance.0.97.cluster.fasta
+        tag = "%g" % threshold
+        head,tail = os.path.split(filename)
+
+        if '.cluster.' in tail :
+            i = tail.rindex('.cluster.')
+            return join(head, tail[:i] + '.' + tag + tail[i:])
+
+        root,ext = splitext(filename)
+        return root + '.' + tag + ext
+
+    def __write_clusters(self, c, samples, centroid_fname, biom_fname, labels={}, prior_biom=None) :
         # output centroids to file
         # output biom file
         # run blast if necessary
-        centroid_fname = self.options['cluster-fasta']
-        biom_fname = self.options['cluster-biom']
-        otu_names = {}
+        otu_names = dict(labels)
 
         # write everything out anyway in case labelling fails or is killed
-        self.__fasta(centroid_fname, c.centroids(), names=otu_names)
-        self.__biom(biom_fname, samples, c, otu_names)
+        self.__centroid_fasta(centroid_fname, c, otu_names)
+        self.__biom(biom_fname, samples, c, otu_names, prior_biom)
 
         # blast to get better names
         if self.options['labels'] :
             print "getting OTU names (this may take a while)..."
-            otu_names = BlastN(self.options['verbose']).get_names(centroid_fname, self.options['labels'], self.options['labels-similarity'], self.options['labels_db'])
+            blast_plain = self.__uncompressed(centroid_fname)
+            otu_names = BlastN(self.options['verbose']).get_names(blast_plain, self.options['labels'], self.options['labels-similarity'], self.options['labels_db'])
+
+            if blast_plain != centroid_fname :
+                os.remove(blast_plain)
 
             if self.options['labels'] == 'blast' and self.options['merge-blast-hits'] :
                 c.merge(otu_names)
 
             # write out results files
-            self.__fasta(centroid_fname, c.centroids(), names=otu_names)
-            self.__biom(biom_fname, samples, c, otu_names)
-        
-        return 0
+            self.__centroid_fasta(centroid_fname, c, otu_names)
+            self.__biom(biom_fname, samples, c, otu_names, prior_biom)
 
     def label(self) :
         self.seqdb = self.__read_fasta(self.options['cluster-fasta'])
@@ -336,7 +519,10 @@ class WorkFlow(object) :
         # fasta file containing only those sequences
         if self.options['label-missing'] :
             tmp = []
-            biom = json.load(open(self.options['cluster-biom']))
+
+            with open_file(self.options['cluster-biom']) as f :
+                biom = json.load(f)
+
             for r in biom['rows'] :
                 if r['metadata']['label'] in ("", "unknown", "error", "cannot label (matches multiple domains!)") :
                     tmp.append(r['id'])
@@ -350,7 +536,11 @@ class WorkFlow(object) :
 
 
         print "getting OTU names (this may take a while)..." 
-        otu_names = BlastN(self.options['verbose']).get_names(blast_fname, self.options['labels'], self.options['labels-similarity'], self.options['labels_db'])
+        blast_plain = self.__uncompressed(blast_fname)
+        otu_names = BlastN(self.options['verbose']).get_names(blast_plain, self.options['labels'], self.options['labels-similarity'], self.options['labels_db'])
+
+        if blast_plain != blast_fname :
+            os.remove(blast_plain)
 
         # rework the biom
         biom = BiomFile()
@@ -359,12 +549,23 @@ class WorkFlow(object) :
 
         # get the rest of the names and rewrite fasta
         otu_names = biom.get_label_mapping(self.options['cluster-biom'])
-        self.__fasta(self.options['cluster-fasta'], self.seqdb.keys(), names=otu_names)
+        self.__fasta(self.options['cluster-fasta'], self.seqdb.keys(), names=otu_names, compression=detect(self.options['cluster-fasta']))
 
         return 0
 
-    def __fasta(self, filename, keys, names=None) :
-        f = open(filename, 'w')
+    def __uncompressed(self, filename) :
+        # other programs can only read uncompressed files, so compressed
+        # files are decompressed to a temporary file
+        if detect(filename) is None :
+            return filename
+
+        tmp = System.tempfilename(ext='.fasta')
+        decompress(filename, tmp)
+
+        return tmp
+
+    def __fasta(self, filename, keys, names=None, compression=None) :
+        f = open_file(filename, 'w', compression)
         
         if names is None :
             for key in keys :
@@ -386,20 +587,55 @@ class WorkFlow(object) :
 
         return filename
 
-    def __read_fasta(self, filename, include=None) :
-        tmp = {}
+    def __centroid_fasta(self, filename, clustering, names) :
+        f = open_file(filename, 'w', self.options['compress'])
 
-        if include :
-            include = include.lower()
+        for key in clustering.centroids() :
+            name = clustering.name(key)
+
+            print >> f, ">%s %s" % (name, names.get(name, "unknown"))
+            print >> f, clustering.sequence(key).sequence
+
+        f.close()
+        self.log.info("written %s" % filename)
+
+        return filename
+
+    def __read_reference(self, filename) :
+        # centroids from a previous run in cluster order, named seanceN
+        seqs = []
+        labels = {}
 
         f = FastqFile(filename)
         f.open()
 
         for seq in f :
-            if include :
-                if include not in seq.id.lower() :
-                    continue
+            fields = seq.id[1:].split()
+            seq.id = fields[0]
+
+            if len(fields) > 1 :
+                labels[seq.id] = fields[1]
+
+            seqs.append(seq)
+
+        f.close()
 
+        return seqs, labels
+
+    def __read_fasta(self, filename, include=None) :
+        tmp = {}
+
+        f = FastqFile(filename)
+
+        # with include only the matching records are read, using the index
+        if include :
+            include = include.lower()
+            seqs = f.select([ e.name for e in f.index() if include in ("%s %s" % (e.name, e.description)).lower() ])
+        else :
+            f.open()
+            seqs = f
+
+        for seq in seqs :
             seq.id = seq.id.split()[0][1:]
 
             #if only_include :
@@ -414,20 +650,42 @@ class WorkFlow(object) :
 
         return tmp
 
-    def __biom(self, filename, samples, clustering, cluster_names) :
+    def __biom(self, filename, samples, clustering, cluster_names, prior=None) :
         centroids = clustering.centroids()
         all_keys = clustering.all()
 
         output_clusters = clustering.clusters
         output_samples = [ s for s in samples if s.contains(all_keys) ]
-        output_otus = [ ("seance" + str(k), cluster_names.get("seance" + str(k), "unknown")) for k in centroids ]
 
         #self.log.info("%d / %d samples have at least one sequence used in clustering" % \
         #        (len(output_samples), len(samples)))
 
-        b = BiomFile()
-        b.set_samples(output_samples)
-        b.set_otus(output_otus)
+        # extend the biom file from a previous run with the new samples and 
+        # any new otus, otherwise start from scratch
+        if prior :
+            b = copy.deepcopy(prior)
+        else :
+            b = BiomFile()
+
+        otu_index = dict([ (otu[0], i) for i,otu in enumerate(b.otus) ])
+        rows = []
+
+        for k in centroids :
+            name = clustering.name(k)
+            otu = (name, cluster_names.get(name, "unknown"))
+
+            if name in otu_index :
+                b.otus[otu_index[name]] = otu
+            else :
+                otu_index[name] = len(b.otus)
+                b.add_otu(otu)
+
+            rows.append(otu_index[name])
+
+        first_sample = len(b.samples)
+
+        for sample in output_samples :
+            b.add_sample(sample.description(), sample.metadata)
 
         for sind,sample in enumerate(output_samples) :
             for cind,cluster in enumerate(output_clusters) :
@@ -437,9 +695,9 @@ class WorkFlow(object) :
                     if read in sample :
                         count += sample.seqcounts[read]
 
-                b.add_quantity(cind, sind, count)
+                b.add_quantity(rows[cind], first_sample + sind, count)
 
-        b.write_to(filename)
+        b.write_to(filename, self.options['compress'])
         self.log.info("written %s" % filename)
 
     def phylogeny(self) :
@@ -452,14 +710,19 @@ class WorkFlow(object) :
 
             self.log.info("read %d cluster centroids using subset(%s)" % (len(self.seqdb), self.options['subset']))
 
+        fasta = self.__uncompressed(self.options['cluster-fasta'])
+
         if not self.options['silva-fasta'] :
             self.log.info("aligning %s sequences with PAGAN ..." % (num_sequences))
-            alignment,tree,xmlfile = p.phylogenetic_alignment(self.options['cluster-fasta'])
+            alignment,tree,xmlfile = p.phylogenetic_alignment(fasta)
         else :
             self.log.info("aligning %s sequences with PAGAN against SILVA ..." % (num_sequences))
             alignment,tree,xmlfile = p.silva_phylogenetic_alignment(self.options['silva-fasta'], 
                                                                     self.options['silva-tree'], 
-                                                                    self.options['cluster-fasta'])
+                                                                    fasta)
+
+        if fasta != self.options['cluster-fasta'] :
+            os.remove(fasta)
 
         os.rename(alignment, self.options['phylogeny-fasta'])
         os.rename(tree,      self.options['phylogeny-tree'])
@@ -474,15 +737,7 @@ class WorkFlow(object) :
         return 0
 
     def __count(self, fasta) :
-        fq = FastqFile(fasta)
-        fq.open()
-
-        count = 0
-        for seq in fq :
-            count += 1
-
-        fq.close()
-        return count
+        return len(FastqFile(fasta))
 
     def heatmap(self) :
         self.log.info("creating heatmap using %s and %s" % (self.options['cluster-biom'], self.options['phylogeny-tree']))
@@ -573,7 +828,9 @@ class WorkFlow(object) :
         delim = self.options['delimiter']
         
         # read in
-        biom = json.load(open(self.options['cluster-biom']))
+        with open_file(self.options['cluster-biom']) as f :
+            biom = json.load(f)
+
         rows = get_ids(biom, 'rows')
         cols = get_ids(biom, 'columns')
 
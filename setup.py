@@ -13,7 +13,8 @@ setup(name='Seance',
       install_requires=[
           'biopython >= 1.6', 
           'dendropy == 3.12',
-          'cairocffi >= 0.5.4'
+          'cairocffi >= 0.5.4',
+          'numpy >= 1.15'
           ],
       scripts=['scripts/seance'],
      )